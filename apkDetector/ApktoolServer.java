@@ -0,0 +1,43 @@
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+
+/**
+ * Keeps one JVM warm across many apktool runs.
+ * Each line on stdin holds the tab separated arguments of one apktool
+ * command, e.g. "d\t-f\t-o\tout_dir\tapp.apk". After the command returns,
+ * one line "ok" or "error <message>" is written to stdout.
+ * Launched by apktool_worker.py with: java -cp apktool.jar ApktoolServer.java
+ */
+public class ApktoolServer {
+    public static void main(String[] args) throws Exception {
+        BufferedReader in = new BufferedReader(
+            new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        PrintStream out = new PrintStream(System.out, true, "UTF-8");
+        // apktool prints progress, keep stdout for the protocol only
+        PrintStream devNull = new PrintStream(OutputStream.nullOutputStream());
+        System.setOut(devNull);
+        System.setErr(devNull);
+        Method apktoolMain = Class.forName("brut.apktool.Main")
+            .getMethod("main", String[].class);
+        String line;
+        while ((line = in.readLine()) != null) {
+            if (line.isEmpty()) {
+                continue;
+            }
+            String status = "ok";
+            try {
+                apktoolMain.invoke(null, (Object) line.split("\t"));
+            } catch (InvocationTargetException e) {
+                status = "error " + e.getCause();
+            } catch (Throwable t) {
+                status = "error " + t;
+            }
+            out.println(status.replace('\n', ' '));
+        }
+    }
+}
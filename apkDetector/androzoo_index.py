@@ -0,0 +1,494 @@
+""" Columnar index of the AndroZoo apk list (latest.csv)
+    The csv is parsed once into a binary file of columns sorted by dex date:
+    sha256 (32 bytes), dex date (int32 days), market (uint16 code into a
+    market table) and package name (offsets into one utf-8 blob), plus the
+    permutation of the rows in sha256 order. Later runs mmap the file, select
+    date ranges by bisection and markets in C through map/compress, keep
+    selected rows as row numbers in sha256 order, and only build sha256
+    strings and Apk objects for the rows actually used.
+"""
+import array
+import bisect
+import datetime
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import typing
+
+INDEX_MAGIC = b'AZIDX002'
+# dex date of rows without one, sorted before every real date
+MISSING_DAY = -(2 ** 31)
+
+
+def date_to_day(date_str) -> int:
+    if len(date_str) == 0:
+        return MISSING_DAY
+    return datetime.date.fromisoformat(date_str).toordinal()
+
+
+def day_to_date(day) -> str:
+    if day == MISSING_DAY:
+        return ''
+    return datetime.date.fromordinal(day).isoformat()
+
+
+class AndroZooIndex(object):
+    def __init__(
+        self,
+        index_file,
+    ):
+        self.index_file = index_file
+        self.fd = open(index_file, 'rb')
+        self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError('not an androzoo index: {0}'.format(index_file))
+        header_len, = struct.unpack_from('<I', self.mm, len(INDEX_MAGIC))
+        header_start = len(INDEX_MAGIC) + 4
+        self.header = json.loads(self.mm[header_start:header_start + header_len])
+        self.row_count = self.header['row_count']
+        self.markets = self.header['markets']
+        # zero-copy column views on the mmap
+        view = memoryview(self.mm)
+        sections = self.header['sections']
+        self.ids = view[sections['ids'][0]:sections['ids'][1]]
+        self.days = view[sections['days'][0]:sections['days'][1]].cast('i')
+        self.market_codes = view[sections['markets'][0]:sections['markets'][1]].cast('H')
+        self.pkg_offsets = view[sections['pkg_offsets'][0]:sections['pkg_offsets'][1]].cast('q')
+        self.pkg_blob = view[sections['pkgs'][0]:sections['pkgs'][1]]
+        # rows in sha256 order, and by row whether it has the sha256 of the
+        # row before it in that order
+        self.id_order = view[sections['id_order'][0]:sections['id_order'][1]].cast('I')
+        self.id_dups = view[sections['id_dups'][0]:sections['id_dups'][1]]
+
+    def close(self):
+        for column in [
+            self.ids,
+            self.days,
+            self.market_codes,
+            self.pkg_offsets,
+            self.pkg_blob,
+            self.id_order,
+            self.id_dups,
+        ]:
+            column.release()
+        self.mm.close()
+        self.fd.close()
+
+    def is_fresh(self, csv_file) -> bool:
+        """ whether the index was built from the current csv_file
+        """
+        stat = os.stat(csv_file)
+        return (
+            self.header['csv_size'] == stat.st_size
+            and self.header['csv_mtime'] == int(stat.st_mtime)
+        )
+
+    @staticmethod
+    def build(
+        csv_file,
+        index_file,
+    ):
+        """ one pass over the csv, then write the columns sorted by dex date
+        """
+        start_time = time.time()
+        ids = bytearray()
+        days = array.array('i')
+        market_codes = array.array('H')
+        pkgs = []
+        market_table = {}
+        day_cache = {}
+        with open(csv_file, 'r') as fd:
+            line_num = 0
+            for line in fd:
+                line_num += 1
+                if line_num == 1:
+                    continue
+                attrs = line.strip().split(',')
+                try:
+                    sha256 = bytes.fromhex(attrs[0])
+                    dex_ds = attrs[3].split(' ')[0]
+                    day = day_cache.get(dex_ds)
+                    if day is None:
+                        day = day_cache[dex_ds] = date_to_day(dex_ds)
+                except (ValueError, IndexError) as e:
+                    logging.warning('skip bad androzoo line %d: %s', line_num, e)
+                    continue
+                if len(sha256) != 32:
+                    continue
+                market = attrs[-1]
+                market_code = market_table.get(market)
+                if market_code is None:
+                    market_code = market_table[market] = len(market_table)
+                ids += sha256
+                days.append(day)
+                market_codes.append(market_code)
+                pkgs.append(attrs[5].strip('""').encode('utf-8'))
+        if len(market_table) > 65535:
+            raise ValueError('too many distinct markets: {0}'.format(len(market_table)))
+        row_count = len(days)
+        order = sorted(range(row_count), key=days.__getitem__)
+        # columns in dex date order
+        sorted_ids = b''.join([ids[i * 32:i * 32 + 32] for i in order])
+        sorted_days = array.array('i', [days[i] for i in order])
+        sorted_markets = array.array('H', [market_codes[i] for i in order])
+        pkg_offsets = array.array('q', [0])
+        for i in order:
+            pkg_offsets.append(pkg_offsets[-1] + len(pkgs[i]))
+        pkg_blob = b''.join([pkgs[i] for i in order])
+        del ids, days, market_codes, pkgs, order
+        # stable, so an apk listed twice has its earliest dex date first
+        id_order = array.array('I', sorted(
+            range(row_count),
+            key=lambda row: sorted_ids[row * 32:row * 32 + 32],
+        ))
+        # by row, whether its sha256 is that of the row before it in id_order
+        id_dups = bytearray(row_count)
+        for i in range(1, row_count):
+            row, last_row = id_order[i], id_order[i - 1]
+            if sorted_ids[row * 32:row * 32 + 32] == sorted_ids[last_row * 32:last_row * 32 + 32]:
+                id_dups[row] = 1
+        columns = [
+            ('ids', sorted_ids),
+            ('days', sorted_days.tobytes()),
+            ('markets', sorted_markets.tobytes()),
+            ('pkg_offsets', pkg_offsets.tobytes()),
+            ('pkgs', pkg_blob),
+            ('id_order', id_order.tobytes()),
+            ('id_dups', bytes(id_dups)),
+        ]
+        stat = os.stat(csv_file)
+        header = {
+            'row_count': row_count,
+            'markets': [market for market, code in sorted(market_table.items(), key=lambda item: item[1])],
+            'csv_size': stat.st_size,
+            'csv_mtime': int(stat.st_mtime),
+            'sections': {},
+        }
+        # the header holds the section offsets, so size it with placeholders
+        # first; offsets are 8-aligned for the int views
+        header['sections'] = {name: [0, 0] for name, data in columns}
+        header_len = len(json.dumps(header)) + 64 * len(columns)
+        offset = len(INDEX_MAGIC) + 4 + header_len
+        for name, data in columns:
+            offset = (offset + 7) // 8 * 8
+            header['sections'][name] = [offset, offset + len(data)]
+            offset += len(data)
+        header_bytes = json.dumps(header).encode('utf-8').ljust(header_len)
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'wb') as fd:
+            fd.write(INDEX_MAGIC)
+            fd.write(struct.pack('<I', header_len))
+            fd.write(header_bytes)
+            for name, data in columns:
+                fd.write(b'\0' * (header['sections'][name][0] - fd.tell()))
+                fd.write(data)
+        os.replace(tmp_file, index_file)
+        logging.info(
+            'built androzoo index of %d apks in %d seconds',
+            row_count,
+            time.time() - start_time,
+        )
+
+    @classmethod
+    def open(
+        cls,
+        csv_file,
+        index_file=None,
+    ) -> 'AndroZooIndex':
+        """ open the index of csv_file, (re)building it if missing or stale
+        """
+        if index_file is None:
+            index_file = csv_file + '.idx'
+        if os.path.exists(index_file):
+            try:
+                index = cls(index_file)
+            except (ValueError, KeyError) as e:
+                # written by an older version
+                logging.info('rebuild androzoo index %s: %s', index_file, e)
+            else:
+                if index.is_fresh(csv_file):
+                    return index
+                index.close()
+                logging.info('androzoo index %s is stale, rebuild it', index_file)
+        cls.build(csv_file, index_file)
+        return cls(index_file)
+
+    def day_range(self, after_ds=None, before_ds=None) -> typing.List[range]:
+        """ row ranges of dex date after after_ds or before before_ds
+            (either one, as the csv loaders did), all rows if both are None
+        """
+        if after_ds is None and before_ds is None:
+            return [range(self.row_count)]
+        # rows without a dex date sort first and never pass a date filter
+        first_dated = bisect.bisect_right(self.days, MISSING_DAY)
+        ranges = []
+        if before_ds is not None:
+            ranges.append(range(first_dated, bisect.bisect_left(self.days, date_to_day(before_ds))))
+        if after_ds is not None:
+            start = bisect.bisect_right(self.days, date_to_day(after_ds))
+            if len(ranges) > 0:
+                # the two ranges overlap when after_ds < before_ds
+                start = max(start, ranges[0].stop)
+            ranges.append(range(start, self.row_count))
+        return ranges
+
+    def select(
+        self,
+        after_ds=None,
+        before_ds=None,
+        markets=None, # keep rows listing any of these markets
+        apk_class=None, # built from the fields of a row, dicts if None
+    ) -> 'ApkSelection':
+        ranges = self.day_range(after_ds, before_ds)
+        is_selected = bytearray(self.row_count)
+        wanted_codes = None
+        if markets is not None:
+            markets = set(markets)
+            wanted_codes = set([
+                code
+                for code, market in enumerate(self.markets)
+                if markets & set(market.strip('"').split('|'))
+            ])
+        for row_range in ranges:
+            if wanted_codes is None:
+                is_selected[row_range.start:row_range.stop] = b'\1' * len(row_range)
+            else:
+                is_selected[row_range.start:row_range.stop] = bytes(map(
+                    wanted_codes.__contains__,
+                    self.market_codes[row_range.start:row_range.stop],
+                ))
+        # selected rows in sha256 order, without building any key
+        rows = array.array('I', itertools.compress(
+            self.id_order,
+            map(is_selected.__getitem__, self.id_order),
+        ))
+        # an apk listed twice keeps its first selected row, as the csv loader
+        # did; duplicates are rare, so only flagged rows are looked at
+        dup_positions = [
+            i
+            for i in itertools.compress(range(len(rows)), map(self.id_dups.__getitem__, rows))
+            if i > 0 and self.raw_id(rows[i - 1]) == self.raw_id(rows[i])
+        ]
+        for i in reversed(dup_positions):
+            del rows[i]
+        return ApkSelection(self, rows, apk_class)
+
+    def raw_id(self, row) -> bytes:
+        return bytes(self.ids[row * 32:row * 32 + 32])
+
+    def sha256(self, row) -> str:
+        return self.ids[row * 32:row * 32 + 32].hex()
+
+    def pkg_id(self, row) -> str:
+        return bytes(
+            self.pkg_blob[self.pkg_offsets[row]:self.pkg_offsets[row + 1]]
+        ).decode('utf-8')
+
+    def dex_date(self, row) -> str:
+        return day_to_date(self.days[row])
+
+    def market(self, row) -> str:
+        return self.markets[self.market_codes[row]]
+
+
+class ApkSelection(object):
+    """ read-only mapping of sha256 -> Apk over selected index rows
+        the selection is an array of row numbers in sha256 order; lookups
+        bisect it, and sha256 strings and Apk objects are built on access, so
+        that callers can keep rows rather than strings
+    """
+    def __init__(
+        self,
+        index: AndroZooIndex,
+        rows: typing.Sequence[int],
+        apk_class=None,
+    ):
+        self.index = index
+        self.rows = rows
+        # rows are below it, e.g., to size a bytearray of flags by row
+        self.row_limit = index.row_count
+        self.apk_class = apk_class
+
+    def raw_id(self, row) -> bytes:
+        return self.index.raw_id(row)
+
+    def sha256(self, row) -> str:
+        return self.index.sha256(row)
+
+    def fields_of(self, row) -> dict:
+        return dict(
+            id=self.index.sha256(row),
+            pkg_id=self.index.pkg_id(row),
+            dex_date=self.index.dex_date(row),
+            market=self.index.market(row),
+        )
+
+    def apk(self, row):
+        fields = self.fields_of(row)
+        if self.apk_class is None:
+            return fields
+        return self.apk_class(**fields)
+
+    def shard_of(self, row, shard_count) -> int:
+        """ same as shard_lease.shard_of of its sha256
+        """
+        return int.from_bytes(self.raw_id(row)[:4], 'big') * shard_count >> 32
+
+    def _bisect(self, raw_id, lo, hi) -> int:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw_id(self.rows[mid]) < raw_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def row_of(self, sha256) -> typing.Optional[int]:
+        try:
+            raw_id = bytes.fromhex(sha256)
+        except (ValueError, TypeError):
+            return None
+        i = self._bisect(raw_id, 0, len(self.rows))
+        if i < len(self.rows) and self.raw_id(self.rows[i]) == raw_id:
+            return self.rows[i]
+        return None
+
+    def find_rows(
+        self,
+        items: typing.Iterable,
+        key=None, # sha256 of an item, the item itself if None
+    ) -> typing.Iterator[typing.Tuple[typing.Any, typing.Optional[int]]]:
+        """ (item, row or None) for each item; items in sha256 order, e.g.,
+            ids read from the result store, take a galloping merge along the
+            rows instead of a bisection each
+        """
+        lo = 0
+        last_raw_id = None
+        for item in items:
+            try:
+                raw_id = bytes.fromhex(item if key is None else key(item))
+            except (ValueError, TypeError):
+                yield item, None
+                continue
+            if last_raw_id is not None and raw_id < last_raw_id:
+                # out of order, search from the start again
+                lo = 0
+            last_raw_id = raw_id
+            bound = 1
+            while lo + bound <= len(self.rows) and self.raw_id(self.rows[lo + bound - 1]) < raw_id:
+                bound *= 2
+            lo = self._bisect(raw_id, lo + bound // 2, min(lo + bound, len(self.rows)))
+            if lo < len(self.rows) and self.raw_id(self.rows[lo]) == raw_id:
+                yield item, self.rows[lo]
+            else:
+                yield item, None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, sha256):
+        return self.row_of(sha256) is not None
+
+    def __iter__(self):
+        return map(self.sha256, self.rows)
+
+    def keys(self):
+        return iter(self)
+
+    def fields(self, sha256) -> dict:
+        row = self.row_of(sha256)
+        if row is None:
+            raise KeyError(sha256)
+        return self.fields_of(row)
+
+    def __getitem__(self, sha256):
+        row = self.row_of(sha256)
+        if row is None:
+            raise KeyError(sha256)
+        return self.apk(row)
+
+
+class CsvSelection(ApkSelection):
+    """ ApkSelection over records parsed straight from the csv, rows are
+        positions in the records sorted by sha256
+    """
+    def __init__(
+        self,
+        records: typing.List[tuple], # (raw sha256, pkg_id, dex_date, market)
+        apk_class=None,
+    ):
+        self.records = sorted(records)
+        self.rows = range(len(self.records))
+        self.row_limit = len(self.records)
+        self.apk_class = apk_class
+
+    def raw_id(self, row) -> bytes:
+        return self.records[row][0]
+
+    def sha256(self, row) -> str:
+        return self.records[row][0].hex()
+
+    def fields_of(self, row) -> dict:
+        raw_id, pkg_id, dex_date, market = self.records[row]
+        return dict(
+            id=raw_id.hex(),
+            pkg_id=pkg_id,
+            dex_date=dex_date,
+            market=market,
+        )
+
+
+def select_csv(
+    csv_file,
+    after_ds=None,
+    before_ds=None,
+    markets=None,
+    apk_class=None,
+) -> CsvSelection:
+    """ the apks AndroZooIndex.select would return, parsed straight from
+        csv_file, for when the index cannot be built or opened
+    """
+    after_day = date_to_day(after_ds) if after_ds is not None else None
+    before_day = date_to_day(before_ds) if before_ds is not None else None
+    if markets is not None:
+        markets = set(markets)
+    records = {}
+    with open(csv_file, 'r') as fd:
+        line_num = 0
+        for line in fd:
+            line_num += 1
+            if line_num == 1:
+                continue
+            attrs = line.strip().split(',')
+            try:
+                sha256 = bytes.fromhex(attrs[0])
+                dex_ds = attrs[3].split(' ')[0]
+                market = attrs[-1]
+            except (ValueError, IndexError) as e:
+                logging.warning('skip bad androzoo line %d: %s', line_num, e)
+                continue
+            if len(sha256) != 32:
+                continue
+            if markets is not None and not markets & set(market.strip('"').split('|')):
+                continue
+            try:
+                day = date_to_day(dex_ds)
+            except ValueError as e:
+                logging.warning('skip bad androzoo line %d: %s', line_num, e)
+                continue
+            if after_day is not None or before_day is not None:
+                if day == MISSING_DAY: # some didn't have dex_ds
+                    continue
+                if not (
+                    (after_day is not None and day > after_day)
+                    or (before_day is not None and day < before_day)
+                ):
+                    continue
+            # an apk listed twice keeps its earliest row, as in the index
+            if sha256 not in records or day < records[sha256][0]:
+                records[sha256] = (day, (sha256, attrs[5].strip('""'), dex_ds, market))
+    return CsvSelection([record for day, record in records.values()], apk_class)
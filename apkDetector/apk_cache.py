@@ -0,0 +1,374 @@
+""" Content-addressed cache of apks shared across runs
+    Apks are kept by sha256 in a local directory (sharded like apk_base_dir)
+    with a sqlite index of sizes and last use, evicting the least recently
+    used apks beyond max_size. download_apk looks here before AndroZoo and
+    adds what it downloaded, so that sweeps with other signs, or apks deleted
+    as non-hits, do not pay the download again. Within a file system, cached
+    apks and the apks in apk_base_dir are hard links of one file: apks are
+    only ever replaced or removed, never modified in place, and other tools
+    must do the same. The same cache can be served over http to other
+    machines:
+        python apk_cache.py cache_dir -ms 500 -ho 0.0.0.0 -p 8765 -tf token_file
+    and used there with an http://host:8765 location. The server listens on
+    127.0.0.1 by default and is read-only unless a token file is given, PUT
+    then needs an "Authorization: Bearer <token>" header.
+"""
+import argparse
+import hashlib
+import hmac
+import http.server
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import typing
+import requests
+from sqlite_store import SqliteStore
+
+GB = 1024 * 1024 * 1024
+
+
+class LocalApkCache(SqliteStore):
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS apk_cache (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER,
+            last_used REAL
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS apk_cache_last_used ON apk_cache (last_used)',
+    )
+
+    def __init__(
+        self,
+        cache_dir,
+        max_size=100*GB, # bytes
+        timeout=60,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_file = os.path.join(cache_dir, 'apk_cache.db')
+        super().__init__(self.index_file, timeout=timeout)
+
+    def apk_file(self, sha256) -> str:
+        sha256 = sha256.lower()
+        return os.path.join(
+            self.cache_dir,
+            sha256[-6:-4],
+            sha256[-4:-2],
+            sha256[-2:],
+            sha256 + '.apk',
+        )
+
+    def touch(self, sha256, size):
+        try:
+            self.connect().execute(
+                'INSERT OR REPLACE INTO apk_cache VALUES (?, ?, ?)',
+                (sha256.lower(), size, time.time()),
+            )
+        except sqlite3.Error as e:
+            logging.debug('apk cache index update failed: %s', e)
+
+    def open(self, sha256) -> typing.Optional[typing.BinaryIO]:
+        """ the cached apk opened for reading, None on a miss
+        """
+        try:
+            fd = open(self.apk_file(sha256), 'rb')
+        except OSError:
+            return None
+        self.touch(sha256, os.fstat(fd.fileno()).st_size)
+        return fd
+
+    def fetch(self, sha256, result_file) -> bool:
+        """ link or copy the cached apk to result_file, False on a miss;
+            a linked result_file must be replaced rather than modified
+        """
+        cache_file = self.apk_file(sha256)
+        tmp_file = result_file + '.cache'
+        try:
+            try:
+                os.link(cache_file, tmp_file)
+            except OSError:
+                # another file system, or no hard links
+                shutil.copyfile(cache_file, tmp_file)
+            os.replace(tmp_file, result_file)
+        except OSError:
+            # missing, or evicted meanwhile
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+        self.touch(sha256, os.path.getsize(result_file))
+        return True
+
+    def put(self, sha256, apk_file):
+        """ add a downloaded apk whose sha256 was checked, as a hard link of
+            apk_file where possible
+        """
+        cache_file = self.apk_file(sha256)
+        if os.path.exists(cache_file):
+            self.touch(sha256, os.path.getsize(cache_file))
+            return
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        try:
+            try:
+                os.link(apk_file, tmp_file)
+            except OSError:
+                shutil.copyfile(apk_file, tmp_file)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logging.warning('error when caching %s: %s', sha256[-6:], e)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return
+        self.touch(sha256, os.path.getsize(cache_file))
+        self.evict()
+
+    def evict(self, batch_size=100):
+        """ remove the least recently used apks beyond max_size
+        """
+        conn = self.connect()
+        try:
+            total_size = conn.execute('SELECT TOTAL(size) FROM apk_cache').fetchone()[0]
+            while total_size > self.max_size:
+                rows = conn.execute(
+                    'SELECT sha256, size FROM apk_cache ORDER BY last_used LIMIT ?',
+                    (batch_size,),
+                ).fetchall()
+                if len(rows) == 0:
+                    break
+                evicted = []
+                for sha256, size in rows:
+                    if total_size <= self.max_size:
+                        break
+                    try:
+                        os.remove(self.apk_file(sha256))
+                    except OSError:
+                        pass
+                    evicted.append((sha256,))
+                    total_size -= size
+                conn.executemany('DELETE FROM apk_cache WHERE sha256=?', evicted)
+                logging.debug('evicted %d apks from the apk cache', len(evicted))
+        except sqlite3.Error as e:
+            logging.debug('apk cache eviction failed: %s', e)
+
+
+class HttpApkCache(object):
+    """ client of an apk cache served by this module, GET and PUT by sha256
+    """
+    def __init__(
+        self,
+        base_url,
+        chunk_size=10240*1024,
+        timeout=(10, 60),
+        token=None, # needed to PUT, read-only without
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        # created lazily, one session per process
+        self.session = None
+        self.session_pid = None
+
+    def get_session(self) -> requests.Session:
+        if self.session is None or self.session_pid != os.getpid():
+            self.session = requests.Session()
+            self.session_pid = os.getpid()
+        return self.session
+
+    def fetch(self, sha256, result_file) -> bool:
+        tmp_file = result_file + '.cache'
+        new_sha256 = hashlib.sha256()
+        try:
+            with self.get_session().get(
+                '{0}/{1}'.format(self.base_url, sha256.lower()),
+                stream=True,
+                timeout=self.timeout,
+            ) as response:
+                if response.status_code != 200:
+                    return False
+                with open(tmp_file, 'wb') as fd:
+                    for data in response.iter_content(chunk_size=self.chunk_size):
+                        new_sha256.update(data)
+                        fd.write(data)
+        except (requests.RequestException, OSError) as e:
+            logging.debug('apk cache fetch of %s failed: %s', sha256[-6:], e)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+        if new_sha256.hexdigest() != sha256.lower():
+            os.remove(tmp_file)
+            return False
+        os.replace(tmp_file, result_file)
+        return True
+
+    def put(self, sha256, apk_file):
+        if self.token is None:
+            return
+        try:
+            with open(apk_file, 'rb') as fd:
+                self.get_session().put(
+                    '{0}/{1}'.format(self.base_url, sha256.lower()),
+                    data=fd,
+                    headers={'Authorization': 'Bearer {0}'.format(self.token)},
+                    timeout=self.timeout,
+                ).close()
+        except (requests.RequestException, OSError) as e:
+            logging.debug('apk cache put of %s failed: %s', sha256[-6:], e)
+
+
+def open_apk_cache(location, max_size=100*GB, token=None):
+    """ LocalApkCache of a directory, or HttpApkCache of an http(s) url
+    """
+    if location.startswith('http://') or location.startswith('https://'):
+        return HttpApkCache(location, token=token)
+    return LocalApkCache(location, max_size=max_size)
+
+
+def fetch_cached_apk(
+    apk_cache,
+    sha256,
+    result_file,
+    chunk_size=10240*1024,
+    chunk_callback=None,
+) -> bool:
+    """ fetch sha256 from apk_cache into result_file, a stale part file of
+        an earlier download is dropped and chunk_callback sees the apk bytes
+        as if they were downloaded
+    """
+    if not apk_cache.fetch(sha256, result_file):
+        return False
+    part_file = result_file + '.part'
+    if os.path.exists(part_file):
+        os.remove(part_file)
+    if chunk_callback is not None:
+        with open(result_file, 'rb') as fd:
+            while True:
+                data = fd.read(chunk_size)
+                if not data:
+                    break
+                chunk_callback(data)
+    logging.debug('apk %s from the apk cache', sha256[-6:])
+    return True
+
+
+class ApkCacheHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    apk_cache: LocalApkCache = None
+    # bearer token PUT needs, read-only if None
+    token: typing.Optional[str] = None
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def sha256_of_path(self) -> typing.Optional[str]:
+        sha256 = self.path.strip('/').lower()
+        if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+            return None
+        return sha256
+
+    def do_GET(self):
+        sha256 = self.sha256_of_path()
+        fd = self.apk_cache.open(sha256) if sha256 is not None else None
+        if fd is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with fd:
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.fstat(fd.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(fd, self.wfile)
+
+    def is_authorized(self) -> bool:
+        if self.token is None:
+            return False
+        return hmac.compare_digest(
+            self.headers.get('Authorization', ''),
+            'Bearer {0}'.format(self.token),
+        )
+
+    def do_PUT(self):
+        if not self.is_authorized():
+            # the body is not read, so the connection cannot be reused
+            self.close_connection = True
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            return
+        sha256 = self.sha256_of_path()
+        length = int(self.headers.get('Content-Length', 0))
+        if sha256 is None or length <= 0:
+            self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        tmp_file = os.path.join(
+            self.apk_cache.cache_dir,
+            '{0}.{1}.upload'.format(sha256, os.getpid()),
+        )
+        new_sha256 = hashlib.sha256()
+        with open(tmp_file, 'wb') as fd:
+            while length > 0:
+                data = self.rfile.read(min(length, 1024 * 1024))
+                if not data:
+                    break
+                new_sha256.update(data)
+                fd.write(data)
+                length -= len(data)
+        if new_sha256.hexdigest() == sha256:
+            self.apk_cache.put(sha256, tmp_file)
+            self.send_response(201)
+        else:
+            self.send_response(400)
+        os.remove(tmp_file)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def serve(
+    cache_dir,
+    max_size=100*GB,
+    host='127.0.0.1',
+    port=8765,
+    token=None, # bearer token for PUT, read-only if None
+):
+    ApkCacheHandler.apk_cache = LocalApkCache(cache_dir, max_size=max_size)
+    ApkCacheHandler.token = token
+    os.makedirs(cache_dir, exist_ok=True)
+    server = http.server.ThreadingHTTPServer((host, port), ApkCacheHandler)
+    logging.info(
+        'serving apk cache %s on %s:%d, %s',
+        cache_dir,
+        host,
+        port,
+        'read-only' if token is None else 'PUT with a token',
+    )
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    format_str = '%(asctime)s - %(levelname)s - %(message)s -%(funcName)s'
+    logging.basicConfig(level=logging.INFO, format=format_str)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cache_dir')
+    parser.add_argument('-ms', '--max_size', type=int, default=100, help='GB of apks to keep')
+    parser.add_argument('-ho', '--host', type=str, default='127.0.0.1', help='e.g., 0.0.0.0 to serve other machines')
+    parser.add_argument('-p', '--port', type=int, default=8765)
+    parser.add_argument('-tf', '--token_file', type=str, default=None, help='file with the token clients need to PUT apks, read-only without')
+    options = parser.parse_args()
+    token = None
+    if options.token_file is not None:
+        token = open(options.token_file, 'r').read().strip()
+    serve(
+        options.cache_dir,
+        max_size=options.max_size * GB,
+        host=options.host,
+        port=options.port,
+        token=token,
+    )
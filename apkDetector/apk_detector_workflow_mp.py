@@ -19,8 +19,33 @@ import queue
 import time
 import re
 import typing
+import struct
+import array
+import socket
+import errno
 import get_apk_from_androzoo as du
-import datetime
+from get_apk_from_androzoo import put_until
+import zipfile
+import asyncio
+import concurrent.futures
+import fnmatch
+import contextlib
+import itertools
+from sign_matcher import SignMatcher, SignStream, StopCheck
+from entry_cache import EntryVerdictCache
+from feature_store import FeatureCollector, FeatureStore, pack_features
+from apktool_worker import ApktoolWorker
+from rate_controller import AimdController
+from pool_supervisor import WorkerPool, PoolSupervisor
+from task_journal import TaskJournal, TaskState
+from androzoo_index import AndroZooIndex, ApkSelection, select_csv
+from result_store import ResultStore, is_result_store
+from apk_manifest import ApkManifest
+from shard_lease import ShardLeaser, ShardProgress
+from apk_cache import open_apk_cache, GB
+import dex_parser
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s -%(funcName)s'
 
 
 class ApkSign(object):
@@ -36,35 +61,190 @@ class ApkSign(object):
         self.provider = provider
         self.type = type
 
+# a java package or class name: three or more identifiers joined by dots,
+# not ending in a file extension like libviblast.so or peer5.min.js
+PACKAGE_SIGN_RE = re.compile(r'^[A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*){2,}$')
+FILE_EXTS = set(['so', 'js', 'json', 'xml', 'html', 'txt', 'dex', 'jar', 'apk', 'zip', 'bin', 'png', 'jpg'])
+
+def is_package_sign(sign_str) -> bool:
+    return (
+        PACKAGE_SIGN_RE.match(sign_str) is not None
+        and sign_str.rsplit('.', 1)[1].lower() not in FILE_EXTS
+    )
+
+class ScanRules(object):
+    """ Which unpacked files or zip entries to scan, and in which order
+        loaded from a {"scan_rules": {...}} line of the sign file
+    """
+    def __init__(
+        self,
+        exclude_dirs=None, # globs of paths skipped entirely
+        include_dirs=None, # globs of paths to scan, all if empty
+        exclude_exts=None, # extensions whose content is not scanned
+        max_file_size=None, # larger files are not scanned
+        priority_dirs=None, # globs of paths scanned first
+        sign_strs=None, # package paths derived from signs are scanned first
+    ):
+        self.exclude_dirs = exclude_dirs if exclude_dirs else []
+        self.include_dirs = include_dirs if include_dirs else []
+        if exclude_exts is None:
+            exclude_exts = ['png', 'jpeg', 'gif', 'jpg', 'mp3', 'mp4']
+        self.exclude_exts = tuple(
+            '.' + ext.lower().lstrip('.') for ext in exclude_exts
+        )
+        self.max_file_size = max_file_size
+        self.priority_dirs = priority_dirs if priority_dirs else []
+        # one regex for all priority globs
+        self.priority_dirs_re = None
+        if len(self.priority_dirs) > 0:
+            self.priority_dirs_re = re.compile(
+                '|'.join([fnmatch.translate(pattern) for pattern in self.priority_dirs])
+            )
+        # com.xxx.p2p -> com/xxx/p2p, as in smali paths; file names such as
+        # libviblast.so are left alone
+        self.priority_paths = set()
+        for sign_str in (sign_strs if sign_strs else []):
+            if '/' in sign_str:
+                self.priority_paths.add(sign_str)
+            elif is_package_sign(sign_str):
+                self.priority_paths.add(sign_str.replace('.', '/'))
+        # all package paths matched in one pass over a path
+        self.priority_path_matcher = SignMatcher(self.priority_paths)
+
+    def is_path_excluded(self, path) -> bool:
+        if any(fnmatch.fnmatch(path, pattern) for pattern in self.exclude_dirs):
+            return True
+        if len(self.include_dirs) > 0:
+            return not any(fnmatch.fnmatch(path, pattern) for pattern in self.include_dirs)
+        return False
+
+    def is_content_excluded(self, path, size) -> bool:
+        if path.lower().endswith(self.exclude_exts):
+            return True
+        return self.max_file_size is not None and size > self.max_file_size
+
+    def priority(self, path) -> int:
+        if self.priority_dirs_re is not None and self.priority_dirs_re.match(path):
+            return 0
+        if self.priority_path_matcher.contains_any(path.encode('utf-8', errors='surrogateescape')):
+            return 0
+        return 1
+
+    def order(self, paths, key=None) -> list:
+        """ most likely hit locations first, stable otherwise
+        """
+        if key is None:
+            key = lambda path: path
+        return sorted(paths, key=lambda item: self.priority(key(item)))
+
+# binary task batches on the multiprocessing queues: a record count, then
+# per apk the raw sha256 and the lengths of its utf-8 fields, then the fields;
+# the last field is the json list of raw_signs, empty if None
+APK_BATCH_HEADER = struct.Struct('<I')
+APK_RECORD_HEADER = struct.Struct('<32sHHHHI')
+
 class Apk(object):
     """ Define apk meta data
     """
+    # no per-instance __dict__, tens of millions of candidates are loaded
+    __slots__ = ('id', 'pkg_id', 'dex_date', 'market', 'apk_file', 'raw_signs')
+
     def __init__(
         self,
         id: str,
         pkg_id: str,
         dex_date: str='1966-06-06',
         market: str='Unknown',
+        apk_file: typing.Optional[str]=None,
+        raw_signs: typing.Optional[typing.List[str]]=None,
     ):
         self.id = id
         self.pkg_id = pkg_id
         self.dex_date = dex_date
         self.market = market
+        if apk_file is None:
+            apk_file = os.path.join(
+                self.base_dir,
+                self.name,
+            )
+        self.apk_file = apk_file
+        # signs matched on the raw bytes while downloading, None if not matched
+        self.raw_signs = raw_signs
+
+    @property
+    def base_dir(self) -> str:
         # the last 6 characters in id
-        self.base_dir = os.path.join(
+        return os.path.join(
             self.id[-6:-4],
             self.id[-4:-2],
             self.id[-2:],
         )
-        self.name = '{pkg_id}_{dex_ds}_{hash}.apk'.format(
+
+    @property
+    def name(self) -> str:
+        return '{pkg_id}_{dex_ds}_{hash}.apk'.format(
             pkg_id=self.pkg_id,
             dex_ds=self.dex_date,
             hash=self.id[-6:],
         )
-        self.apk_file = os.path.join(
-            self.base_dir,
-            self.name,
-        )
+
+    def to_dict(self) -> dict:
+        """ the apk_meta of detection results
+        """
+        return {
+            'id': self.id,
+            'pkg_id': self.pkg_id,
+            'dex_date': self.dex_date,
+            'market': self.market,
+            'base_dir': self.base_dir,
+            'name': self.name,
+            'apk_file': self.apk_file,
+        }
+
+    @staticmethod
+    def pack_batch(apks: typing.Sequence['Apk']) -> bytes:
+        parts = [APK_BATCH_HEADER.pack(len(apks))]
+        for apk in apks:
+            fields = [
+                item.encode('utf-8')
+                for item in (apk.pkg_id, apk.dex_date, apk.market, apk.apk_file)
+            ]
+            fields.append(
+                b'' if apk.raw_signs is None else json.dumps(apk.raw_signs).encode('utf-8')
+            )
+            parts.append(APK_RECORD_HEADER.pack(
+                bytes.fromhex(apk.id),
+                *[len(item) for item in fields]
+            ))
+            parts.extend(fields)
+        return b''.join(parts)
+
+    @staticmethod
+    def unpack_batch(data: bytes) -> typing.List['Apk']:
+        apks = []
+        count, = APK_BATCH_HEADER.unpack_from(data, 0)
+        offset = APK_BATCH_HEADER.size
+        for i in range(count):
+            sha256, *field_lens = APK_RECORD_HEADER.unpack_from(data, offset)
+            offset += APK_RECORD_HEADER.size
+            fields = []
+            for field_len in field_lens:
+                fields.append(data[offset:offset + field_len].decode('utf-8'))
+                offset += field_len
+            raw_signs_str = fields.pop()
+            raw_signs = json.loads(raw_signs_str) if len(raw_signs_str) > 0 else None
+            apks.append(Apk(sha256.hex(), *fields, raw_signs=raw_signs))
+        return apks
+
+class ScanMode(object):
+    APKTOOL = 'apktool' # unpack every apk with apktool
+    ZIP = 'zip' # scan zip entries in process, apktool only for smali signs
+    DEX = 'dex' # as zip, dex string pools stand in for smali, no apktool
+
+class VerdictMode(object):
+    EXHAUSTIVE = 'exhaustive' # match every sign
+    FIRST_HIGH = 'first_high' # stop at the first high confidence hit
+    PROVIDER = 'provider' # stop matching the signs of a provider once it is identified
 
 class ApkDetector(object):
     def __init__(
@@ -73,27 +253,81 @@ class ApkDetector(object):
         detect_dir,
         apk_signs=None,
         encoding=None,
+        scan_mode=ScanMode.APKTOOL,
+        max_entry_size=None,
+        entry_cache=None,
+        verdict_mode=VerdictMode.EXHAUSTIVE,
+        apktool_worker=None,
+        scan_rules=None,
+        memory_budget=256*1024*1024,
     ):
         self.apk_tool = apk_tool
+        # ApktoolWorker keeping the jvm warm, None to fork apktool per apk
+        self.apktool_worker = apktool_worker
         self.detect_dir = detect_dir
         self.apk_signs = apk_signs if apk_signs else []
         self.encoding=encoding if encoding else 'utf-8'
+        self.scan_mode = scan_mode
+        if scan_rules is None:
+            scan_rules = ScanRules(
+                sign_strs=[item.sign_str for item in self.apk_signs],
+            )
+        self.scan_rules = scan_rules
+        # bytes of file content held in memory at once; files are matched in
+        # chunks, a chunk plus its overlap is copied once more when joined
+        self.memory_budget = memory_budget
+        self.chunk_size = max(1024*1024, memory_budget // 4)
+        # zip entries larger than this (uncompressed) are not scanned
+        self.max_entry_size = max_entry_size
+        # EntryVerdictCache shared by detection processes, None to disable
+        self.entry_cache = entry_cache
+        self.sign_matcher = SignMatcher(
+            [item.sign_str for item in self.apk_signs],
+            encoding=self.encoding,
+        )
+        # strings in binary xml and resources.arsc are mostly utf-16
+        self.utf16_sign_matcher = SignMatcher(
+            [item.sign_str for item in self.apk_signs],
+            encoding='utf-16-le',
+        )
+        self.verdict_mode = verdict_mode
+        self.high_sign_strs = set([
+            item.sign_str for item in self.apk_signs if item.confidence == 'high'
+        ])
+        # providers of each sign str, a provider is identified by any of them
+        self.sign_providers = {}
+        for item in self.apk_signs:
+            self.sign_providers.setdefault(item.sign_str, set()).add(item.provider)
+        # signs that can only be found in decoded smali
+        self.smali_sign_strs = set([
+            item.sign_str for item in self.apk_signs if item.type == 'smali'
+        ])
+        # a sign str shared by signs of different types can be anywhere
+        self.sign_types = {}
+        for item in self.apk_signs:
+            if self.sign_types.get(item.sign_str, item.type) != item.type:
+                self.sign_types[item.sign_str] = 'str'
+            else:
+                self.sign_types[item.sign_str] = item.type
 
     # unpack the given apk file to the result directory
-    def unpack_apk(self, src_file, result_dir) -> bool:
+    def unpack_apk(self, src_file, result_dir, decode_options=None) -> bool:
         try:
             if not (os.path.exists(src_file)):
                 logging.warning("No such file %s",src_file)
+            apktool_args = [
+                'd',
+                '-f',
+                '--only-main-classes', # only detect main classes
+            ] + (decode_options if decode_options else []) + [
+                '-o',
+                result_dir,
+                src_file,
+            ]
+            if self.apktool_worker is not None:
+                return self.apktool_worker.run(apktool_args)
             subprocess.run(
-                args=[
-                    self.apk_tool,
-                    'd',
-                    '-f',
-                    '--only-main-classes', # only detect main classes
-                    '-o',
-                    result_dir,
-                    src_file,
-                ],
+                args=[self.apk_tool] + apktool_args,
                 env={'PATH':'/usr/bin'},
                 check=True,
                 stdout=subprocess.DEVNULL,
@@ -108,6 +342,19 @@ class ApkDetector(object):
             )
             return False
 
+    # cheapest apktool decoding that still covers the given signs:
+    # res signs only need resources, smali signs only need sources
+    def decode_options(self, signs_to_match) -> typing.List[str]:
+        sign_types = set([
+            self.sign_types[sign_str] for sign_str in signs_to_match
+        ])
+        decode_options = []
+        if len(sign_types - {'smali'}) == 0:
+            decode_options.append('-r') # no resources
+        elif len(sign_types - {'res'}) == 0:
+            decode_options.append('-s') # no sources
+        return decode_options
+
     # list all files recursively in the given directory
     def exhaust_files(self, src_dir):
         src_dir = src_dir.rstrip('/') + '/'
@@ -120,28 +367,286 @@ class ApkDetector(object):
             result_dirs_files.append(sub_path[base_dir_len:])
         return result_dirs_files
 
-    def detect(self, apk_file):
-        media_re = re.compile('.*\.(png|jpeg|gif|jpg|mp3|mp4|dll|yml)$', re.I)
-        dir_re = re.compile('.*(original|assets)/.*$', re.I)
-        media_re = re.compile('.*\.(png|jpeg|gif|jpg|mp3|mp4)$', re.I)
-        dir_re = None
+    # read only the zip central directory, match entry names as path signs
+    # and keep entries worth a content scan, and those worth their features
+    def prefilter_zip(self, apk_file, collector=None) -> typing.Optional[tuple]:
+        matched_signs = set()
+        scan_entries = []
+        feature_entries = []
+        too_big_skip = 0
+        try:
+            with zipfile.ZipFile(apk_file) as apk_zip:
+                entries = apk_zip.infolist()
+        except (zipfile.BadZipFile, OSError) as e:
+            logging.info('no zip central directory in %s: %s', apk_file, e)
+            return None
+        for entry in entries:
+            if collector is not None and not entry.is_dir():
+                collector.add_name(entry)
+                if collector.wants(entry):
+                    feature_entries.append(entry)
+            if entry.is_dir() or self.scan_rules.is_path_excluded(entry.filename):
+                continue
+            # conduct path matching
+            matched_signs |= self.sign_matcher.match(
+                entry.filename.encode(
+                    encoding=self.encoding,
+                    errors='backslashreplace',
+                ),
+            )
+            # exclude images and too big files
+            if self.scan_rules.is_content_excluded(entry.filename, entry.file_size):
+                continue
+            if self.max_entry_size is not None and entry.file_size > self.max_entry_size:
+                too_big_skip += 1
+                continue
+            scan_entries.append(entry)
+        scan_entries = self.scan_rules.order(
+            scan_entries,
+            key=lambda entry: entry.filename,
+        )
+        logging.debug(
+            '%d of %d zip entries to scan, %d too big',
+            len(scan_entries),
+            len(entries),
+            too_big_skip,
+        )
+        return matched_signs, scan_entries, feature_entries
+
+    # match decompressed entry contents without unpacking, the features of
+    # the entries are collected on the same read
+    def detect_zip(
+        self,
+        apk_file,
+        scan_entries,
+        signs_to_match,
+        collector=None,
+        feature_entries=(),
+    ) -> typing.Optional[set]:
+        matched_signs = set()
+        scan_ids = set([id(entry) for entry in scan_entries])
+        feature_ids = set([id(entry) for entry in feature_entries])
+        entries = list(scan_entries)
+        if collector is not None:
+            # entries only read for their features come last
+            entries += [entry for entry in feature_entries if id(entry) not in scan_ids]
+        is_done = len(signs_to_match) == 0
+        try:
+            with zipfile.ZipFile(apk_file) as apk_zip:
+                for entry in entries:
+                    entry_collector = collector if id(entry) in feature_ids else None
+                    if is_done or id(entry) not in scan_ids:
+                        if collector is None:
+                            break
+                        if entry_collector is not None:
+                            collector.add_content(apk_zip, entry)
+                        continue
+                    stop_signs = signs_to_match - matched_signs
+                    kind = self.entry_kind(entry)
+                    entry_matched_signs = None
+                    if self.entry_cache is not None:
+                        entry_matched_signs = self.entry_cache.get(
+                            entry.CRC,
+                            entry.file_size,
+                            kind,
+                        )
+                        if entry_matched_signs is not None and entry_collector is not None:
+                            collector.add_content(apk_zip, entry)
+                    if entry_matched_signs is None:
+                        entry_matched_signs = self.scan_entry(
+                            apk_zip,
+                            entry,
+                            kind,
+                            stop_signs,
+                            entry_collector,
+                            self.verdict_stop(signs_to_match, matched_signs),
+                        )
+                        # a scan stopped once the verdict was over is not a
+                        # full verdict of the entry
+                        if self.entry_cache is not None and len(self.signs_left(
+                            signs_to_match,
+                            matched_signs | entry_matched_signs,
+                        )) != 0:
+                            self.entry_cache.put(
+                                entry.CRC,
+                                entry.file_size,
+                                kind,
+                                entry_matched_signs,
+                            )
+                    matched_signs |= entry_matched_signs
+                    is_done = len(self.signs_left(signs_to_match, matched_signs)) == 0
+        except (zipfile.BadZipFile, NotImplementedError, RuntimeError) as e:
+            logging.info(
+                'fall back to apktool for %s: %s',
+                apk_file,
+                e,
+            )
+            return None
+        return matched_signs
+
+    def entry_kind(self, entry) -> str:
+        # dex parsing needs the whole dex in memory
+        if (
+            dex_parser.DEX_ENTRY_RE.match(entry.filename)
+            and entry.file_size <= self.memory_budget // 2
+        ):
+            return 'dex'
+        if entry.filename.endswith(('.xml', '.arsc')):
+            return 'xml'
+        return 'raw'
+
+    def scan_entry(
+        self,
+        apk_zip,
+        entry,
+        kind,
+        stop_signs,
+        collector=None,
+        should_stop: StopCheck=None,
+    ) -> set:
+        if kind == 'dex':
+            dex_matched_signs = self.detect_dex(
+                apk_zip.read(entry),
+                stop_signs,
+                collector,
+                should_stop,
+            )
+            if dex_matched_signs is not None:
+                return dex_matched_signs
+        with apk_zip.open(entry) as entry_fd:
+            reader = entry_fd
+            if collector is not None:
+                reader = collector.reader(entry_fd, entry.filename)
+            matched_signs = self.sign_matcher.match_stream(
+                reader,
+                stop_signs,
+                chunk_size=self.chunk_size,
+                should_stop=should_stop,
+            )
+            if collector is not None:
+                reader.drain()
+        if (
+            kind == 'xml'
+            and not stop_signs <= matched_signs
+            and not (should_stop is not None and should_stop(matched_signs))
+        ):
+            utf16_should_stop = None
+            if should_stop is not None:
+                utf16_should_stop = lambda found: should_stop(matched_signs | found)
+            with apk_zip.open(entry) as entry_fd:
+                matched_signs |= self.utf16_sign_matcher.match_stream(
+                    entry_fd,
+                    stop_signs - matched_signs,
+                    chunk_size=self.chunk_size,
+                    should_stop=utf16_should_stop,
+                )
+        return matched_signs
+
+    # signs still worth matching under the verdict mode
+    def signs_left(self, signs_to_match, matched_signs) -> set:
+        if self.verdict_mode == VerdictMode.FIRST_HIGH and len(matched_signs & self.high_sign_strs) > 0:
+            return set()
+        if self.verdict_mode == VerdictMode.PROVIDER and len(matched_signs) > 0:
+            found_providers = set()
+            for sign_str in matched_signs:
+                found_providers |= self.sign_providers.get(sign_str, set())
+            # a sign shared with a provider not found yet is still worth it
+            return set([
+                sign_str
+                for sign_str in signs_to_match - matched_signs
+                if not self.sign_providers.get(sign_str, set()) <= found_providers
+            ])
+        return signs_to_match - matched_signs
+
+    # let SignMatcher stop at the first hit that ends the verdict, given the
+    # signs matched before the scan
+    def verdict_stop(self, signs_to_match, matched_signs) -> StopCheck:
+        return lambda found: len(
+            self.signs_left(signs_to_match, matched_signs | found)
+        ) == 0
+
+    # match the string pool and class names of a dex file
+    def detect_dex(
+        self,
+        dex_data,
+        signs_to_match,
+        collector=None,
+        should_stop: StopCheck=None,
+    ) -> typing.Optional[set]:
+        dex_index = dex_parser.DexStringIndex()
+        try:
+            dex_index.add_dex(dex_data)
+        except (dex_parser.DexFormatError, struct.error, IndexError) as e:
+            logging.debug('fall back to raw dex matching: %s', e)
+            return None
+        if collector is not None:
+            collector.add_dex(dex_index)
+        return dex_index.match(self.sign_matcher, signs_to_match, should_stop)
+
+    def detect(
+        self,
+        apk_file,
+        raw_signs=None, # signs matched on the raw bytes while downloading
+        features=None, # set to add the apk features to, see FeatureCollector
+    ):
         signs_to_match = set([item.sign_str for item in self.apk_signs])
         matched_signs = set()
         detect_start_time = time.time()
-        apk_binary = open(apk_file, 'rb').read()
-        # match the whole binary content
-        for apk_sign in signs_to_match:
-            apk_sign_binary = apk_sign.encode(
-                encoding=self.encoding,
-                errors='backslashreplace',
+        collector = None
+        if features is not None:
+            collector = FeatureCollector(
+                max_entry_size=self.max_entry_size,
+                memory_budget=self.memory_budget,
+            )
+        # resolve path signs from the zip central directory first
+        scan_entries = None
+        feature_entries = []
+        prefilter_result = self.prefilter_zip(apk_file, collector)
+        if prefilter_result is not None:
+            prefilter_matched_signs, scan_entries, feature_entries = prefilter_result
+            matched_signs |= prefilter_matched_signs
+            signs_to_match = self.signs_left(signs_to_match, matched_signs)
+        # match the whole binary content in a single pass, unless it was
+        # already matched while downloading
+        if len(signs_to_match) != 0 and raw_signs is not None:
+            matched_signs |= set(raw_signs)
+        elif len(signs_to_match) != 0:
+            with open(apk_file, 'rb') as apk_fd:
+                matched_signs |= self.sign_matcher.match_stream(
+                    apk_fd,
+                    signs_to_match,
+                    chunk_size=self.chunk_size,
+                    should_stop=self.verdict_stop(signs_to_match, matched_signs),
+                )
+        signs_to_match = self.signs_left(signs_to_match, matched_signs)
+        zip_signs = set()
+        if self.scan_mode in (ScanMode.ZIP, ScanMode.DEX):
+            zip_signs = signs_to_match
+        # the zip entries are also read when only their features are wanted
+        if scan_entries is not None and (len(zip_signs) != 0 or collector is not None):
+            zip_matched_signs = self.detect_zip(
+                apk_file,
+                scan_entries,
+                zip_signs,
+                collector,
+                feature_entries,
             )
-            if apk_sign_binary in apk_binary:
-                matched_signs.add(apk_sign)
-        signs_to_match -= matched_signs
+            if zip_matched_signs is None and collector is not None:
+                # partial features would hide strings from re-detection
+                collector.features.clear()
+            if zip_matched_signs is not None and len(zip_signs) != 0:
+                matched_signs |= zip_matched_signs
+                signs_to_match = self.signs_left(signs_to_match, matched_signs)
+                # only signs in decoded smali are left for apktool
+                signs_to_match &= self.smali_sign_strs
+                if self.scan_mode == ScanMode.DEX:
+                    signs_to_match = set()
+        if collector is not None:
+            features |= collector.features
         if len(signs_to_match) != 0:
             #  unpack the apk file
             apk_hash = hashlib.md5()
-            apk_hash.update(apk_binary)
+            apk_hash.update(os.path.abspath(apk_file).encode('utf-8'))
             unpack_dir = os.path.join(
                 self.detect_dir,
                 apk_hash.hexdigest(),
@@ -149,33 +654,44 @@ class ApkDetector(object):
             if not os.path.exists(unpack_dir):
                 os.makedirs(unpack_dir)
             unpack_start_time = time.time()
-            unpack_result = self.unpack_apk(apk_file, unpack_dir)
+            decode_options = self.decode_options(signs_to_match)
+            unpack_result = self.unpack_apk(apk_file, unpack_dir, decode_options)
             if unpack_result == False:
                 logging.info('skip this apk because of unpack error')
                 shutil.rmtree(unpack_dir)
                 return None
             unpack_end_time = time.time()
+            logging.info(
+                'apktool decode of %s with options [%s] for %d signs took %f seconds',
+                os.path.basename(apk_file),
+                ' '.join(decode_options),
+                len(signs_to_match),
+                unpack_end_time - unpack_start_time,
+            )
             # exhaust all files in the unpacked dir
             sub_paths = self.exhaust_files(unpack_dir)
             new_sub_paths = [
                 sub_path
                 for sub_path in sub_paths
-                if dir_re is None or (not dir_re.match(sub_path))
+                if not self.scan_rules.is_path_excluded(sub_path)
             ]
-            sub_paths = new_sub_paths
+            sub_paths = self.scan_rules.order(new_sub_paths)
             #logging.info('got %d unpacked files', len(sub_paths))
             # match unpacked files
             media_skip = 0
             for sub_path in sub_paths:
-                signs_to_match -= matched_signs
+                signs_to_match = self.signs_left(signs_to_match, matched_signs)
                 if len(signs_to_match) == 0:
                     break
 
                 # conduct path matching
-                for sign in signs_to_match:
-                    if sign in sub_path:
-                        matched_signs.add(sign)
-                signs_to_match -= matched_signs
+                matched_signs |= self.sign_matcher.match(
+                    sub_path.encode(
+                        encoding=self.encoding,
+                        errors='backslashreplace',
+                    ),
+                )
+                signs_to_match = self.signs_left(signs_to_match, matched_signs)
                 if len(signs_to_match) == 0:
                     break
 
@@ -186,19 +702,18 @@ class ApkDetector(object):
                 )
                 if not os.path.isfile(sub_file):
                     continue
-                # exclude images
-                if media_re.match(sub_file):
+                # exclude images and too big files
+                if self.scan_rules.is_content_excluded(sub_path, os.path.getsize(sub_file)):
                     media_skip += 1
                     continue
-                file_content_binary = open(sub_file, 'rb').read()
-                file_content = file_content_binary.decode(
-                    encoding=self.encoding,
-                    errors='backslashreplace',
-                )
-                for sign in signs_to_match:
-                    if sign in file_content:
-                        matched_signs.add(sign)
-                signs_to_match -= matched_signs
+                with open(sub_file, 'rb') as sub_fd:
+                    matched_signs |= self.sign_matcher.match_stream(
+                        sub_fd,
+                        signs_to_match,
+                        chunk_size=self.chunk_size,
+                        should_stop=self.verdict_stop(signs_to_match, matched_signs),
+                    )
+                signs_to_match = self.signs_left(signs_to_match, matched_signs)
                 if len(signs_to_match) == 0:
                     break
             shutil.rmtree(unpack_dir)
@@ -208,7 +723,9 @@ class ApkDetector(object):
                 time.time() - unpack_end_time,
                 time.time() - detect_start_time,
             )
+        return self.matched_sign_objs(matched_signs)
 
+    def matched_sign_objs(self, matched_signs):
         matched_sign_objs = []
         for sign_obj in self.apk_signs:
             if sign_obj.sign_str in matched_signs:
@@ -226,21 +743,66 @@ class ApkDetectionConfig(object):
         timeout=80000,
         encoding=None,
         is_delete=True,
+        scan_mode=ScanMode.APKTOOL,
+        max_entry_size=None,
+        entry_cache_file=None,
+        entry_cache_size=1000000,
+        feature_store_file=None,
+        verdict_mode=VerdictMode.EXHAUSTIVE,
+        apktool_jar=None,
+        scan_rules=None,
+        memory_budget=256*1024*1024,
+        result_store_file=None,
+        apk_manifest=None,
+        task_queue_size=0,
+        drop_queue=None,
     ):
-        self.task_queue = mp.Queue()
+        # bounded task queue for backpressure, unbounded if 0
+        self.task_queue = mp.Queue(task_queue_size)
+        self.task_queue_size = task_queue_size
         self.result_queue = mp.Queue()
+        # ids of apks given up on, see drop_result_phase, None to disable
+        self.drop_queue = drop_queue
         self.is_stop = False
         self.work_dir = work_dir
         self.apk_tool = apk_tool
         self.encoding = encoding if encoding else 'utf-8'
         self.apk_signs = apk_signs
+        # json lines of earlier runs, imported into and exported from the store
         self.result_file = result_file
+        # sqlite ResultStore the results are written to
+        if result_store_file is None:
+            result_store_file = os.path.join(
+                os.path.dirname(result_file),
+                'detection_results.db',
+            )
+        self.result_store_file = result_store_file
+        # wall clock time at which every stage gives up
+        self.deadline = time.time() + timeout
+        # ApkManifest of apk_base_dir to update on deletes, None to disable
+        self.apk_manifest = apk_manifest
         self.timeout = timeout
         # whether to delete the apks if no hit
         self.is_delete = is_delete
         self.detect_tag = detect_tag
+        self.scan_mode = scan_mode
+        self.max_entry_size = max_entry_size
+        self.entry_cache_file = entry_cache_file
+        self.entry_cache_size = entry_cache_size
+        # keep per-apk features for re-detection with new signs
+        self.feature_store_file = feature_store_file
+        self.verdict_mode = verdict_mode
+        # run apktool.jar in a warm worker jvm if given
+        self.apktool_jar = apktool_jar
+        self.scan_rules = scan_rules
+        # per detection process
+        self.memory_budget = memory_budget
         self.detect_count = 0
 
+class DownloadEngine(object):
+    THREAD = 'thread' # thread_num threads per process, one connection per apk
+    ASYNC = 'async' # asyncio with one pooled keep-alive session per process
+
 class ApkDownloadConfig(object):
     def __init__(
         self,
@@ -248,135 +810,534 @@ class ApkDownloadConfig(object):
         thread_num=10,
         timeout=80000,
         is_overwrite=False,
+        stream_detect_cfg=None,
+        engine=DownloadEngine.THREAD,
+        concurrency=None,
+        rate_controller=None,
+        apk_manifest=None,
+        task_queue_size=0,
+        result_queue_size=0,
+        apk_cache=None,
+        drop_queue=None,
+        spool_dir=None,
     ):
         self.api_key = api_key
-        self.task_queue = mp.Queue()
-        self.result_queue = mp.Queue()
+        # bounded queues for backpressure, unbounded if 0
+        self.task_queue = mp.Queue(task_queue_size)
+        self.task_queue_size = task_queue_size
+        self.result_queue = mp.Queue(result_queue_size)
+        # ids of apks given up on, see drop_result_phase, None to disable
+        self.drop_queue = drop_queue
         self.timeout = timeout
+        # wall clock time at which every stage gives up
+        self.deadline = time.time() + timeout
         self.is_overwrite = is_overwrite
         self.thread_num = thread_num
+        # ApkDetectionConfig to match raw bytes while downloading, None to disable
+        self.stream_detect_cfg = stream_detect_cfg
+        # local dir to download into while matching, kept apks are moved to
+        # apk_base_dir, next to the apk if None
+        self.spool_dir = spool_dir
+        self.engine = engine
+        # downloads in flight per process with the async engine
+        self.concurrency = concurrency if concurrency else thread_num
+        # AimdController shared by download processes, None for fixed concurrency
+        self.rate_controller = rate_controller
+        # ApkManifest of apk_base_dir to update on downloads, None to disable
+        self.apk_manifest = apk_manifest
+        # LocalApkCache or HttpApkCache tried before AndroZoo, None to disable
+        self.apk_cache = apk_cache
         self.download_count = 0
 
+    def consumer_count(self, process_count) -> int:
+        """ task queue readers, each stops on one None
+        """
+        if self.engine == DownloadEngine.ASYNC:
+            return process_count
+        return process_count * self.thread_num
+
+# report an apk given up on, so that its shard can be marked done
+def drop_task(cfg, task: Apk):
+    if cfg.drop_queue is not None:
+        cfg.drop_queue.put(task.id)
+
+# a None item on a task or result queue means its producer is done
+def get_until(
+    task_queue,
+    deadline,
+    get_timeout=60,
+    stop_event=None, # a worker pool asks the process to stop
+):
+    """ blocking get, raise queue.Empty once the deadline has passed or the
+        stop_event is set
+    """
+    if stop_event is not None:
+        get_timeout = min(get_timeout, 5)
+    while True:
+        time_left = deadline - time.time()
+        if time_left <= 0:
+            raise queue.Empty
+        if stop_event is not None and stop_event.is_set():
+            raise queue.Empty
+        try:
+            return task_queue.get(timeout=min(get_timeout, time_left))
+        except queue.Empty:
+            continue
+
 def apk_detection(
     ad_cfg, # ApkDetectionConfig
-    interval=5,
+    stop_event=None,
 ):
     logging.info(
         'Detection process %s started',
         mp.current_process().name,
     )
+    entry_cache = None
+    if ad_cfg.entry_cache_file is not None:
+        entry_cache = EntryVerdictCache(
+            ad_cfg.entry_cache_file,
+            [item.sign_str for item in ad_cfg.apk_signs],
+            max_entries=ad_cfg.entry_cache_size,
+        )
+    apktool_worker = None
+    if ad_cfg.apktool_jar is not None:
+        apktool_worker = ApktoolWorker(ad_cfg.apktool_jar)
     apk_detector = ApkDetector(
         apk_tool=ad_cfg.apk_tool,
         detect_dir=ad_cfg.work_dir,
         apk_signs=ad_cfg.apk_signs,
         encoding=ad_cfg.encoding,
+        scan_mode=ad_cfg.scan_mode,
+        max_entry_size=ad_cfg.max_entry_size,
+        entry_cache=entry_cache,
+        verdict_mode=ad_cfg.verdict_mode,
+        apktool_worker=apktool_worker,
+        scan_rules=ad_cfg.scan_rules,
+        memory_budget=ad_cfg.memory_budget,
     )
-    start_time = time.time()
     while True:
-        if time.time() - start_time >= ad_cfg.timeout:
-            break
-        is_empty = ad_cfg.task_queue.empty()
-        if is_empty:
-            time.sleep(interval)
-            continue
-        apk_file = None
         try:
-            task_str = ad_cfg.task_queue.get_nowait()
-            task = json.loads(task_str)
-            apk_file = task['apk_file']
-            d_result = apk_detector.detect(apk_file)
-            if d_result is None and os.path.exists(apk_file):
-                os.remove(apk_file)
-                continue
-            d_results = {
-                'id': task['id'],
-                'detection': list(d_result),
-                'detect_tag': ad_cfg.detect_tag,
-                'detection_time': time.time(),
-                'apk_meta': task,
-                'is_hit': len(d_result) > 0,
-            }
-            ad_cfg.result_queue.put(json.dumps(d_results))
-        except Exception as e:
-            logging.warning(
-                'error when detecting apk: %s',
-                e,
-            )
-            if apk_file and os.path.exists(apk_file):
-                os.remove(apk_file)
-            time.sleep(interval)
+            task_batch = get_until(ad_cfg.task_queue, ad_cfg.deadline, stop_event=stop_event)
+        except queue.Empty:
+            break
+        if task_batch is None:
+            if stop_event is not None and stop_event.is_set():
+                # retiring, leave the None to a process that still runs
+                put_until(ad_cfg.task_queue, None, ad_cfg.deadline)
+            break
+        for task in Apk.unpack_batch(task_batch):
+            apk_file = task.apk_file
+            try:
+                apk_features = None
+                if ad_cfg.feature_store_file is not None:
+                    apk_features = set()
+                d_result = apk_detector.detect(
+                    apk_file,
+                    raw_signs=task.raw_signs,
+                    features=apk_features,
+                )
+                if d_result is None:
+                    if os.path.exists(apk_file):
+                        os.remove(apk_file)
+                        if ad_cfg.apk_manifest is not None:
+                            ad_cfg.apk_manifest.remove(apk_file)
+                    drop_task(ad_cfg, task)
+                    continue
+                d_results = {
+                    'id': task.id,
+                    'detection': list(d_result),
+                    'detect_tag': ad_cfg.detect_tag,
+                    'verdict_mode': ad_cfg.verdict_mode,
+                    'detection_time': time.time(),
+                    'apk_meta': task.to_dict(),
+                    'is_hit': len(d_result) > 0,
+                }
+                # written by detect_result_phase along with the result
+                feature_blob = None
+                if apk_features:
+                    feature_blob = pack_features(apk_features)
+                ad_cfg.result_queue.put((json.dumps(d_results), feature_blob))
+            except Exception as e:
+                logging.warning(
+                    'error when detecting apk: %s',
+                    e,
+                )
+                if apk_file and os.path.exists(apk_file):
+                    os.remove(apk_file)
+                    if ad_cfg.apk_manifest is not None:
+                        ad_cfg.apk_manifest.remove(apk_file)
+                drop_task(ad_cfg, task)
+    if apktool_worker is not None:
+        apktool_worker.stop()
+    if entry_cache is not None:
+        entry_cache.flush_touched()
     logging.info('quit apk detection proces')
 
 # apk downloading process
 def apk_download(
     apk_download_cfg: ApkDownloadConfig,
-    interval: int=5,
+    stop_event=None,
 ):
     logging.info(
         'Download process %s started',
         mp.current_process().name,
     )
-    start_time = time.time()
-    download_workers = []
-    for i in range(apk_download_cfg.thread_num):
-        worker = threading.Thread(
-            target=apk_download_thread,
-            args=(
-                apk_download_cfg,
-            ),
-        )
-        download_workers.append(worker)
-        worker.start()
-    while True:
-        time_cost = time.time() - start_time
-        if time_cost >= apk_download_cfg.timeout:
-            break
-        time.sleep(interval)
-    time.sleep(interval)
+    if apk_download_cfg.engine == DownloadEngine.ASYNC:
+        asyncio.run(apk_download_async(apk_download_cfg, stop_event))
+    else:
+        download_workers = []
+        for i in range(apk_download_cfg.thread_num):
+            worker = threading.Thread(
+                target=apk_download_thread,
+                args=(
+                    apk_download_cfg,
+                    stop_event,
+                ),
+            )
+            download_workers.append(worker)
+            worker.start()
+        for worker in download_workers:
+            worker.join()
     logging.info('quit apk download process')
 
 
-def apk_download_thread(
+async def apk_download_async(
     apk_download_cfg: ApkDownloadConfig,
-    interval: int=5,
+    stop_event=None,
 ):
+    import async_downloader as adu
     cfg = apk_download_cfg
-    start_time = time.time()
-    while True:
-        if time.time() - start_time >= cfg.timeout:
-            break
-        is_empty = cfg.task_queue.empty()
-        if is_empty:
-            time.sleep(interval)
-            continue
-        apk_file = None
+    stream_detector = None
+    if cfg.stream_detect_cfg is not None:
+        stream_detector = ApkDetector(
+            apk_tool=cfg.stream_detect_cfg.apk_tool,
+            detect_dir=cfg.stream_detect_cfg.work_dir,
+            apk_signs=cfg.stream_detect_cfg.apk_signs,
+            encoding=cfg.stream_detect_cfg.encoding,
+            verdict_mode=cfg.stream_detect_cfg.verdict_mode,
+        )
+
+    loop = asyncio.get_running_loop()
+    # file writes, hashing, sign matching and queue puts stay off the event
+    # loop; waits for a download window get threads of their own, so that
+    # they never hold up the work that releases them
+    io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=cfg.concurrency)
+    acquire_executor = None
+    if cfg.rate_controller is not None:
+        acquire_executor = concurrent.futures.ThreadPoolExecutor(max_workers=cfg.concurrency)
+
+    async def put_result(task: Apk):
+        # a full result queue blocks an executor thread, not the event loop
+        await loop.run_in_executor(
+            io_executor,
+            put_until,
+            cfg.result_queue,
+            Apk.pack_batch([task]),
+            cfg.deadline,
+        )
+
+    async def download_task(task: Apk):
+        apk_file = task.apk_file
+        if os.path.exists(apk_file) and not cfg.is_overwrite:
+            await put_result(task)
+            return
+        download_file = apk_file
+        sign_stream = None
+        if stream_detector is not None:
+            download_file = spool_file_of(cfg, task)
+            sign_stream = SignStream(stream_detector.sign_matcher)
+            # no more matching once the raw bytes decide the verdict
+            stream_should_stop = stream_detector.verdict_stop(
+                set([item.sign_str for item in stream_detector.apk_signs]),
+                set(),
+            )
+
+        def on_chunk(data):
+            if sign_stream is not None:
+                sign_stream.feed(data, should_stop=stream_should_stop)
+            if cfg.rate_controller is not None:
+                cfg.rate_controller.on_chunk(data)
+
+        if cfg.rate_controller is not None and not await loop.run_in_executor(
+            acquire_executor,
+            cfg.rate_controller.acquire_until,
+            cfg.deadline,
+        ):
+            return
+        download_start_time = time.time()
+        download_error = None
         try:
-            task_str = cfg.task_queue.get_nowait()
-            task = json.loads(task_str)
-            apk_id = task['id']
-            apk_file = task['apk_file']
-            apk_dir = os.path.dirname(apk_file)
-            if os.path.exists(apk_file):
-                if not cfg.is_overwrite:
-                    cfg.result_queue.put(task_str)
-                    continue
+            apk_dir = os.path.dirname(download_file)
             if not os.path.exists(apk_dir):
-                os.makedirs(apk_dir)
-            download_result = du.download_apk(
-                apk_id,
-                apk_file,
-                cfg.api_key,
-            )
+                os.makedirs(apk_dir, exist_ok=True)
+            try:
+                download_result = await adu.download_apk(
+                    session,
+                    task.id,
+                    download_file,
+                    cfg.api_key,
+                    chunk_callback=on_chunk,
+                    apk_cache=cfg.apk_cache,
+                    executor=io_executor,
+                )
+            except Exception as e:
+                download_error = e
+                raise
+            finally:
+                if cfg.rate_controller is not None:
+                    cfg.rate_controller.release(
+                        latency=time.time() - download_start_time,
+                        error=download_error,
+                    )
+            if not download_result:
+                drop_task(cfg, task)
+            elif sign_stream is not None:
+                # False once the result was sent from the raw bytes
+                download_result = await loop.run_in_executor(
+                    io_executor,
+                    finish_stream_download,
+                    cfg,
+                    stream_detector,
+                    task,
+                    download_file,
+                    sign_stream,
+                )
             if download_result:
-                cfg.result_queue.put(task_str)
+                if cfg.apk_manifest is not None:
+                    cfg.apk_manifest.add(apk_file)
+                await put_result(task)
+            elif os.path.exists(download_file) and download_file != apk_file:
+                os.remove(download_file)
         except Exception as e:
             logging.warning(
                 'errror during downloading %s',
                 e,
             )
-            time.sleep(interval)
-            if apk_file and os.path.exists(apk_file):
-                os.remove(apk_file)
+            if os.path.exists(download_file):
+                os.remove(download_file)
+                if download_file == apk_file and cfg.apk_manifest is not None:
+                    cfg.apk_manifest.remove(apk_file)
+            # the task is not retried
+            du.remove_part_file(download_file)
+            drop_task(cfg, task)
+
+    try:
+        async with adu.new_session(cfg.concurrency) as session:
+            await adu.consume(
+                cfg.task_queue,
+                download_task,
+                cfg.concurrency,
+                cfg.deadline - time.time(),
+                unpack=Apk.unpack_batch,
+                stop_event=stop_event,
+            )
+    finally:
+        io_executor.shutdown(wait=True)
+        if acquire_executor is not None:
+            acquire_executor.shutdown(wait=False)
+
+def spool_file_of(
+    apk_download_cfg: ApkDownloadConfig,
+    task: Apk,
+) -> str:
+    """ in the spool dir, so that apks which are not kept never reach
+        apk_base_dir, e.g., a network share
+    """
+    spool_dir = apk_download_cfg.spool_dir
+    if spool_dir is None:
+        spool_dir = os.path.dirname(task.apk_file)
+    if not os.path.exists(spool_dir):
+        os.makedirs(spool_dir, exist_ok=True)
+    return os.path.join(spool_dir, task.id + '.spool')
+
+def keep_spool_file(spool_file, apk_file):
+    """ move a spooled apk to its place, only ever complete there, even
+        across file systems
+    """
+    apk_dir = os.path.dirname(apk_file)
+    if not os.path.exists(apk_dir):
+        os.makedirs(apk_dir, exist_ok=True)
+    try:
+        os.replace(spool_file, apk_file)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file = apk_file + '.spool'
+        shutil.copyfile(spool_file, copy_file)
+        os.replace(copy_file, apk_file)
+        os.remove(spool_file)
+
+# decide on the raw bytes matched while downloading into the spool file,
+# return whether the apk still needs detection
+def finish_stream_download(
+    apk_download_cfg: ApkDownloadConfig,
+    apk_detector: ApkDetector,
+    task: Apk,
+    spool_file: str,
+    sign_stream: SignStream,
+) -> bool:
+    ad_cfg = apk_download_cfg.stream_detect_cfg
+    apk_file = task.apk_file
+    all_signs = set([item.sign_str for item in apk_detector.apk_signs])
+    matched_signs = sign_stream.matched_signs
+    if len(apk_detector.signs_left(all_signs, matched_signs)) == 0:
+        # classified from raw bytes alone, the apk is not kept
+        d_results = {
+            'id': task.id,
+            'detection': apk_detector.matched_sign_objs(matched_signs),
+            'detect_tag': ad_cfg.detect_tag,
+            'verdict_mode': ad_cfg.verdict_mode,
+            'detection_time': time.time(),
+            'apk_meta': task.to_dict(),
+            'is_hit': len(matched_signs) > 0,
+        }
+        ad_cfg.result_queue.put((json.dumps(d_results), None))
+        os.remove(spool_file)
+        return False
+    # detection goes on from the signs matched so far, without another raw pass
+    task.raw_signs = sorted(matched_signs)
+    keep_spool_file(spool_file, apk_file)
+    return True
+
+# download into the spool file of the apk while matching the raw bytes,
+# return whether the apk still needs detection
+def stream_download_apk(
+    apk_download_cfg: ApkDownloadConfig,
+    apk_detector: ApkDetector,
+    task: Apk,
+    chunk_callback=None,
+) -> bool:
+    spool_file = spool_file_of(apk_download_cfg, task)
+    sign_stream = SignStream(apk_detector.sign_matcher)
+    # no more matching once the raw bytes decide the verdict
+    should_stop = apk_detector.verdict_stop(
+        set([item.sign_str for item in apk_detector.apk_signs]),
+        set(),
+    )
+
+    def on_chunk(data):
+        sign_stream.feed(data, should_stop=should_stop)
+        if chunk_callback is not None:
+            chunk_callback(data)
+
+    try:
+        download_result = du.download_apk(
+            task.id,
+            spool_file,
+            apk_download_cfg.api_key,
+            chunk_callback=on_chunk,
+            apk_cache=apk_download_cfg.apk_cache,
+        )
+        if not download_result:
+            drop_task(apk_download_cfg, task)
+            return False
+        return finish_stream_download(
+            apk_download_cfg,
+            apk_detector,
+            task,
+            spool_file,
+            sign_stream,
+        )
+    finally:
+        if os.path.exists(spool_file):
+            os.remove(spool_file)
+
+def download_apk_task(
+    apk_download_cfg: ApkDownloadConfig,
+    stream_detector: typing.Optional[ApkDetector],
+    task: Apk,
+    interval: int=5,
+):
+    cfg = apk_download_cfg
+    apk_file = task.apk_file
+    try:
+        apk_dir = os.path.dirname(apk_file)
+        if os.path.exists(apk_file):
+            if not cfg.is_overwrite:
+                put_until(cfg.result_queue, Apk.pack_batch([task]), cfg.deadline)
+                return
+        chunk_callback = None
+        if cfg.rate_controller is not None:
+            if not cfg.rate_controller.acquire_until(cfg.deadline):
+                return
+            chunk_callback = cfg.rate_controller.on_chunk
+        download_start_time = time.time()
+        download_error = None
+        try:
+            if stream_detector is not None:
+                download_result = stream_download_apk(
+                    cfg,
+                    stream_detector,
+                    task,
+                    chunk_callback=chunk_callback,
+                )
+            else:
+                if not os.path.exists(apk_dir):
+                    os.makedirs(apk_dir)
+                download_result = du.download_apk(
+                    task.id,
+                    apk_file,
+                    cfg.api_key,
+                    chunk_callback=chunk_callback,
+                    apk_cache=cfg.apk_cache,
+                )
+        except Exception as e:
+            download_error = e
+            raise
+        finally:
+            if cfg.rate_controller is not None:
+                cfg.rate_controller.release(
+                    latency=time.time() - download_start_time,
+                    error=download_error,
+                )
+        if download_result:
+            if cfg.apk_manifest is not None:
+                cfg.apk_manifest.add(apk_file)
+            put_until(cfg.result_queue, Apk.pack_batch([task]), cfg.deadline)
+        elif stream_detector is None:
+            drop_task(cfg, task)
+    except Exception as e:
+        logging.warning(
+            'errror during downloading %s',
+            e,
+        )
+        time.sleep(interval)
+        if apk_file and os.path.exists(apk_file):
+            os.remove(apk_file)
+            if cfg.apk_manifest is not None:
+                cfg.apk_manifest.remove(apk_file)
+        # the task is not retried
+        du.remove_part_file(apk_file)
+        if stream_detector is not None:
+            du.remove_part_file(spool_file_of(cfg, task))
+        drop_task(cfg, task)
+
+def apk_download_thread(
+    apk_download_cfg: ApkDownloadConfig,
+    stop_event=None,
+):
+    cfg = apk_download_cfg
+    stream_detector = None
+    if cfg.stream_detect_cfg is not None:
+        stream_detector = ApkDetector(
+            apk_tool=cfg.stream_detect_cfg.apk_tool,
+            detect_dir=cfg.stream_detect_cfg.work_dir,
+            apk_signs=cfg.stream_detect_cfg.apk_signs,
+            encoding=cfg.stream_detect_cfg.encoding,
+            verdict_mode=cfg.stream_detect_cfg.verdict_mode,
+        )
+    while True:
+        try:
+            task_batch = get_until(cfg.task_queue, cfg.deadline, stop_event=stop_event)
+        except queue.Empty:
+            break
+        if task_batch is None:
+            if stop_event is not None and stop_event.is_set():
+                # retiring, leave the None to a thread that still runs
+                put_until(cfg.task_queue, None, cfg.deadline)
+            break
+        for task in Apk.unpack_batch(task_batch):
+            download_apk_task(cfg, stream_detector, task)
 
     logging.info('quit download thread')
 
@@ -384,51 +1345,83 @@ def apk_download_thread(
 def download_result_phase(
     apk_download_cfg: ApkDownloadConfig,
     apk_detect_cfg: ApkDetectionConfig,
-    interval :int=5,
+    task_journal: TaskJournal=None,
 ):
-    start_time = time.time()
+    """ move downloaded apks to the detection queue until the None the main
+        process sends once all download processes have exited
+    """
     download_count = 0
     while True:
-        if time.time() - start_time >= apk_download_cfg.timeout:
-            break
-        is_empty = apk_download_cfg.result_queue.empty()
-        if is_empty:
-            time.sleep(interval)
-            continue
         try:
-            task = apk_download_cfg.result_queue.get_nowait()
-            apk_download_cfg.download_count += 1
-            download_count += 1
-            apk_detect_cfg.task_queue.put(task)
-            if download_count % 100 == 0:
-                logging.info(
-                    'download %d apks',
-                    download_count,
-                )
-        except Exception as e:
-            logging.warning(
-                'error when parsing download results: %s',
-                e,
+            task = get_until(apk_download_cfg.result_queue, apk_download_cfg.deadline)
+        except queue.Empty:
+            break
+        if task is None:
+            break
+        apk_download_cfg.download_count += 1
+        download_count += 1
+        apk_ids = None
+        if task_journal is not None:
+            apk_ids = [apk_obj.id for apk_obj in Apk.unpack_batch(task)]
+            task_journal.record(TaskState.DOWNLOADED, apk_ids)
+        if put_until(apk_detect_cfg.task_queue, task, apk_detect_cfg.deadline) and apk_ids is not None:
+            task_journal.record(TaskState.DETECTING, apk_ids)
+        if download_count % 100 == 0:
+            logging.info(
+                'download %d apks',
+                download_count,
             )
-            time.sleep(interval)
-            continue
 
 def detect_result_phase(
     ad_cfg: ApkDetectionConfig,
     interval :int=5,
+    batch_size :int=200,
+    task_journal: TaskJournal=None,
+    shard_progress: ShardProgress=None,
 ):
-    result_fd = open(ad_cfg.result_file, 'a')
+    """ write results until the None the main process sends once all
+        detection processes have exited, pending results are flushed after
+        interval seconds without any; each item is a json result with the
+        packed features of the apk, or None
+    """
+    result_store = ResultStore(ad_cfg.result_store_file)
+    feature_store = None
+    if ad_cfg.feature_store_file is not None:
+        feature_store = FeatureStore(ad_cfg.feature_store_file)
+    # results not yet written to the store
+    result_batch = []
+    # (apk id, packed features) of the results in the batch
+    feature_batch = []
+
+    def flush_results():
+        if feature_store is not None:
+            try:
+                feature_store.put_many(feature_batch)
+            except Exception as e:
+                logging.warning('error when storing apk features: %s', e)
+            feature_batch.clear()
+        result_store.put_many(result_batch)
+        # only once the results are written
+        apk_ids = [json.loads(result_item)['id'] for result_item in result_batch]
+        if task_journal is not None:
+            task_journal.record(TaskState.DONE, apk_ids)
+        if shard_progress is not None:
+            shard_progress.settle(apk_ids)
+        result_batch.clear()
+
     result_count = 0
     start_time = time.time()
     delete_count = 0
-    while True:
+    while time.time() < ad_cfg.deadline:
+        try:
+            result_item = ad_cfg.result_queue.get(timeout=interval)
+        except queue.Empty:
+            flush_results()
+            continue
+        if result_item is None:
+            break
+        result_item, feature_blob = result_item
         try:
-            if time.time() - start_time >= ad_cfg.timeout:
-                break
-            if ad_cfg.result_queue.empty():
-                time.sleep(interval)
-                continue
-            result_item = ad_cfg.result_queue.get_nowait()
             result_count += 1
             ad_cfg.detect_count += 1
             if result_count % 50 == 0:
@@ -443,72 +1436,151 @@ def detect_result_phase(
                     delete_count,
                     ad_cfg.task_queue.qsize(),
                 )
-            result_fd.write(result_item + '\n')
-            result_fd.flush()
             result_obj = json.loads(result_item)
+            result_batch.append(result_item)
+            if feature_blob is not None:
+                feature_batch.append((result_obj['id'], feature_blob))
+            if len(result_batch) >= batch_size:
+                flush_results()
             if ad_cfg.is_delete and result_obj['is_hit'] == False:
                 if os.path.exists(result_obj['apk_meta']['apk_file']):
                     os.remove(result_obj['apk_meta']['apk_file'])
+                    if ad_cfg.apk_manifest is not None:
+                        ad_cfg.apk_manifest.remove(result_obj['apk_meta']['apk_file'])
                     delete_count += 1
         except Exception as e:
             logging.info('error when saving detection results: %s', e)
-            time.sleep(interval)
             continue
+    flush_results()
     logging.info(
         'quit detect result dumping with %d done, and time cost %d seconds',
         result_count,
         time.time() - start_time,
     )
-    result_fd.close()
+
+def drop_result_phase(
+    drop_queue,
+    interval :int=5,
+    batch_size :int=200,
+    task_journal: TaskJournal=None,
+    shard_progress: ShardProgress=None,
+):
+    """ finish the apks download and detection processes gave up on, until
+        the None the main process sends once all of them have exited: they
+        leave the journal as dropped and no longer hold back their shard
+    """
+    drop_batch = []
+
+    def flush_drops():
+        if task_journal is not None:
+            task_journal.record(TaskState.DROPPED, drop_batch)
+        if shard_progress is not None:
+            shard_progress.settle(drop_batch)
+        drop_batch.clear()
+
+    drop_count = 0
+    while True:
+        try:
+            apk_id = drop_queue.get(timeout=interval)
+        except queue.Empty:
+            flush_drops()
+            continue
+        if apk_id is None:
+            break
+        drop_count += 1
+        drop_batch.append(apk_id)
+        if len(drop_batch) >= batch_size:
+            flush_drops()
+    flush_drops()
+    logging.info('quit drop result dumping with %d apks given up on', drop_count)
 
 def load_androzoo_apks(
     apk_file,
     before_ds='2000-01-01',
     after_ds='2017-01-01',
-) -> typing.Dict[str, Apk]:
-    date_format='%Y-%m-%d'
-    after_date_filter = datetime.datetime.strptime(after_ds, date_format)
-    before_date_filter = datetime.datetime.strptime(before_ds, date_format)
-    apk_dict = {}
-    # load in download tasks
-    with open(apk_file, 'r') as fd:
-        line_num = 0
-        for line in fd:
-            line_num += 1
-            if line_num == 1:
-                continue
-            attrs = line.strip().split(',')
-            sha256 = attrs[0].lower()
-            dex_ds = attrs[3].split(' ')[0]
-            market = attrs[-1]
-            is_target = False
-            if after_date_filter:
-                if len(dex_ds) == 0: # some didn't have dex_ds
-                    continue
-                dex_date = datetime.datetime.strptime(dex_ds, date_format)
-                if after_date_filter < dex_date:
-                    is_target = True
-            if before_date_filter:
-                if len(dex_ds) == 0: # some didn't have dex_ds
-                    continue
-                dex_date = datetime.datetime.strptime(dex_ds, '%Y-%m-%d')
-                if before_date_filter > dex_date:
-                    is_target = True
-            if (after_date_filter is not None or before_date_filter is not None) and is_target == False:
+    index_file=None,
+    markets=None,
+) -> ApkSelection:
+    """ select apks from the columnar index of apk_file (see androzoo_index),
+        built next to it (or at index_file) on the first run
+    """
+    try:
+        index = AndroZooIndex.open(apk_file, index_file)
+    except OSError as e:
+        logging.warning('no androzoo index, parse %s instead: %s', apk_file, e)
+        return select_csv(
+            apk_file,
+            after_ds=after_ds,
+            before_ds=before_ds,
+            markets=markets,
+            apk_class=Apk,
+        )
+    return index.select(
+        after_ds=after_ds,
+        before_ds=before_ds,
+        markets=markets,
+        apk_class=Apk,
+    )
+
+def load_apk_signs(
+    apk_sign_file,
+) -> typing.List[ApkSign]:
+    """ each line: {"pname": provider, "signs": [[sign, confidence, type], ...]}
+        confidence and type are optional
+    """
+    apk_signs = []
+    with open(apk_sign_file, 'r') as fd:
+        for line  in fd:
+            p_obj = json.loads(line.strip())
+            if 'pname' not in p_obj:
                 continue
-            pkg_id = attrs[5].strip('""')
-            apk_dict[sha256] = Apk(
-                id=sha256,
-                pkg_id=pkg_id,
-                dex_date=dex_ds,
-                market=market,
-            )
-    return apk_dict
+            provider = p_obj['pname']
+            for sign_item in p_obj['signs']:
+                sign = sign_item[0]
+                confidence = sign_item[1] if len(sign_item) > 1 else 'low'
+                sign_type = sign_item[2] if len(sign_item) > 2 else 'str'
+                apk_signs.append(
+                    ApkSign(
+                        sign_str=sign,
+                        provider=provider,
+                        confidence=confidence,
+                        type=sign_type,
+                    )
+                )
+    return apk_signs
+
+def load_scan_rules(
+    apk_sign_file,
+    apk_signs,
+) -> ScanRules:
+    """ a line {"scan_rules": {"exclude_dirs": [...], "include_dirs": [...],
+        "exclude_exts": [...], "max_file_size": ..., "priority_dirs": [...]}}
+        in the sign file, defaults if there is none
+    """
+    rule_obj = {}
+    with open(apk_sign_file, 'r') as fd:
+        for line in fd:
+            p_obj = json.loads(line.strip())
+            if 'scan_rules' in p_obj:
+                rule_obj = p_obj['scan_rules']
+    return ScanRules(
+        exclude_dirs=rule_obj.get('exclude_dirs'),
+        include_dirs=rule_obj.get('include_dirs'),
+        exclude_exts=rule_obj.get('exclude_exts'),
+        max_file_size=rule_obj.get('max_file_size'),
+        priority_dirs=rule_obj.get('priority_dirs'),
+        sign_strs=[sign.sign_str for sign in apk_signs],
+    )
+
+def init_worker_logging(level):
+    logging.basicConfig(level=level, format=LOG_FORMAT)
 
 if __name__ == '__main__':
-    format_str = '%(asctime)s - %(levelname)s - %(message)s -%(funcName)s'
-    #logging.basicConfig(level=logging.DEBUG, format=format_str)
-    logging.basicConfig(level=logging.INFO, format=format_str)
+    # processes are started from a clean server process rather than forked
+    # from this one, whose threads (e.g., the pool supervisor) may hold locks
+    mp.set_start_method('forkserver')
+    #logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
     parser = argparse.ArgumentParser()
     parser.add_argument('apk_base_dir') # where to store those apks
     parser.add_argument('apk_list_file') # androzoo apk list
@@ -524,6 +1596,61 @@ if __name__ == '__main__':
     parser.add_argument('-adf', '--after_date_filter', type=str, default=None, help='format Y-m-d, e.g, 2017-01-01')
     parser.add_argument('-bdf', '--before_date_filter', type=str, default=None, help='format Y-m-d, e.g, 2017-01-01')
     parser.add_argument('-odf', '--old_detection_file', type=str, default=None)
+    parser.add_argument(
+        '-sm',
+        '--scan_mode',
+        type=str,
+        default=ScanMode.APKTOOL,
+        choices=[ScanMode.APKTOOL, ScanMode.ZIP, ScanMode.DEX],
+        help='zip: scan zip entries in process and run apktool only for smali signs, dex: never run apktool',
+    )
+    parser.add_argument('-mes', '--max_entry_size', type=int, default=None, help='skip zip entries larger than this many bytes')
+    parser.add_argument('-ecf', '--entry_cache_file', type=str, default=None, help='sqlite file caching zip entry verdicts across apks')
+    parser.add_argument('-ecs', '--entry_cache_size', type=int, default=1000000, help='max number of cached entry verdicts')
+    parser.add_argument('-fsf', '--feature_store_file', type=str, default=None, help='sqlite file of per-apk features, used to re-detect old results without downloading')
+    parser.add_argument(
+        '-vm',
+        '--verdict_mode',
+        type=str,
+        default=VerdictMode.EXHAUSTIVE,
+        choices=[VerdictMode.EXHAUSTIVE, VerdictMode.FIRST_HIGH, VerdictMode.PROVIDER],
+        help='first_high: stop at the first high confidence hit, provider: stop matching the signs of a provider once one of them hit',
+    )
+    parser.add_argument('-aw', '--apktool_worker', action='store_true', help='keep apktool.jar (next to apk_tool) warm in one jvm per detection process')
+    parser.add_argument('-mb', '--memory_budget', type=int, default=256, help='MB of file content each detection process holds in memory')
+    parser.add_argument('-sd', '--stream_detect', action='store_true', help='match raw bytes while downloading, apks classified from raw bytes alone are not kept; with the default -vm exhaustive that is only when every sign is matched')
+    parser.add_argument('-spd', '--spool_dir', type=str, default=None, help='local dir to download into with -sd, only kept apks are moved to apk_base_dir, default result_dir/temp/spool')
+    parser.add_argument(
+        '-de',
+        '--download_engine',
+        type=str,
+        default=DownloadEngine.THREAD,
+        choices=[DownloadEngine.THREAD, DownloadEngine.ASYNC],
+        help='async: asyncio with one pooled keep-alive session per download process, needs aiohttp',
+    )
+    parser.add_argument('-dc', '--download_concurrency', type=int, default=None, help='downloads in flight per process with the async engine, default num_download_threads')
+    parser.add_argument('-arc', '--adaptive_rate', action='store_true', help='adapt downloads in flight across download processes (AIMD), up to the configured threads or concurrency')
+    parser.add_argument('-aif', '--androzoo_index_file', type=str, default=None, help='columnar index of apk_list_file, default apk_list_file.idx, built on first use')
+    parser.add_argument('-mf', '--market_filter', type=str, default=None, help='comma separated markets, e.g., play.google.com')
+    parser.add_argument('-tbs', '--task_batch_size', type=int, default=8, help='apk tasks per item of the task queues')
+    parser.add_argument('-rsf', '--result_store_file', type=str, default=None, help='sqlite result store, default result_dir/detection_results.db')
+    parser.add_argument('-ex', '--export_results', type=str, nargs='?', const='', default=None, help='export the result store as json lines (default result_dir/detection_results.json) and quit')
+    parser.add_argument('-amf', '--apk_manifest_file', type=str, default=None, help='sqlite manifest of the apks under apk_base_dir, scanned once and kept up to date by downloads and deletes')
+    parser.add_argument('-rs', '--rescan_manifest', action='store_true', help='rebuild the manifest, e.g., after apks were added by other tools')
+    parser.add_argument('-tjf', '--task_journal_file', type=str, default=None, help='journal of task states, default result_dir/task_journal.log, downloaded apks of a crashed run are detected first on restart')
+    parser.add_argument('-sld', '--shard_lease_dir', type=str, default=None, help='directory shared by the nodes of a sharded run, each node detects the shards it leases there')
+    parser.add_argument('-nsh', '--num_shards', type=int, default=256, help='shards of the apk list by sha256 prefix, the same on every node')
+    parser.add_argument('-nid', '--node_id', type=str, default=None, help='node name on shard leases, default host name')
+    parser.add_argument('-lttl', '--lease_ttl', type=int, default=600, help='seconds before the shards of a lost node are leased again')
+    parser.add_argument('-mrg', '--merge_result_stores', type=str, nargs='+', default=None, help='merge the result stores of other nodes into the result store and quit')
+    parser.add_argument('-ac', '--apk_cache', type=str, default=None, help='apk cache by sha256 tried before androzoo, a directory or the http url of apk_cache.py')
+    parser.add_argument('-acs', '--apk_cache_size', type=int, default=100, help='GB of apks kept in a cache directory, least recently used ones are evicted')
+    parser.add_argument('-actf', '--apk_cache_token_file', type=str, default=None, help='file with the token of an http apk cache, needed to add downloads to it')
+    parser.add_argument('-rbl', '--rebalance', action='store_true', help='move processes between download and detection, whichever is the bottleneck')
+    parser.add_argument('-rbi', '--rebalance_interval', type=int, default=30, help='seconds between rebalance checks')
+    parser.add_argument('-mxdep', '--max_detect_processes', type=int, default=None, help='max detection processes when rebalancing, default cpu count')
+    parser.add_argument('-mxdop', '--max_download_processes', type=int, default=None, help='max download processes when rebalancing, default 2 * num_download_processes')
+    parser.add_argument('-mxc', '--max_connections', type=int, default=None, help='max androzoo connections of all download processes when rebalancing')
     options = parser.parse_args()
     apk_base_dir = options.apk_base_dir
     apk_list_file = options.apk_list_file
@@ -535,10 +1662,58 @@ if __name__ == '__main__':
     num_detect_processes = options.num_detect_processes
     num_download_processes = options.num_download_processes
     num_download_threads = options.num_download_threads
+    rebalance = options.rebalance
+    rebalance_interval = options.rebalance_interval
+    max_detect_processes = options.max_detect_processes
+    max_download_processes = options.max_download_processes
+    max_connections = options.max_connections
     timeout = options.timeout
     before_ds = options.before_date_filter
     after_ds = options.after_date_filter
     old_detection_file = options.old_detection_file
+    scan_mode = options.scan_mode
+    max_entry_size = options.max_entry_size
+    entry_cache_file = options.entry_cache_file
+    entry_cache_size = options.entry_cache_size
+    feature_store_file = options.feature_store_file
+    verdict_mode = options.verdict_mode
+    memory_budget = options.memory_budget * 1024 * 1024
+    stream_detect = options.stream_detect
+    spool_dir = options.spool_dir
+    download_engine = options.download_engine
+    download_concurrency = options.download_concurrency
+    adaptive_rate = options.adaptive_rate
+    androzoo_index_file = options.androzoo_index_file
+    task_batch_size = max(1, options.task_batch_size)
+    result_store_file = options.result_store_file
+    export_results = options.export_results
+    apk_manifest_file = options.apk_manifest_file
+    rescan_manifest = options.rescan_manifest
+    task_journal_file = options.task_journal_file
+    shard_lease_dir = options.shard_lease_dir
+    num_shards = options.num_shards
+    node_id = options.node_id if options.node_id else socket.gethostname()
+    lease_ttl = options.lease_ttl
+    merge_result_stores = options.merge_result_stores
+    apk_cache = None
+    if options.apk_cache is not None:
+        apk_cache_token = None
+        if options.apk_cache_token_file is not None:
+            apk_cache_token = open(options.apk_cache_token_file, 'r').read().strip()
+        apk_cache = open_apk_cache(
+            options.apk_cache,
+            max_size=options.apk_cache_size * GB,
+            token=apk_cache_token,
+        )
+    market_filter = None
+    if options.market_filter is not None:
+        market_filter = options.market_filter.split(',')
+    apktool_jar = None
+    if options.apktool_worker:
+        apktool_jar = os.path.join(
+            os.path.dirname(os.path.abspath(apk_tool)),
+            'apktool.jar',
+        )
 
     if not os.path.exists(result_dir):
         os.makedirs(result_dir)
@@ -546,22 +1721,46 @@ if __name__ == '__main__':
         result_dir,
         'detection_results.json'
     )
+    if result_store_file is None:
+        result_store_file = os.path.join(
+            result_dir,
+            'detection_results.db',
+        )
+    is_new_store = not os.path.exists(result_store_file)
+    result_store = ResultStore(result_store_file)
+    if is_new_store and os.path.exists(result_file):
+        # one-time migration of the json lines results
+        result_store.import_jsonl(result_file)
+    if merge_result_stores is not None:
+        for store_file in merge_result_stores:
+            result_store.merge(store_file)
+        sys.exit(0)
+    if export_results is not None:
+        result_store.export_jsonl(
+            export_results if export_results else result_file,
+        )
+        sys.exit(0)
+    if task_journal_file is None:
+        task_journal_file = os.path.join(
+            result_dir,
+            'task_journal.log',
+        )
+    task_journal = TaskJournal(task_journal_file)
+    shard_leaser = None
+    shard_progress = None
+    if shard_lease_dir is not None:
+        shard_leaser = ShardLeaser(
+            shard_lease_dir,
+            num_shards,
+            node_id,
+            lease_ttl=lease_ttl,
+        )
+        shard_progress = ShardProgress(shard_leaser)
+    # ids of apks the download and detection processes give up on
+    drop_queue = mp.Queue()
     # load in apk signatures
-    apk_signs = []
-    with open(apk_sign_file, 'r') as fd:
-        for line  in fd:
-            p_obj = json.loads(line.strip())
-            provider = p_obj['pname']
-            for sign_item in p_obj['signs']:
-                sign = sign_item[0]
-                confidence = sign_item[1]
-                apk_signs.append(
-                    ApkSign(
-                        sign_str=sign,
-                        provider=provider,
-                        confidence=confidence,
-                    )
-                )
+    apk_signs = load_apk_signs(apk_sign_file)
+    scan_rules = load_scan_rules(apk_sign_file, apk_signs)
     apk_sign_str_set = set([sign.sign_str for sign in apk_signs])
     logging.info(
         'loaded %d apk signs, %d unique sign strs',
@@ -569,11 +1768,47 @@ if __name__ == '__main__':
         len(apk_sign_str_set),
     )
     api_key = open(api_key_file, 'r').read().strip()
+    apk_manifest = None
+    if apk_manifest_file is not None:
+        apk_manifest = ApkManifest(apk_base_dir, apk_manifest_file)
+        if rescan_manifest or not apk_manifest.exists():
+            apk_manifest.scan()
     apk_download_cfg = ApkDownloadConfig(
         api_key=api_key,
         thread_num=num_download_threads,
         timeout=timeout,
+        engine=download_engine,
+        concurrency=download_concurrency,
+        apk_manifest=apk_manifest,
+        task_queue_size=2 * max(1, num_download_processes * max(num_download_threads, download_concurrency or 0)),
+        result_queue_size=max(1, 1000 // task_batch_size),
+        apk_cache=apk_cache,
+        drop_queue=drop_queue,
     )
+    if rebalance:
+        if max_detect_processes is None:
+            max_detect_processes = max(num_detect_processes, os.cpu_count() or 1)
+        if max_download_processes is None:
+            max_download_processes = 2 * num_download_processes
+        if max_connections is not None:
+            # connections of a download process are its threads or concurrency
+            if download_engine == DownloadEngine.ASYNC:
+                process_connections = apk_download_cfg.concurrency
+            else:
+                process_connections = num_download_threads
+            max_download_processes = min(
+                max_download_processes,
+                max(1, max_connections // process_connections),
+            )
+        max_detect_processes = max(num_detect_processes, max_detect_processes)
+        max_download_processes = max(num_download_processes, max_download_processes)
+    else:
+        max_detect_processes = num_detect_processes
+        max_download_processes = num_download_processes
+    if adaptive_rate:
+        apk_download_cfg.rate_controller = AimdController(
+            max_window=max_download_processes * apk_download_cfg.concurrency,
+        )
     apk_detect_cfg = ApkDetectionConfig(
         work_dir=os.path.join(
             result_dir,
@@ -584,40 +1819,83 @@ if __name__ == '__main__':
         result_file=result_file,
         timeout=timeout,
         detect_tag=detect_tag,
+        scan_mode=scan_mode,
+        max_entry_size=max_entry_size,
+        entry_cache_file=entry_cache_file,
+        entry_cache_size=entry_cache_size,
+        feature_store_file=feature_store_file,
+        verdict_mode=verdict_mode,
+        apktool_jar=apktool_jar,
+        scan_rules=scan_rules,
+        memory_budget=memory_budget,
+        result_store_file=result_store_file,
+        apk_manifest=apk_manifest,
+        task_queue_size=4 * num_detect_processes,
+        drop_queue=drop_queue,
     )
+    if stream_detect:
+        apk_download_cfg.stream_detect_cfg = apk_detect_cfg
+        apk_download_cfg.spool_dir = spool_dir if spool_dir else os.path.join(
+            result_dir,
+            'temp',
+            'spool',
+        )
+        if verdict_mode == VerdictMode.EXHAUSTIVE:
+            logging.warning(
+                'with -vm %s, -sd only drops apks in which every sign is matched while downloading, see -vm',
+                verdict_mode,
+            )
 
     # set up detect workers
-    detect_workers = []
+    detect_pool = WorkerPool(
+        'detect',
+        apk_detection,
+        (apk_detect_cfg,),
+        min_size=1 if rebalance else num_detect_processes,
+        max_size=max_detect_processes,
+        initializer=init_worker_logging,
+        initargs=(logging.getLogger().level,),
+    )
     for index in range(num_detect_processes):
-        detect_worker = mp.Process(
-            target=apk_detection,
-            args=(
-                apk_detect_cfg,
-            ),
-        )
-        detect_workers.append(detect_worker)
-        detect_worker.start()
+        detect_pool.grow()
     logging.info(
-        'start %d detection processes',
+        'start %d detection processes, at most %d',
         num_detect_processes,
+        max_detect_processes,
     )
 
     # set up download workers
-    download_workers = []
+    download_pool = WorkerPool(
+        'download',
+        apk_download,
+        (apk_download_cfg,),
+        min_size=1 if rebalance else num_download_processes,
+        max_size=max_download_processes,
+        initializer=init_worker_logging,
+        initargs=(logging.getLogger().level,),
+    )
     for index in range(num_download_processes):
-        download_worker = mp.Process(
-            target=apk_download,
-            args=(
-                apk_download_cfg,
-            )
-        )
-        download_workers.append(download_worker)
-        download_worker.start()
+        download_pool.grow()
     logging.info(
-        'start %d download processes, each with %d threads',
+        'start %d download processes, each with %d threads, at most %d processes',
         num_download_processes,
         num_download_threads,
+        max_download_processes,
     )
+    pool_supervisor = None
+    if rebalance:
+        pool_supervisor = PoolSupervisor(
+            download_pool,
+            detect_pool,
+            apk_download_cfg.task_queue,
+            apk_download_cfg.task_queue_size,
+            apk_detect_cfg.task_queue,
+            apk_detect_cfg.task_queue_size,
+            lambda: apk_download_cfg.download_count,
+            lambda: apk_detect_cfg.detect_count,
+            interval=rebalance_interval,
+        )
+        pool_supervisor.start()
 
     # set up threads in main process to process download
     # and detection results
@@ -627,6 +1905,9 @@ if __name__ == '__main__':
             apk_download_cfg,
             apk_detect_cfg,
         ),
+        kwargs=dict(
+            task_journal=task_journal,
+        ),
     )
     download_result_thread.start()
     detect_result_thread = threading.Thread(
@@ -634,40 +1915,98 @@ if __name__ == '__main__':
         args=(
             apk_detect_cfg,
         ),
+        kwargs=dict(
+            task_journal=task_journal,
+            shard_progress=shard_progress,
+        ),
     )
     detect_result_thread.start()
+    drop_result_thread = threading.Thread(
+        target=drop_result_phase,
+        args=(
+            drop_queue,
+        ),
+        kwargs=dict(
+            task_journal=task_journal,
+            shard_progress=shard_progress,
+        ),
+    )
+    drop_result_thread.start()
     start_time = time.time()
     # load in apk id and file path
-    apk_dict = load_androzoo_apks(
+    selection = load_androzoo_apks(
         apk_list_file,
         before_ds,
         after_ds,
+        index_file=androzoo_index_file,
+        markets=market_filter,
     )
     logging.info(
         'loaded %d apks',
-        len(apk_dict),
+        len(selection),
     )
-    # loaded in already done results
-    done_apks = set()
-    if os.path.exists(result_file):
-        with open(result_file, 'r') as fd:
-            for line in fd:
-                result_obj = json.loads(line.strip())
-                done_apks.add(result_obj['id'])
-    old_new_detect_apks = set()
+    # selected apks are kept as index rows from here on, flagged by row once
+    # done; the store hands its ids over in the same sha256 order
+    done_mask = bytearray(selection.row_limit)
+    for apk_id, row in selection.find_rows(result_store.ids()):
+        if row is not None:
+            done_mask[row] = 1
+    done_count = done_mask.count(1)
+    old_new_detect_rows = array.array('I')
     old_no_detect = 0
     old_deprecate = 0
+    old_feature_detect = 0
+    feature_store = None
+    if feature_store_file is not None and os.path.exists(feature_store_file):
+        feature_store = FeatureStore(feature_store_file)
+    sign_matcher = SignMatcher(apk_sign_str_set)
     if old_detection_file is not None:
-        with open(old_detection_file, 'r') as fd:
-            for line in fd:
-                result_obj = json.loads(line.strip())
+        # only old results of the selected apks are taken from a store
+        is_selected_only = is_result_store(old_detection_file)
+        if is_selected_only:
+            # the latest old result of each apk, in id order
+            old_results = ResultStore(old_detection_file).latest_results()
+        else:
+            old_results = open(old_detection_file, 'r')
+        with contextlib.closing(old_results) as fd:
+            for result_obj, row in selection.find_rows(
+                (json.loads(line.strip()) for line in fd),
+                key=lambda result_obj: result_obj['id'],
+            ):
                 apk_id = result_obj['id']
-                if apk_id in done_apks:
+                if row is None:
+                    if is_selected_only or result_store.is_done(apk_id):
+                        continue
+                elif done_mask[row]:
                     continue
                 old_detect_tag = result_obj['detect_tag']
                 old_sign_strs = set([
                     detect['sign_str'] for detect in result_obj['detection']
                 ])
+                # re-detect on stored features: keep old hits of signs
+                # still in use and match the current signs on the features
+                apk_features = None
+                if feature_store is not None:
+                    apk_features = feature_store.get(apk_id)
+                if apk_features is not None:
+                    matched_signs = (
+                        (old_sign_strs & apk_sign_str_set)
+                        | sign_matcher.match(apk_features)
+                    )
+                    result_obj['detection'] = [
+                        sign_obj.__dict__
+                        for sign_obj in apk_signs
+                        if sign_obj.sign_str in matched_signs
+                    ]
+                    result_obj['is_hit'] = len(matched_signs) > 0
+                    result_obj['detect_tag'] = detect_tag
+                    result_obj['detection_time'] = time.time()
+                    old_feature_detect += 1
+                    apk_detect_cfg.result_queue.put((json.dumps(result_obj), None))
+                    if row is not None:
+                        done_mask[row] = 1
+                        done_count += 1
+                    continue
                 # deprecated signatures
                 if len(old_sign_strs) > 0 and len(old_sign_strs & apk_sign_str_set) == 0:
                     result_obj['detection'] = []
@@ -677,101 +2016,176 @@ if __name__ == '__main__':
                 # result_obj['detect_tag'] = detect_tag
                 if len(result_obj['detection']) == 0:
                     old_no_detect += 1
-                    apk_detect_cfg.result_queue.put(json.dumps(result_obj))
-                    done_apks.add(apk_id)
+                    apk_detect_cfg.result_queue.put((json.dumps(result_obj), None))
+                    if row is not None:
+                        done_mask[row] = 1
+                        done_count += 1
                     continue
-                old_new_detect_apks.add(apk_id)
+                # only apks of the selection are detected again, flagged so
+                # that they are taken once
+                if row is not None:
+                    old_new_detect_rows.append(row)
+                    done_mask[row] = 1
 
     logging.info(
         """
         old detection results:
         no need for detection: %d,
         deprecated detection: %d,
+        re-detected on stored features: %d,
         need new detection: %d,
         """,
         old_no_detect,
         old_deprecate,
-        len(old_new_detect_apks),
+        old_feature_detect,
+        len(old_new_detect_rows),
     )
-    apks_to_detect = set(apk_dict.keys()) - done_apks
     logging.info(
         'loaded %d apk ids, %d done, %d left to detect',
-        len(apk_dict),
-        len(done_apks),
-        len(apks_to_detect),
+        len(selection),
+        done_count,
+        len(selection) - done_count,
     )
-    if len(apks_to_detect) == 0:
-        logging.info('no apks to detect, quit')
-        sys.exit(0)
+    if len(selection) == done_count:
+        logging.info('no apks to detect, quit once the workers have drained')
 
-    # put downloaded apks in the queue of detection
-    # put others in the queue of download
-    apks_to_download = set()
-    download_task_count = 0
-    detect_task_count = 0
-    for apk_id in old_new_detect_apks:
-        apk_obj = apk_dict[apk_id]
-        apk_obj.apk_file = os.path.join(
-            apk_base_dir,
-            apk_obj.base_dir,
-            apk_obj.name,
-        )
-        if os.path.exists(apk_obj.apk_file):
-            apk_detect_cfg.task_queue.put(
-                json.dumps(apk_obj.__dict__)
-            )
-            detect_task_count += 1
-        else:
-            apks_to_download.add(apk_id)
-            download_task_count += 1
-    apks_to_detect -= old_new_detect_apks
-    for apk_id in apks_to_detect:
-        apk_obj = apk_dict[apk_id]
-        apk_obj.apk_file = os.path.join(
-            apk_base_dir,
-            apk_obj.base_dir,
-            apk_obj.name,
-        )
-        if os.path.exists(apk_obj.apk_file):
-            apk_detect_cfg.task_queue.put(
-                json.dumps(apk_obj.__dict__)
-            )
-            detect_task_count += 1
-        else:
-            apks_to_download.add(apk_id)
-            download_task_count += 1
-    logging.info(
-        'fed %d download tasks, %d detection tasks',
-        download_task_count,
-        detect_task_count,
+    rows_to_detect = array.array('I', itertools.filterfalse(done_mask.__getitem__, selection.rows))
+    del done_mask
+    present_apks = None
+    if apk_manifest is not None:
+        present_apks = apk_manifest.load()
+    # apks downloaded by a run that died before detecting them
+    journal_rows = set(
+        row
+        for apk_id, row in selection.find_rows(sorted(
+            task_journal.ids_in(TaskState.DOWNLOADED, TaskState.DETECTING)
+        ))
+        if row is not None
     )
-    task_unit = 1000
-    while True:
-        if time.time() - start_time >= timeout:
-            break
-        new_download_task_unit = task_unit - apk_detect_cfg.task_queue.qsize() - apk_download_cfg.task_queue.qsize()
-        if (
-            len(apks_to_download) == 0
-            or new_download_task_unit <= 0
-        ):
-            time.sleep(10)
-            continue
-        for index in range(new_download_task_unit):
-            apk_id = apks_to_download.pop()
-            apk_obj = apk_dict[apk_id]
-            apk_download_cfg.task_queue.put(
-                json.dumps(apk_obj.__dict__)
+
+    def route_apks(rows):
+        """ downloaded apks go to detection, the ones of a run that died
+            first, others go to download
+        """
+        resumed_rows = array.array('I')
+        detect_task_rows = array.array('I')
+        rows_to_download = array.array('I')
+        for row in rows:
+            apk_obj = selection.apk(row)
+            if row in journal_rows and os.path.exists(
+                os.path.join(apk_base_dir, apk_obj.base_dir, apk_obj.name)
+            ):
+                resumed_rows.append(row)
+                continue
+            if present_apks is not None:
+                is_present = os.path.join(apk_obj.base_dir, apk_obj.name) in present_apks
+            else:
+                is_present = os.path.exists(os.path.join(apk_base_dir, apk_obj.apk_file))
+            if is_present:
+                detect_task_rows.append(row)
+            else:
+                rows_to_download.append(row)
+        logging.info(
+            'resume detection of %d apks downloaded before a restart',
+            len(resumed_rows),
+        )
+        return resumed_rows + detect_task_rows, rows_to_download
+
+    def feed_tasks(task_queue, rows, deadline, sentinel_count, task_state):
+        """ put batches of tasks with backpressure from the bounded queue,
+            journaled as task_state, then one None per consumer
+        """
+        task_batch = []
+        for row in rows:
+            apk_obj = selection.apk(row)
+            apk_obj.apk_file = os.path.join(
+                apk_base_dir,
+                apk_obj.base_dir,
+                apk_obj.name,
             )
-        time.sleep(10)
+            task_batch.append(apk_obj)
+            if len(task_batch) >= task_batch_size:
+                task_journal.record(task_state, [apk_obj.id for apk_obj in task_batch])
+                if not put_until(task_queue, Apk.pack_batch(task_batch), deadline):
+                    return
+                task_batch = []
+        if len(task_batch) > 0:
+            task_journal.record(task_state, [apk_obj.id for apk_obj in task_batch])
+            put_until(task_queue, Apk.pack_batch(task_batch), deadline)
+        for i in range(sentinel_count):
+            put_until(task_queue, None, deadline)
 
+    candidate_rows = old_new_detect_rows + rows_to_detect
+    if shard_leaser is None:
+        shard_tasks = [(None, candidate_rows)]
+    else:
+        # lease shards one at a time, the bounded queues hold back the next
+        # lease until the tasks of the current shard are mostly taken
+        shard_rows = {}
+        for row in candidate_rows:
+            shard = selection.shard_of(row, shard_leaser.shard_count)
+            if shard not in shard_rows:
+                shard_rows[shard] = array.array('I')
+            shard_rows[shard].append(row)
+        shard_leaser.start()
+        shard_tasks = (
+            (shard, shard_rows.get(shard, array.array('I')))
+            for shard in shard_leaser.iter_shards(apk_detect_cfg.deadline)
+        )
+    for shard, rows in shard_tasks:
+        if shard_progress is not None:
+            if time.time() >= apk_detect_cfg.deadline:
+                # leased just as the run timed out
+                shard_leaser.release(shard)
+                break
+            shard_progress.add(shard, [selection.sha256(row) for row in rows])
+        detect_task_rows, rows_to_download = route_apks(rows)
+        download_feed_thread = threading.Thread(
+            target=feed_tasks,
+            args=(
+                apk_download_cfg.task_queue,
+                rows_to_download,
+                apk_download_cfg.deadline,
+                0,
+                TaskState.QUEUED,
+            ),
+        )
+        download_feed_thread.start()
+        logging.info(
+            'feeding %d download tasks, %d detection tasks of shard %s',
+            len(rows_to_download),
+            len(detect_task_rows),
+            'all' if shard is None else shard,
+        )
+        feed_tasks(
+            apk_detect_cfg.task_queue,
+            detect_task_rows,
+            apk_detect_cfg.deadline,
+            0,
+            TaskState.DETECTING,
+        )
+        download_feed_thread.join()
 
-    # wait for workers to finish
-    for worker in download_workers:
-        worker.join()
+    # wait for the stages to drain: downloads, then detections, then results,
+    # a None per consumer still running once its pool stops growing
+    for i in range(apk_download_cfg.consumer_count(download_pool.drain())):
+        put_until(apk_download_cfg.task_queue, None, apk_download_cfg.deadline)
+    download_pool.join()
+    put_until(apk_download_cfg.result_queue, None, apk_download_cfg.deadline)
     download_result_thread.join()
-    for worker in detect_workers:
-        worker.join()
+    for i in range(detect_pool.drain()):
+        put_until(apk_detect_cfg.task_queue, None, apk_detect_cfg.deadline)
+    if pool_supervisor is not None:
+        pool_supervisor.stop()
+    detect_pool.join()
+    apk_detect_cfg.result_queue.put(None)
     detect_result_thread.join()
+    drop_queue.put(None)
+    drop_result_thread.join()
+    task_journal.close()
+    if shard_leaser is not None:
+        # shards of a run that timed out are left to expire
+        shard_leaser.finish(is_done=time.time() < apk_detect_cfg.deadline)
 
     # output result stats
     logging.info(
@@ -782,7 +2196,7 @@ if __name__ == '__main__':
         Detection: %d,
         time cost is %d seconds
         """,
-        len(apks_to_detect),
+        len(candidate_rows),
         apk_download_cfg.download_count,
         apk_detect_cfg.detect_count,
         int(time.time() - start_time),
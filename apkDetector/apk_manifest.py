@@ -0,0 +1,106 @@
+""" Inventory of the apks present under apk_base_dir
+    One parallel os.scandir walk of the three-level base_dir sharding builds a
+    sqlite manifest of apk paths; the download and delete paths of the
+    workflow keep it up to date, so that routing tasks between download and
+    detection is a set lookup instead of one stat per candidate apk.
+"""
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import time
+import typing
+from sqlite_store import SqliteStore
+
+
+class ApkManifest(SqliteStore):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS apk_manifest (path TEXT PRIMARY KEY)',
+    )
+
+    def __init__(
+        self,
+        base_dir,
+        manifest_file,
+        timeout=60,
+    ):
+        self.base_dir = base_dir
+        self.manifest_file = manifest_file
+        super().__init__(manifest_file, timeout=timeout)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_file)
+
+    def rel_path(self, apk_file) -> str:
+        return os.path.relpath(apk_file, self.base_dir)
+
+    def _scan_dir(self, top_dir) -> typing.List[str]:
+        """ apk paths under one first-level shard, relative to base_dir
+        """
+        apk_paths = []
+        stack = [(top_dir, 1)]
+        while len(stack) > 0:
+            cur_dir, depth = stack.pop()
+            try:
+                with os.scandir(cur_dir) as entries:
+                    for entry in entries:
+                        if depth < 3 and entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, depth + 1))
+                        elif depth == 3 and entry.name.endswith('.apk'):
+                            apk_paths.append(self.rel_path(entry.path))
+            except OSError as e:
+                logging.warning('error when scanning %s: %s', cur_dir, e)
+        return apk_paths
+
+    def scan(self, workers=16) -> int:
+        """ rebuild the manifest from the apks on disk
+        """
+        start_time = time.time()
+        top_dirs = []
+        if os.path.exists(self.base_dir):
+            with os.scandir(self.base_dir) as entries:
+                top_dirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+        conn = self.connect()
+        conn.execute('BEGIN')
+        try:
+            conn.execute('DELETE FROM apk_manifest')
+            apk_count = 0
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for apk_paths in executor.map(self._scan_dir, top_dirs):
+                    conn.executemany(
+                        'INSERT OR IGNORE INTO apk_manifest VALUES (?)',
+                        [(path,) for path in apk_paths],
+                    )
+                    apk_count += len(apk_paths)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        logging.info(
+            'scanned %d apks under %s in %d seconds',
+            apk_count,
+            self.base_dir,
+            time.time() - start_time,
+        )
+        return apk_count
+
+    def load(self) -> typing.Set[str]:
+        return set(row[0] for row in self.connect().execute('SELECT path FROM apk_manifest'))
+
+    def add(self, apk_file):
+        try:
+            self.connect().execute(
+                'INSERT OR IGNORE INTO apk_manifest VALUES (?)',
+                (self.rel_path(apk_file),),
+            )
+        except sqlite3.Error as e:
+            logging.debug('manifest insert failed: %s', e)
+
+    def remove(self, apk_file):
+        try:
+            self.connect().execute(
+                'DELETE FROM apk_manifest WHERE path=?',
+                (self.rel_path(apk_file),),
+            )
+        except sqlite3.Error as e:
+            logging.debug('manifest delete failed: %s', e)
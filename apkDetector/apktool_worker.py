@@ -0,0 +1,133 @@
+""" Long-lived apktool worker
+    Runs apktool.jar inside one JVM (see ApktoolServer.java) and feeds it one
+    command per line over a pipe, so JVM startup and JIT warm-up are paid once
+    per detection process instead of once per apk.
+"""
+import logging
+import os
+import queue
+import subprocess
+import threading
+import typing
+
+SERVER_SOURCE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'ApktoolServer.java',
+)
+
+
+class ApktoolWorker(object):
+    def __init__(
+        self,
+        apktool_jar,
+        java='java',
+        java_opts=('-Xmx512M', '-Dfile.encoding=utf-8'),
+        job_timeout=600,
+        max_jobs=200,
+        max_rss_mb=2048,
+    ):
+        self.apktool_jar = apktool_jar
+        self.java = java
+        self.java_opts = list(java_opts)
+        # kill and restart the jvm when a job runs longer than this
+        self.job_timeout = job_timeout
+        # restart the jvm after max_jobs jobs or once its rss exceeds max_rss_mb
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.proc = None
+        self.status_queue = None
+        self.job_count = 0
+        self.restart_count = 0
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            args=[self.java] + self.java_opts + [
+                '-cp',
+                self.apktool_jar,
+                SERVER_SOURCE,
+            ],
+            env={'PATH':'/usr/bin'},
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding='utf-8',
+        )
+        self.status_queue = queue.Queue()
+        reader = threading.Thread(
+            target=self._read_status,
+            args=(self.proc, self.status_queue),
+            daemon=True,
+        )
+        reader.start()
+        self.job_count = 0
+
+    @staticmethod
+    def _read_status(proc, status_queue):
+        for line in proc.stdout:
+            status_queue.put(line.strip())
+        # eof: the jvm exited
+        status_queue.put(None)
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=10)
+        except Exception:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def restart(self, reason):
+        logging.info(
+            'restart apktool worker after %d jobs: %s',
+            self.job_count,
+            reason,
+        )
+        self.stop()
+        self.restart_count += 1
+        self.start()
+
+    def rss_mb(self) -> typing.Optional[float]:
+        try:
+            with open('/proc/{0}/status'.format(self.proc.pid), 'r') as fd:
+                for line in fd:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+    def run(self, args) -> bool:
+        """ run one apktool command, e.g., ['d', '-f', '-o', out_dir, apk_file]
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        try:
+            self.proc.stdin.write('\t'.join(args) + '\n')
+            self.proc.stdin.flush()
+        except OSError as e:
+            self.restart('broken pipe {0}'.format(e))
+            return False
+        try:
+            status = self.status_queue.get(timeout=self.job_timeout)
+        except queue.Empty:
+            self.proc.kill()
+            self.restart('job timeout')
+            return False
+        self.job_count += 1
+        if status is None:
+            # apktool called System.exit, start over on the next job
+            return_code = self.proc.wait()
+            self.proc = None
+            return return_code == 0
+        if status != 'ok':
+            logging.debug('apktool job error: %s', status)
+        rss_mb = self.rss_mb()
+        if self.job_count >= self.max_jobs:
+            self.restart('job limit')
+        elif rss_mb is not None and rss_mb > self.max_rss_mb:
+            self.restart('rss {0:.0f} MB'.format(rss_mb))
+        return status == 'ok'
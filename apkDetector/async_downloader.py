@@ -0,0 +1,195 @@
+""" asyncio download engine for the apk workflow
+    One aiohttp session per download process keeps its connections to
+    AndroZoo alive, a fixed number of worker coroutines bounds the downloads
+    in flight, and tasks are taken from the multiprocessing queue with
+    blocking gets instead of polling. Needs aiohttp.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import time
+import typing
+import aiohttp
+import get_apk_from_androzoo as du
+from apk_cache import fetch_cached_apk
+
+
+def new_session(concurrency) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=concurrency,
+        keepalive_timeout=60,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+async def download_apk(
+    session: aiohttp.ClientSession,
+    sha256,
+    result_file,
+    api_key,
+    chunk_size=10240*1024,
+    timeout=(60, 60),
+    chunk_callback=None, # called with every downloaded chunk
+    apk_cache=None, # LocalApkCache or HttpApkCache tried before AndroZoo
+    executor=None, # runs file writes, hashing and chunk_callback
+    write_size=1024*1024, # bytes received before they are handed to executor
+) -> bool:
+    """ same as du.download_apk: resume result_file.part with a Range
+        request, rename it to result_file once the sha256 matches; only the
+        network reads run on the event loop
+    """
+    loop = asyncio.get_running_loop()
+    if apk_cache is not None and await loop.run_in_executor(
+        executor,
+        fetch_cached_apk,
+        apk_cache,
+        sha256,
+        result_file,
+        chunk_size,
+        chunk_callback,
+    ):
+        return True
+    url = du.ANDROZOO_DOWNLOAD_URL.format(
+        api_key=api_key,
+        sha256=sha256,
+    )
+    start_time = time.time()
+    part_file = result_file + '.part'
+    # hashed only once the server accepts the range
+    part_size = du.part_size_of(part_file)
+    headers = {}
+    if part_size > 0:
+        headers['Range'] = 'bytes={0}-'.format(part_size)
+    client_timeout = aiohttp.ClientTimeout(
+        sock_connect=timeout[0],
+        sock_read=timeout[1],
+    )
+    async with session.get(url, timeout=client_timeout, headers=headers) as response:
+        # throttled or server errors are worth a retry, not a hash mismatch
+        if response.status == 429 or response.status >= 500:
+            response.raise_for_status()
+        if part_size > 0 and response.status == 416:
+            # the part file is already complete
+            new_sha256, _ = await loop.run_in_executor(
+                executor,
+                du.hash_partial_file,
+                part_file,
+                chunk_size,
+                chunk_callback,
+            )
+        else:
+            if part_size > 0 and response.status == 206:
+                logging.debug('resume downloading %s from byte %d', sha256[-6:], part_size)
+                new_sha256, _ = await loop.run_in_executor(
+                    executor,
+                    du.hash_partial_file,
+                    part_file,
+                    chunk_size,
+                    chunk_callback,
+                )
+                mode = 'ab'
+            else:
+                # no part file, or the range was ignored
+                new_sha256 = hashlib.sha256()
+                mode = 'wb'
+
+            def write_data(fd, data):
+                new_sha256.update(data)
+                fd.write(data)
+                if chunk_callback is not None:
+                    chunk_callback(data)
+
+            with open(part_file, mode) as fd:
+                # gather network reads, one executor call per write_size
+                pending = bytearray()
+                async for data in response.content.iter_chunked(chunk_size):
+                    pending += data
+                    if len(pending) >= write_size:
+                        await loop.run_in_executor(executor, write_data, fd, bytes(pending))
+                        pending = bytearray()
+                if len(pending) > 0:
+                    await loop.run_in_executor(executor, write_data, fd, bytes(pending))
+    logging.debug(
+        'time cost for downloading %s is %d seconds',
+        sha256[-6:],
+        time.time() - start_time,
+    )
+    if new_sha256.hexdigest().lower() != sha256.lower():
+        logging.warning(
+            'downloaded file is of a different sha256 hash: origin %s, download %s',
+            sha256.lower(),
+            new_sha256.hexdigest().lower(),
+        )
+        os.remove(part_file)
+        return False
+    os.replace(part_file, result_file)
+    if apk_cache is not None:
+        await loop.run_in_executor(executor, apk_cache.put, sha256, result_file)
+    return True
+
+
+async def consume(
+    task_queue,
+    handler: typing.Callable[[typing.Any], typing.Awaitable[None]],
+    concurrency,
+    timeout,
+    get_timeout=60,
+    unpack=None, # split a queue item into a list of tasks
+    stop_event=None, # stop taking tasks once set
+):
+    """ run handler on tasks of a multiprocessing queue, at most concurrency
+        at a time, until a None task, the stop_event or timeout seconds
+    """
+    loop = asyncio.get_running_loop()
+    deadline = time.time() + timeout
+    pending = asyncio.Queue(maxsize=concurrency)
+    if stop_event is not None:
+        get_timeout = min(get_timeout, 5)
+
+    async def feed():
+        while True:
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                break
+            if stop_event is not None and stop_event.is_set():
+                break
+            try:
+                # a blocking get in the executor, no sleep between polls
+                task = await loop.run_in_executor(
+                    None,
+                    task_queue.get,
+                    True,
+                    min(get_timeout, time_left),
+                )
+            except queue.Empty:
+                continue
+            if task is None:
+                if stop_event is not None and stop_event.is_set():
+                    # leave the None to a process that still runs, in the
+                    # executor as the queue is bounded
+                    await loop.run_in_executor(None, du.put_until, task_queue, None, deadline)
+                break
+            if unpack is None:
+                await pending.put(task)
+                continue
+            for item in unpack(task):
+                await pending.put(item)
+        for i in range(concurrency):
+            await pending.put(None)
+
+    async def work():
+        while True:
+            task = await pending.get()
+            if task is None:
+                break
+            try:
+                await handler(task)
+            except Exception as e:
+                logging.warning('error in download task: %s', e)
+
+    await asyncio.gather(
+        feed(),
+        *[work() for i in range(concurrency)],
+    )
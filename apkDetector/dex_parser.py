@@ -0,0 +1,124 @@
+""" String pool extraction from dex files
+    Class names, package paths and url strings all live in the string_ids
+    table of classes*.dex, so signs can be matched against the string pool
+    instead of the smali disassembled by apktool.
+"""
+import re
+import struct
+import typing
+import zipfile
+
+DEX_MAGIC = b'dex\n'
+DEX_HEADER_SIZE = 0x70
+# offsets of (size, offset) pairs in the dex header
+STRING_IDS_OFF = 0x38
+TYPE_IDS_OFF = 0x40
+DEX_ENTRY_RE = re.compile(r'^classes\d*\.dex$')
+
+
+class DexFormatError(Exception):
+    pass
+
+
+def read_uleb128(data, offset) -> typing.Tuple[int, int]:
+    """ return the decoded value and the offset right after it
+    """
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data) or shift > 28:
+            raise DexFormatError('bad uleb128 at {0}'.format(offset))
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80 == 0:
+            return value, offset
+        shift += 7
+
+
+def parse_dex_strings(dex_data: bytes) -> typing.List[bytes]:
+    """ return the raw MUTF-8 bytes of every entry of string_ids
+        MUTF-8 never contains a zero byte inside a string, so each string
+        ends at the first zero byte after its uleb128 utf16 length
+    """
+    if len(dex_data) < DEX_HEADER_SIZE or dex_data[:4] != DEX_MAGIC:
+        raise DexFormatError('not a dex file')
+    string_ids_size, string_ids_off = struct.unpack_from('<II', dex_data, STRING_IDS_OFF)
+    if string_ids_off + 4 * string_ids_size > len(dex_data):
+        raise DexFormatError('string_ids out of range')
+    string_data_offs = struct.unpack_from(
+        '<{0}I'.format(string_ids_size),
+        dex_data,
+        string_ids_off,
+    )
+    strings = []
+    for string_data_off in string_data_offs:
+        _, start = read_uleb128(dex_data, string_data_off)
+        end = dex_data.find(b'\0', start)
+        if end < 0:
+            raise DexFormatError('unterminated string at {0}'.format(start))
+        strings.append(dex_data[start:end])
+    return strings
+
+
+def parse_dex_types(
+    dex_data: bytes,
+    strings: typing.List[bytes],
+) -> typing.List[bytes]:
+    """ return the type descriptors listed in type_ids, e.g., Lcom/xxx/p2p/Peer;
+    """
+    type_ids_size, type_ids_off = struct.unpack_from('<II', dex_data, TYPE_IDS_OFF)
+    if type_ids_off + 4 * type_ids_size > len(dex_data):
+        raise DexFormatError('type_ids out of range')
+    descriptor_idxs = struct.unpack_from(
+        '<{0}I'.format(type_ids_size),
+        dex_data,
+        type_ids_off,
+    )
+    return [strings[idx] for idx in descriptor_idxs if idx < len(strings)]
+
+
+def descriptor_to_class_name(descriptor: bytes) -> typing.Optional[bytes]:
+    """ Lcom/xxx/p2p/Peer; -> com.xxx.p2p.Peer, None for primitive types
+    """
+    descriptor = descriptor.lstrip(b'[')
+    if not (descriptor.startswith(b'L') and descriptor.endswith(b';')):
+        return None
+    return descriptor[1:-1].replace(b'/', b'.')
+
+
+class DexStringIndex(object):
+    """ Compact set of the strings and dotted class names of dex files
+    """
+    def __init__(self):
+        self.strings = set()
+        self.dex_count = 0
+
+    def add_dex(self, dex_data: bytes):
+        strings = parse_dex_strings(dex_data)
+        self.strings.update(strings)
+        for descriptor in parse_dex_types(dex_data, strings):
+            class_name = descriptor_to_class_name(descriptor)
+            if class_name:
+                self.strings.add(class_name)
+        self.dex_count += 1
+
+    def add_apk(self, apk_zip: zipfile.ZipFile):
+        for entry in apk_zip.infolist():
+            if DEX_ENTRY_RE.match(entry.filename):
+                self.add_dex(apk_zip.read(entry))
+
+    def match(
+        self,
+        sign_matcher,
+        stop_signs: typing.Optional[typing.Set[str]]=None,
+        should_stop=None,
+    ) -> typing.Set[str]:
+        """ match all strings in one pass, zero bytes keep signs from
+            spanning two strings
+        """
+        return sign_matcher.match(
+            b'\0'.join(self.strings),
+            stop_signs,
+            should_stop,
+        )
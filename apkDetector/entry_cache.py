@@ -0,0 +1,148 @@
+""" Cross-apk cache of zip entry verdicts
+    Many apks bundle byte-identical sdk jars, native libs and assets. A zip
+    entry is identified by its CRC32 and uncompressed size, so once such an
+    entry is scanned, the signs it matched are stored in a sqlite file shared
+    by all detection processes and later copies skip the content scan.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import typing
+from sqlite_store import SqliteStore
+
+
+def sign_set_hash(sign_strs: typing.Iterable[str]) -> str:
+    sign_hash = hashlib.sha1()
+    for sign_str in sorted(set(sign_strs)):
+        sign_hash.update(sign_str.encode('utf-8', errors='backslashreplace'))
+        sign_hash.update(b'\n')
+    return sign_hash.hexdigest()
+
+
+class EntryVerdictCache(SqliteStore):
+    """ sqlite-backed cache keyed by (crc, size, scan kind, sign set hash)
+        least recently used verdicts are evicted once max_entries is exceeded
+    """
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS entry_verdict (
+            crc INTEGER,
+            size INTEGER,
+            kind TEXT,
+            sign_hash TEXT,
+            signs TEXT,
+            last_used REAL,
+            PRIMARY KEY (crc, size, kind, sign_hash)
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS entry_verdict_last_used ON entry_verdict (last_used)',
+    )
+
+    def __init__(
+        self,
+        cache_file,
+        sign_strs,
+        max_entries=1000000,
+        evict_interval=1000,
+        timeout=60,
+    ):
+        self.cache_file = cache_file
+        self.sign_hash = sign_set_hash(sign_strs)
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self.put_count = 0
+        self.hit_count = 0
+        self.miss_count = 0
+        # keys of hits since the last flush -> last use, written in one
+        # transaction so that hits do not take the write lock one by one
+        self.touched = {}
+        # the connection is opened lazily, so that the cache object can be
+        # created before worker processes start
+        super().__init__(cache_file, timeout=timeout)
+
+    def get(self, crc, size, kind) -> typing.Optional[typing.Set[str]]:
+        try:
+            conn = self.connect()
+            row = conn.execute(
+                'SELECT signs FROM entry_verdict WHERE crc=? AND size=? AND kind=? AND sign_hash=?',
+                (crc, size, kind, self.sign_hash),
+            ).fetchone()
+            if row is None:
+                self.miss_count += 1
+                return None
+        except sqlite3.Error as e:
+            logging.debug('entry cache lookup failed: %s', e)
+            return None
+        self.hit_count += 1
+        self.touched[(crc, size, kind)] = time.time()
+        if self.hit_count % self.evict_interval == 0:
+            self.flush_touched()
+        return set(json.loads(row[0]))
+
+    def flush_touched(self):
+        """ write the last use of the buffered hits
+        """
+        if len(self.touched) == 0:
+            return
+        rows = [
+            (last_used, crc, size, kind, self.sign_hash)
+            for (crc, size, kind), last_used in self.touched.items()
+        ]
+        self.touched = {}
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN')
+            conn.executemany(
+                'UPDATE entry_verdict SET last_used=? WHERE crc=? AND size=? AND kind=? AND sign_hash=?',
+                rows,
+            )
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            logging.debug('entry cache touch failed: %s', e)
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+
+    def put(self, crc, size, kind, matched_signs):
+        try:
+            conn = self.connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO entry_verdict VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    crc,
+                    size,
+                    kind,
+                    self.sign_hash,
+                    json.dumps(sorted(matched_signs)),
+                    time.time(),
+                ),
+            )
+            self.put_count += 1
+            if self.put_count % self.evict_interval == 0:
+                self.evict()
+        except sqlite3.Error as e:
+            logging.debug('entry cache insert failed: %s', e)
+
+    def evict(self):
+        """ drop least recently used verdicts down to 90% of max_entries
+        """
+        self.flush_touched()
+        conn = self.connect()
+        entry_count = conn.execute('SELECT COUNT(*) FROM entry_verdict').fetchone()[0]
+        if entry_count <= self.max_entries:
+            return
+        evict_count = entry_count - int(self.max_entries * 0.9)
+        conn.execute(
+            """
+            DELETE FROM entry_verdict WHERE rowid IN (
+                SELECT rowid FROM entry_verdict ORDER BY last_used LIMIT ?
+            )
+            """,
+            (evict_count,),
+        )
+        logging.info(
+            'evicted %d of %d cached entry verdicts',
+            evict_count,
+            entry_count,
+        )
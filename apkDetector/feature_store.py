@@ -0,0 +1,233 @@
+""" Per-apk feature store for incremental re-detection
+    For every detected apk, the zip entry names, the dex string pools and the
+    printable strings of all other entries are kept in a sqlite file. When the
+    sign file changes, new signs are matched against the stored features
+    instead of downloading and unpacking the apk again.
+"""
+import logging
+import re
+import sqlite3
+import typing
+import zipfile
+import zlib
+import dex_parser
+from sqlite_store import SqliteStore
+
+MEDIA_RE = re.compile(r'.*\.(png|jpeg|gif|jpg|mp3|mp4)$', re.I)
+
+
+class StringFinder(object):
+    """ findall over a stream fed chunk by chunk
+        a string running into the end of a chunk is carried over to the next
+        one (cut if longer than a chunk), otherwise the last overlap bytes are
+        carried so that short starts of strings are not lost; this may yield
+        suffixes of strings already found, which are harmless for matching
+    """
+    def __init__(self, string_re, overlap, chunk_size=64*1024*1024):
+        self.string_re = string_re
+        self.overlap = overlap
+        self.chunk_size = chunk_size
+        self.carry = b''
+
+    def feed(self, chunk) -> typing.List[bytes]:
+        buf = self.carry + chunk
+        self.carry = buf[-self.overlap:]
+        found = []
+        for m in self.string_re.finditer(buf):
+            if m.end() == len(buf) and m.end() - m.start() < self.chunk_size:
+                self.carry = m.group()
+                break
+            found.append(m.group())
+        return found
+
+    def finish(self) -> typing.List[bytes]:
+        found = [
+            m.group()
+            for m in self.string_re.finditer(self.carry)
+            if m.end() == len(self.carry)
+        ]
+        self.carry = b''
+        return found
+
+
+def find_strings_stream(
+    fd,
+    string_re,
+    overlap,
+    chunk_size=64*1024*1024,
+) -> typing.Iterator[bytes]:
+    """ findall over a binary file object, chunk by chunk, see StringFinder
+    """
+    finder = StringFinder(string_re, overlap, chunk_size)
+    while True:
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            break
+        yield from finder.feed(chunk)
+    yield from finder.finish()
+
+
+class FeatureReader(object):
+    """ file object wrapper that finds strings in whatever is read through it,
+        so that the features of an entry come with the read that matches it
+    """
+    def __init__(self, fd, finders, features, chunk_size):
+        self.fd = fd
+        # (StringFinder, whether its strings are utf-16)
+        self.finders = finders
+        self.features = features
+        self.chunk_size = chunk_size
+
+    def add(self, strings, is_utf16):
+        if is_utf16:
+            self.features.update(item.replace(b'\x00', b'') for item in strings)
+        else:
+            self.features.update(strings)
+
+    def read(self, size=-1) -> bytes:
+        data = self.fd.read(size)
+        if data:
+            for finder, is_utf16 in self.finders:
+                self.add(finder.feed(data), is_utf16)
+        return data
+
+    def drain(self):
+        """ read what the caller left, e.g. after an early stop
+        """
+        while self.read(self.chunk_size):
+            pass
+        for finder, is_utf16 in self.finders:
+            self.add(finder.finish(), is_utf16)
+
+
+class FeatureCollector(object):
+    """ features of a single apk, gathered entry by entry
+        any ascii sign of at least min_len chars found in the apk content is
+        also found in the collected strings
+    """
+    def __init__(
+        self,
+        min_len=4,
+        media_re=MEDIA_RE,
+        max_entry_size=None,
+        memory_budget=256*1024*1024,
+    ):
+        self.min_len = min_len
+        self.media_re = media_re
+        self.max_entry_size = max_entry_size
+        self.memory_budget = memory_budget
+        self.ascii_re = re.compile(b'[\\x20-\\x7e]{%d,}' % min_len)
+        self.utf16_re = re.compile(b'(?:[\\x20-\\x7e]\\x00){%d,}' % min_len)
+        self.chunk_size = max(1024*1024, memory_budget // 4)
+        self.features = set()
+
+    def add_name(self, entry):
+        self.features.add(entry.filename.encode('utf-8', errors='backslashreplace'))
+
+    def wants(self, entry) -> bool:
+        """ whether the content of a zip entry is worth its strings
+        """
+        if entry.is_dir() or self.media_re.match(entry.filename):
+            return False
+        return self.max_entry_size is None or entry.file_size <= self.max_entry_size
+
+    def add_dex(self, dex_index: dex_parser.DexStringIndex):
+        self.features |= dex_index.strings
+
+    def reader(self, fd, filename) -> FeatureReader:
+        finders = [(StringFinder(self.ascii_re, self.min_len, self.chunk_size), False)]
+        if filename.endswith(('.xml', '.arsc')):
+            finders.append(
+                (StringFinder(self.utf16_re, 2 * self.min_len, self.chunk_size), True)
+            )
+        return FeatureReader(fd, finders, self.features, self.chunk_size)
+
+    def add_content(self, apk_zip, entry):
+        """ strings of an entry nobody else reads
+        """
+        # dex parsing needs the whole dex in memory
+        if (
+            dex_parser.DEX_ENTRY_RE.match(entry.filename)
+            and entry.file_size <= self.memory_budget // 2
+        ):
+            dex_index = dex_parser.DexStringIndex()
+            try:
+                dex_index.add_dex(apk_zip.read(entry))
+                self.add_dex(dex_index)
+                return
+            except Exception as e:
+                logging.debug('extract raw strings from bad dex: %s', e)
+        with apk_zip.open(entry) as entry_fd:
+            self.reader(entry_fd, entry.filename).drain()
+
+
+def extract_apk_features(
+    apk_file,
+    min_len=4,
+    media_re=MEDIA_RE,
+    max_entry_size=None,
+    memory_budget=256*1024*1024,
+) -> typing.Set[bytes]:
+    """ features of an apk read on their own, ApkDetector.detect collects the
+        same while matching
+    """
+    collector = FeatureCollector(min_len, media_re, max_entry_size, memory_budget)
+    with zipfile.ZipFile(apk_file) as apk_zip:
+        for entry in apk_zip.infolist():
+            if entry.is_dir():
+                continue
+            collector.add_name(entry)
+            if collector.wants(entry):
+                collector.add_content(apk_zip, entry)
+    return collector.features
+
+
+def pack_features(features: typing.Set[bytes]) -> bytes:
+    """ as kept in the store, cheap to send between processes
+    """
+    return zlib.compress(b'\0'.join(sorted(features)))
+
+
+class FeatureStore(SqliteStore):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS apk_features (id TEXT PRIMARY KEY, features BLOB)',
+    )
+
+    def __init__(
+        self,
+        store_file,
+        timeout=60,
+    ):
+        self.store_file = store_file
+        super().__init__(store_file, timeout=timeout)
+
+    def put(self, apk_id, features: typing.Set[bytes]):
+        self.connect().execute(
+            'INSERT OR REPLACE INTO apk_features VALUES (?, ?)',
+            (apk_id, pack_features(features)),
+        )
+
+    def put_many(self, rows: typing.List[tuple]):
+        """ (apk_id, pack_features(...)) rows in a single transaction
+        """
+        if len(rows) == 0:
+            return
+        conn = self.connect()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO apk_features VALUES (?, ?)', rows)
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, apk_id) -> typing.Optional[bytes]:
+        """ return the zero separated feature strings of an apk
+        """
+        row = self.connect().execute(
+            'SELECT features FROM apk_features WHERE id=?',
+            (apk_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0])
@@ -6,16 +6,72 @@ import threading
 import queue
 import sys, os
 import traceback
-import datetime
+import heapq
+import itertools
+import random
+from androzoo_index import AndroZooIndex, select_csv
+from apk_cache import fetch_cached_apk
 ''' utils to download apks from androzoo
 '''
 
-global_download_task_queue = queue.Queue()
+ANDROZOO_DOWNLOAD_URL = 'https://androzoo.uni.lu/api/download?apikey={api_key}&sha256={sha256}'
+
+# retries go ahead of new tasks, sentinels after everything, except the
+# sentinels of a timeout that stop the threads after their current download
+TASK_PRIORITY_ABORT = -1
+TASK_PRIORITY_RETRY = 0
+TASK_PRIORITY_NEW = 1
+TASK_PRIORITY_STOP = 2
+
+# entries are (priority, seq, task), a task of None stops a download thread
+global_download_task_queue = queue.PriorityQueue()
+global_download_task_seq = itertools.count()
 global_download_result_queue = queue.Queue()
 global_is_stop = False
 global_overall_start_time = time.time()
 global_download_done_count = 0
 global_download_error_count = 0
+# tasks neither downloaded nor given up
+global_download_pending_count = 0
+
+
+def hash_partial_file(
+    part_file,
+    chunk_size=10240*1024,
+    chunk_callback=None,
+):
+    """ rebuild the sha256 state and size from an interrupted download, the
+        bytes are passed to chunk_callback on the same read
+    """
+    new_sha256 = hashlib.sha256()
+    part_size = 0
+    if os.path.exists(part_file):
+        with open(part_file, 'rb') as fd:
+            while True:
+                data = fd.read(chunk_size)
+                if not data:
+                    break
+                new_sha256.update(data)
+                part_size += len(data)
+                if chunk_callback is not None:
+                    chunk_callback(data)
+    return new_sha256, part_size
+
+
+def part_size_of(part_file) -> int:
+    """ bytes of an interrupted download to resume from
+    """
+    if os.path.exists(part_file):
+        return os.path.getsize(part_file)
+    return 0
+
+
+def remove_part_file(result_file):
+    """ drop the part file of a download that is not retried
+    """
+    part_file = result_file + '.part'
+    if os.path.exists(part_file):
+        os.remove(part_file)
 
 
 def download_apk(
@@ -25,21 +81,57 @@ def download_apk(
     request_session=None,
     chunk_size=10240*1024,
     timeout=(60, 60),
+    chunk_callback=None, # called with every downloaded chunk
+    apk_cache=None, # LocalApkCache or HttpApkCache tried before AndroZoo
 ):
-    url = 'https://androzoo.uni.lu/api/download?apikey={api_key}&sha256={sha256}'.format(
+    """ download into result_file.part, resuming it with a Range request if
+        it exists, and rename it to result_file once the sha256 matches
+    """
+    if apk_cache is not None and fetch_cached_apk(
+        apk_cache,
+        sha256,
+        result_file,
+        chunk_size,
+        chunk_callback,
+    ):
+        return True
+    url = ANDROZOO_DOWNLOAD_URL.format(
         api_key=api_key,
         sha256=sha256,
     )
     start_time = time.time()
+    part_file = result_file + '.part'
+    # hashed only once the server accepts the range
+    part_size = part_size_of(part_file)
+    headers = {}
+    if part_size > 0:
+        headers['Range'] = 'bytes={0}-'.format(part_size)
     if request_session is None:
-        response = requests.get(url, stream=True, timeout=timeout)
+        response = requests.get(url, stream=True, timeout=timeout, headers=headers)
     else:
-        response = request_session.get(url, stream=True, timeout=timeout)
-    new_sha256 = hashlib.sha256()
-    with open(result_file, 'wb') as fd:
-        for data in response.iter_content(chunk_size=chunk_size):
-            new_sha256.update(data)
-            fd.write(data)
+        response = request_session.get(url, stream=True, timeout=timeout, headers=headers)
+    # throttled or server errors are worth a retry, not a hash mismatch
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+    if part_size > 0 and response.status_code == 416:
+        # the part file is already complete
+        response.close()
+        new_sha256, _ = hash_partial_file(part_file, chunk_size, chunk_callback)
+    else:
+        if part_size > 0 and response.status_code == 206:
+            logging.debug('resume downloading %s from byte %d', sha256[-6:], part_size)
+            new_sha256, _ = hash_partial_file(part_file, chunk_size, chunk_callback)
+            mode = 'ab'
+        else:
+            # no part file, or the range was ignored
+            new_sha256 = hashlib.sha256()
+            mode = 'wb'
+        with open(part_file, mode) as fd:
+            for data in response.iter_content(chunk_size=chunk_size):
+                new_sha256.update(data)
+                fd.write(data)
+                if chunk_callback is not None:
+                    chunk_callback(data)
     end_time = time.time()
     logging.debug(
         'time cost for downloading %s is %d seconds',
@@ -52,7 +144,11 @@ def download_apk(
             sha256.lower(),
             new_sha256.hexdigest().lower(),
         )
+        os.remove(part_file)
         return False
+    os.replace(part_file, result_file)
+    if apk_cache is not None:
+        apk_cache.put(sha256, result_file)
     return True
 
 
@@ -79,71 +175,138 @@ def alive_message(
             break
 
 
+def put_download_task(
+    download_task,
+    priority=TASK_PRIORITY_NEW,
+):
+    global global_download_task_queue
+    global_download_task_queue.put(
+        (priority, next(global_download_task_seq), download_task)
+    )
+
+
+def put_until(
+    task_queue,
+    item,
+    deadline,
+    put_timeout=60,
+) -> bool:
+    """ blocking put on a bounded queue, give up once the deadline has passed
+    """
+    while True:
+        time_left = deadline - time.time()
+        if time_left <= 0:
+            return False
+        try:
+            task_queue.put(item, timeout=min(put_timeout, time_left))
+            return True
+        except queue.Full:
+            continue
+
+
+def retry_delay(
+    error_count,
+    retry_backoff=30,
+    max_retry_backoff=1800,
+):
+    """ exponential backoff with jitter, so that failed tasks do not hit
+        androzoo again at once and together
+    """
+    delay = min(max_retry_backoff, retry_backoff * 2 ** (error_count - 1))
+    return delay * random.uniform(0.5, 1.5)
+
+
 def dump_download_stat(
     result_file,
     error_file,
     error_count_limit=3,
     dump_interval=5,
+    retry_backoff=30,
+    max_retry_backoff=1800,
+    thread_num=0, # stop thread_num download threads once no task is pending
 ):
     global global_download_task_queue
     global global_download_result_queue
     global global_is_stop
     global global_download_done_count
     global global_download_error_count
+    global global_download_pending_count
 
+    # (retry time, seq, task) of failed tasks waiting for their backoff
+    retry_heap = []
     with open(result_file, 'a') as fd, open(error_file, 'a') as error_fd:
         while True:
-            fd.flush()
-            error_fd.flush()
-            download_result = None
-            if not global_download_result_queue.empty():
+            now = time.time()
+            while len(retry_heap) > 0 and retry_heap[0][0] <= now:
+                retry_time, seq, download_task = heapq.heappop(retry_heap)
+                put_download_task(download_task, TASK_PRIORITY_RETRY)
+            if global_download_pending_count <= 0 or global_is_stop:
+                if not global_is_stop:
+                    global_is_stop = True
+                    for i in range(thread_num):
+                        put_download_task(None, TASK_PRIORITY_STOP)
+                if global_download_result_queue.empty():
+                    break
+            get_timeout = dump_interval
+            if len(retry_heap) > 0:
+                get_timeout = max(0, min(get_timeout, retry_heap[0][0] - now))
+            try:
                 download_result = global_download_result_queue.get(
-                    block=False,
+                    timeout=get_timeout,
                 )
-            if download_result is not None:
-                if download_result.is_done:
-                    fd.write(
-                        '{sha256}\t{result_file}\n'.format(
-                            sha256=download_result.sha256,
-                            result_file=os.path.join(
-                                download_result.result_direct_dir,
-                                download_result.result_file,
-                            )
+            except queue.Empty:
+                fd.flush()
+                error_fd.flush()
+                continue
+            if download_result.is_done:
+                fd.write(
+                    '{sha256}\t{result_file}\n'.format(
+                        sha256=download_result.sha256,
+                        result_file=os.path.join(
+                            download_result.result_direct_dir,
+                            download_result.result_file,
                         )
                     )
-                    global_download_done_count += 1
-                if download_result.is_error:
-                    if download_result.error_type == TaskError.HASH_UNMATCH:
-                        error_fd.write(
-                            '{sha256}\t{result_file}\t{error_type}\t{error_msg}\t{error_count}\n'.format(
-                                sha256=download_result.sha256,
-                                result_file=download_result.result_file,
-                                error_type=download_result.error_type,
-                                error_msg=download_result.error_msg,
-                                error_count=download_result.error_count,
-                            )
-                        )
-                        global_download_error_count += 1
-                    elif download_result.error_count >= error_count_limit:
-                        error_fd.write(
-                            '{sha256}\t{result_file}\t{error_type}\t{error_msg}\t{error_count}\n'.format(
-                                sha256=download_result.sha256,
-                                result_file=download_result.result_file,
-                                error_type=download_result.error_type,
-                                error_msg=download_result.error_msg,
-                                error_count=download_result.error_count,
-                            )
+                )
+                global_download_done_count += 1
+                global_download_pending_count -= 1
+            if download_result.is_error:
+                if (
+                    download_result.error_type == TaskError.HASH_UNMATCH
+                    or download_result.error_count >= error_count_limit
+                ):
+                    error_fd.write(
+                        '{sha256}\t{result_file}\t{error_type}\t{error_msg}\t{error_count}\n'.format(
+                            sha256=download_result.sha256,
+                            result_file=download_result.result_file,
+                            error_type=download_result.error_type,
+                            error_msg=download_result.error_msg,
+                            error_count=download_result.error_count,
                         )
-                        global_download_error_count += 1
-                    else:
-                        download_result.is_error = False
-                        download_result.error_msg = None
-                        download_result.error_type = None
-                        global_download_task_queue.put(download_result)
-            else:
-                time.sleep(dump_interval)
-                if global_download_result_queue.empty() and global_is_stop:
-                    break
+                    )
+                    global_download_error_count += 1
+                    global_download_pending_count -= 1
+                    remove_part_file(os.path.join(
+                        download_result.result_base_dir,
+                        download_result.result_direct_dir,
+                        download_result.result_file,
+                    ))
+                else:
+                    download_result.is_error = False
+                    download_result.error_msg = None
+                    download_result.error_type = None
+                    heapq.heappush(
+                        retry_heap,
+                        (
+                            time.time() + retry_delay(
+                                download_result.error_count,
+                                retry_backoff,
+                                max_retry_backoff,
+                            ),
+                            next(global_download_task_seq),
+                            download_result,
+                        ),
+                    )
 
 class TaskError(object):
     HASH_UNMATCH = 1
@@ -175,16 +338,18 @@ class DownloadTask(object):
 
 
 class DownloadThread(threading.Thread):
+    """ a long-lived worker taking tasks from global_download_task_queue
+        until it gets a None task or global_is_stop is set
+    """
     def __init__(
         self,
-        download_tasks,
         api_key,
         request_session=None,
         sleep_interval=0,
         task_timeout=(60, 120),
+        get_timeout=5,
     ):
         super().__init__()
-        self.download_tasks = download_tasks
         self.api_key = api_key
         if request_session is None:
             self.request_session = requests.Session()
@@ -192,17 +357,27 @@ class DownloadThread(threading.Thread):
             self.request_session = request_session
         self.sleep_internal = sleep_interval
         self.task_timeout = task_timeout
+        self.get_timeout = get_timeout
 
     def run(self):
+        global global_download_task_queue
         global global_download_result_queue
-        for download_task in self.download_tasks:
+        while not global_is_stop:
+            try:
+                priority, seq, download_task = global_download_task_queue.get(
+                    timeout=self.get_timeout,
+                )
+            except queue.Empty:
+                continue
+            if download_task is None:
+                break
             try:
                 result_dir = os.path.join(
                     download_task.result_base_dir,
                     download_task.result_direct_dir,
                 )
                 if not os.path.exists(result_dir):
-                    os.makedirs(result_dir)
+                    os.makedirs(result_dir, exist_ok=True)
                 result_file = os.path.join(
                     result_dir,
                     download_task.result_file,
@@ -211,6 +386,7 @@ class DownloadThread(threading.Thread):
                     sha256=download_task.sha256,
                     result_file=result_file,
                     api_key=self.api_key,
+                    request_session=self.request_session,
                     timeout=self.task_timeout,
                 )
                 if download_result == False:
@@ -227,6 +403,8 @@ class DownloadThread(threading.Thread):
                 download_task.error_msg = 'exception: {0}'.format(e)
                 download_task.error_count += 1
             global_download_result_queue.put(download_task)
+            if self.sleep_internal > 0:
+                time.sleep(self.sleep_internal)
 
 
 if __name__ == '__main__':
@@ -239,31 +417,29 @@ if __name__ == '__main__':
     parser.add_argument('download_result_dir', type=str)
     parser.add_argument('api_key_file', type=str)
     parser.add_argument('-tn', '--thread_num', type=int, default=10)
-    parser.add_argument('-ttu', '--thread_task_unit', type=int, default=10)
+    parser.add_argument('-ttu', '--thread_task_unit', type=int, default=None, help='deprecated, download threads take one task at a time')
     parser.add_argument('-to', '--timeout', type=int, default=22*3600) # job time
     parser.add_argument('-ecl', '--error_count_limit', type=int, default=3)
+    parser.add_argument('-rb', '--retry_backoff', type=int, default=30, help='seconds before the first retry of a failed task, doubled on every further error')
+    parser.add_argument('-mrb', '--max_retry_backoff', type=int, default=1800)
     parser.add_argument('-adf', '--after_date_filter', type=str, default=None, help='format Y-m-d, e.g, 2017-01-01')
     parser.add_argument('-bdf', '--before_date_filter', type=str, default=None, help='format Y-m-d, e.g, 2017-01-01')
+    parser.add_argument('-ti', '--task_index_file', type=str, default=None, help='columnar index of download_task_file, default download_task_file.idx, built on first use')
     options = parser.parse_args()
+    if options.thread_task_unit is not None:
+        parser.error('-ttu/--thread_task_unit is deprecated: download threads take one task at a time, drop the option')
     download_task_file = options.download_task_file
     download_result_file = options.download_result_file
     download_error_file = options.download_error_file
     download_result_dir = options.download_result_dir
     api_key_file=options.api_key_file
     thread_num = options.thread_num
-    thread_task_unit = options.thread_task_unit
     overall_timeout = options.timeout
     error_count_limit = options.error_count_limit
+    retry_backoff = options.retry_backoff
+    max_retry_backoff = options.max_retry_backoff
     date_filter_str = options.after_date_filter
     before_date_filter_str = options.before_date_filter
-    if date_filter_str is None:
-        date_filter = None
-    else:
-        date_filter = datetime.datetime.strptime(date_filter_str, '%Y-%m-%d')
-    if before_date_filter_str is None:
-        before_date_filter = None
-    else:
-        before_date_filter = datetime.datetime.strptime(before_date_filter_str, '%Y-%m-%d')
     if not os.path.exists(download_result_dir):
         os.makedirs(download_result_dir)
     api_key = None
@@ -277,36 +453,20 @@ if __name__ == '__main__':
         logging.error('no api key provided')
         sys.exit(1)
 
-    apk_to_pkg_dict = {}
-    apk_to_dex_ds_dict = {}
     # load in download tasks
-    with open(download_task_file, 'r') as fd:
-        line_num = 0
-        for line in fd:
-            line_num += 1
-            if line_num == 1:
-                continue
-            attrs = line.strip().split(',')
-            sha256 = attrs[0].lower()
-            dex_ds = attrs[3].split(' ')[0]
-            is_target = False
-            if date_filter:
-                if len(dex_ds) == 0: # some didn't have dex_ds
-                    continue
-                dex_date = datetime.datetime.strptime(dex_ds, '%Y-%m-%d')
-                if date_filter < dex_date:
-                    is_target = True
-            if before_date_filter:
-                if len(dex_ds) == 0: # some didn't have dex_ds
-                    continue
-                dex_date = datetime.datetime.strptime(dex_ds, '%Y-%m-%d')
-                if before_date_filter > dex_date:
-                    is_target = True
-            if (date_filter is not None or before_date_filter is not None) and is_target == False:
-                continue
-            pkg_id = attrs[5].strip('""')
-            apk_to_pkg_dict[sha256] = pkg_id
-            apk_to_dex_ds_dict[sha256] = dex_ds
+    try:
+        task_index = AndroZooIndex.open(download_task_file, options.task_index_file)
+        download_selection = task_index.select(
+            after_ds=date_filter_str,
+            before_ds=before_date_filter_str,
+        )
+    except OSError as e:
+        logging.warning('no androzoo index, parse %s instead: %s', download_task_file, e)
+        download_selection = select_csv(
+            download_task_file,
+            after_ds=date_filter_str,
+            before_ds=before_date_filter_str,
+        )
     # load in previous download results
     init_complte_task_set = set()
     if os.path.exists(download_result_file):
@@ -315,10 +475,10 @@ if __name__ == '__main__':
                 attrs = line.strip().split('\t')
                 sha256 = attrs[0].lower()
                 init_complte_task_set.add(sha256)
-    apk_to_download_list = list(set(apk_to_pkg_dict.keys()) - init_complte_task_set)
+    apk_to_download_list = list(set(download_selection.keys()) - init_complte_task_set)
     logging.info(
         '%d download tasks, %d finished, %d left in this round',
-        len(apk_to_pkg_dict),
+        len(download_selection),
         len(init_complte_task_set),
         len(apk_to_download_list),
     )
@@ -329,9 +489,10 @@ if __name__ == '__main__':
             sha256[-4:-2],
             sha256[-2:],
         )
+        apk_fields = download_selection[sha256]
         result_file = '{pkg_id}_{dex_ds}_{hash}.apk'.format(
-            pkg_id=apk_to_pkg_dict[sha256],
-            dex_ds=apk_to_dex_ds_dict[sha256],
+            pkg_id=apk_fields['pkg_id'],
+            dex_ds=apk_fields['dex_date'],
             hash=sha256[-6:],
         )
         download_task = DownloadTask(
@@ -341,6 +502,9 @@ if __name__ == '__main__':
             result_direct_dir=result_direct_dir,
         )
         download_task_list.append(download_task)
+    for download_task in download_task_list:
+        put_download_task(download_task)
+    global_download_pending_count = len(download_task_list)
     alive_msg_thread = threading.Thread(
         target=alive_message,
         kwargs=dict(
@@ -356,43 +520,34 @@ if __name__ == '__main__':
         kwargs=dict(
             error_count_limit=error_count_limit,
             dump_interval=10,
+            retry_backoff=retry_backoff,
+            max_retry_backoff=max_retry_backoff,
+            thread_num=thread_num,
         ),
     )
     alive_msg_thread.start()
     dump_download_stat_thread.start()
-    download_index = 0
-    request_session = None
-    while download_index < len(download_task_list):
-        timecost = time.time() - global_overall_start_time
-        if timecost >= overall_timeout:
+    # a persistent pool: a slow apk only holds up its own thread
+    download_thread_list = []
+    for i in range(thread_num):
+        download_thread = DownloadThread(
+            api_key=api_key,
+        )
+        download_thread.start()
+        download_thread_list.append(download_thread)
+    logging.info('created %d threads for downloading', len(download_thread_list))
+    while dump_download_stat_thread.is_alive():
+        time_left = overall_timeout - (time.time() - global_overall_start_time)
+        if time_left <= 0:
             break
-        download_thread_list = []
-        for i in range(thread_num):
-            sub_download_task_list = []
-            # prioritize failed task
-            if not global_download_task_queue.empty():
-                for i in range(thread_task_unit):
-                    try:
-                        download_task = global_download_task_queue.get_nowait()
-                        sub_download_task_list.append(download_task)
-                    except Exception as e:
-                        break
-            if len(sub_download_task_list) == 0:
-                sub_download_task_list = download_task_list[download_index:download_index + thread_task_unit]
-            download_thread = DownloadThread(
-                download_tasks=sub_download_task_list,
-                api_key=api_key,
-                request_session=request_session,
-            )
-            download_thread_list.append(download_thread)
-            download_index += thread_task_unit
-            if download_index >= len(download_task_list):
-                break
-        logging.info('created %d threads for downloading', len(download_thread_list))
-        for d_thread in download_thread_list:
-            d_thread.start()
-        for d_thread in download_thread_list:
-            d_thread.join()
+        dump_download_stat_thread.join(timeout=min(time_left, 60))
+    if dump_download_stat_thread.is_alive():
+        # on timeout, threads stop after their current download
+        for i in range(len(download_thread_list)):
+            put_download_task(None, TASK_PRIORITY_ABORT)
+    for d_thread in download_thread_list:
+        d_thread.join()
+    # only now, so that the results of the last downloads are dumped
     global_is_stop = True
     alive_msg_thread.join()
     dump_download_stat_thread.join()
@@ -0,0 +1,237 @@
+""" Rebalancing of the download and detection process pools
+    A supervisor thread in the main process watches how full the task queues
+    are and how fast apks are downloaded and detected, and moves processes to
+    whichever stage is the bottleneck, within the given process and
+    connection limits. A stage whose throughput did not rise after its last
+    added process (e.g., downloads limited by AndroZoo rather than by the
+    processes) gets no further one until it stops being the bottleneck.
+"""
+import logging
+import multiprocessing as mp
+import threading
+import time
+import typing
+
+
+def run_worker(initializer, initargs, target, args):
+    if initializer is not None:
+        initializer(*initargs)
+    target(*args)
+
+
+class WorkerPool(object):
+    """ processes running target(*args, stop_event), each one stops after its
+        current batch once its stop_event is set; processes come from the
+        default multiprocessing context, which the workflow sets to
+        forkserver, so growing from the supervisor thread does not fork a
+        multithreaded parent; initializer(*initargs) runs first in each, as
+        the process does not inherit e.g. the logging setup
+    """
+    def __init__(
+        self,
+        name,
+        target,
+        args,
+        min_size=1,
+        max_size=1,
+        initializer=None,
+        initargs=(),
+    ):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.initializer = initializer
+        self.initargs = initargs
+        self.min_size = min_size
+        self.max_size = max_size
+        # (process, stop_event) of every process started
+        self.workers = []
+        # set once the shutdown Nones were sent, the pool may not grow then
+        self.is_draining = False
+        self.lock = threading.Lock()
+
+    def size(self) -> int:
+        """ processes not asked to stop
+        """
+        with self.lock:
+            return len([
+                worker
+                for worker, stop_event in self.workers
+                if not stop_event.is_set() and worker.is_alive()
+            ])
+
+    def grow(self) -> bool:
+        with self.lock:
+            if self.is_draining:
+                return False
+            live_count = len([
+                worker
+                for worker, stop_event in self.workers
+                if not stop_event.is_set() and worker.is_alive()
+            ])
+            if live_count >= self.max_size:
+                return False
+            stop_event = mp.Event()
+            worker = mp.Process(
+                target=run_worker,
+                args=(
+                    self.initializer,
+                    self.initargs,
+                    self.target,
+                    tuple(self.args) + (stop_event,),
+                ),
+            )
+            worker.start()
+            self.workers.append((worker, stop_event))
+        return True
+
+    def shrink(self) -> bool:
+        with self.lock:
+            live_workers = [
+                (worker, stop_event)
+                for worker, stop_event in self.workers
+                if not stop_event.is_set() and worker.is_alive()
+            ]
+            if len(live_workers) <= self.min_size:
+                return False
+            live_workers[-1][1].set()
+        return True
+
+    def drain(self) -> int:
+        """ stop growing, return the processes still expecting a None
+        """
+        with self.lock:
+            self.is_draining = True
+        return self.size()
+
+    def join(self):
+        for worker, stop_event in self.workers:
+            worker.join()
+
+
+def queue_fill(task_queue, max_size) -> float:
+    if max_size <= 0:
+        return 0
+    try:
+        return task_queue.qsize() / max_size
+    except NotImplementedError:
+        # no qsize on macOS
+        return 0
+
+
+class PoolSupervisor(threading.Thread):
+    def __init__(
+        self,
+        download_pool: WorkerPool,
+        detect_pool: WorkerPool,
+        download_queue,
+        download_queue_size,
+        detect_queue,
+        detect_queue_size,
+        download_counter: typing.Callable[[], int],
+        detect_counter: typing.Callable[[], int],
+        interval=30,
+        patience=2,
+        min_gain=0.1,
+    ):
+        super().__init__(daemon=True)
+        self.download_pool = download_pool
+        self.detect_pool = detect_pool
+        self.download_queue = download_queue
+        self.download_queue_size = download_queue_size
+        self.detect_queue = detect_queue
+        self.detect_queue_size = detect_queue_size
+        self.download_counter = download_counter
+        self.detect_counter = detect_counter
+        self.interval = interval
+        # intervals in a row with the same bottleneck before acting
+        self.patience = patience
+        # relative throughput gain an added process must bring
+        self.min_gain = min_gain
+        # throughput of a stage when it last grew
+        self.grow_rates = {}
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def bottleneck(self, download_fill, detect_fill) -> typing.Optional[str]:
+        if detect_fill >= 0.75:
+            # downloaded apks pile up in front of detection
+            return 'detect'
+        if detect_fill <= 0.25 and download_fill >= 0.5:
+            # detection waits while download tasks are pending
+            return 'download'
+        return None
+
+    def is_gaining(self, stage, rate) -> bool:
+        """ whether the last process added to stage raised its throughput
+        """
+        grow_rate = self.grow_rates.get(stage)
+        return grow_rate is None or rate >= grow_rate * (1 + self.min_gain)
+
+    def run(self):
+        last_bottleneck = None
+        streak = 0
+        last_time = time.time()
+        last_download_count = self.download_counter()
+        last_detect_count = self.detect_counter()
+        while not self.stop_event.wait(self.interval):
+            now = time.time()
+            download_count = self.download_counter()
+            detect_count = self.detect_counter()
+            download_rate = (download_count - last_download_count) / (now - last_time)
+            detect_rate = (detect_count - last_detect_count) / (now - last_time)
+            last_time, last_download_count, last_detect_count = now, download_count, detect_count
+            download_fill = queue_fill(self.download_queue, self.download_queue_size)
+            detect_fill = queue_fill(self.detect_queue, self.detect_queue_size)
+            bottleneck = self.bottleneck(download_fill, detect_fill)
+            if bottleneck is not None and bottleneck == last_bottleneck:
+                streak += 1
+            else:
+                streak = 1 if bottleneck is not None else 0
+            last_bottleneck = bottleneck
+            for stage in list(self.grow_rates):
+                if stage != bottleneck:
+                    del self.grow_rates[stage]
+            logging.info(
+                'pools: %d download, %d detect processes; queues %.0f%%, %.0f%% full; %.2f downloads/s, %.2f detections/s; bottleneck %s',
+                self.download_pool.size(),
+                self.detect_pool.size(),
+                download_fill * 100,
+                detect_fill * 100,
+                download_rate,
+                detect_rate,
+                bottleneck,
+            )
+            if bottleneck is None or streak < self.patience:
+                continue
+            stage_rate = detect_rate if bottleneck == 'detect' else download_rate
+            if not self.is_gaining(bottleneck, stage_rate):
+                logging.info(
+                    'hold %s: %.2f apks/s, %.2f before its last process',
+                    bottleneck,
+                    stage_rate,
+                    self.grow_rates[bottleneck],
+                )
+                streak = 0
+                continue
+            if bottleneck == 'detect':
+                is_grown = self.detect_pool.grow()
+                # at the process limit, free the cores of a download process
+                is_shrunk = not is_grown and self.download_pool.shrink()
+            else:
+                is_grown = self.download_pool.grow()
+                # an idle detection process only holds memory
+                is_shrunk = detect_fill == 0 and self.detect_pool.shrink()
+            if is_grown:
+                self.grow_rates[bottleneck] = stage_rate
+            if is_grown or is_shrunk:
+                logging.info(
+                    'rebalance for %s: grown %s, shrunk %s',
+                    bottleneck,
+                    is_grown,
+                    is_shrunk,
+                )
+                streak = 0
@@ -0,0 +1,179 @@
+""" Adaptive control of concurrent AndroZoo downloads
+    An AIMD window of in-flight downloads shared by all download processes:
+    the window grows by one each interval in which throughput or latency
+    improved, and is cut multiplicatively on 429/5xx responses and timeouts.
+"""
+import logging
+import multiprocessing as mp
+import threading
+import time
+
+
+def is_backoff_error(e, depth=0) -> bool:
+    """ 429/5xx from requests or aiohttp, or a timeout, also when wrapped,
+        e.g., a urllib3 ReadTimeoutError in a requests ConnectionError
+    """
+    status = getattr(e, 'status', None) # aiohttp.ClientResponseError
+    response = getattr(e, 'response', None) # requests.HTTPError
+    if status is None and response is not None:
+        status = getattr(response, 'status_code', None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    if isinstance(e, TimeoutError) or 'timeout' in type(e).__name__.lower():
+        return True
+    if depth >= 4:
+        return False
+    # urllib3 MaxRetryError keeps the error it gave up on in reason
+    wrapped = [e.__cause__, e.__context__, getattr(e, 'reason', None)] + list(e.args)
+    return any(
+        isinstance(item, BaseException) and item is not e and is_backoff_error(item, depth + 1)
+        for item in wrapped
+    )
+
+
+class AimdController(object):
+    """ created in the main process and passed to the download processes as
+        a Process argument, pickled under forkserver with handles to the same
+        shared values and lock; the per-process counters start over in each
+    """
+    def __init__(
+        self,
+        max_window,
+        min_window=1,
+        init_window=None,
+        increase=1,
+        decrease=0.5,
+        interval=30,
+        backoff_gap=5,
+    ):
+        self.max_window = max_window
+        self.min_window = min_window
+        self.increase = increase
+        self.decrease = decrease
+        # seconds between window increases
+        self.interval = interval
+        # at most one multiplicative decrease per backoff_gap seconds
+        self.backoff_gap = backoff_gap
+        if init_window is None:
+            init_window = max(min_window, max_window // 4)
+        self.cond = mp.Condition(mp.Lock())
+        self.window = mp.Value('d', init_window, lock=False)
+        self.in_flight = mp.Value('i', 0, lock=False)
+        # stats of the current interval
+        self.interval_start = mp.Value('d', time.time(), lock=False)
+        self.interval_bytes = mp.Value('d', 0, lock=False)
+        self.interval_latency = mp.Value('d', 0, lock=False)
+        self.interval_done = mp.Value('i', 0, lock=False)
+        self.interval_backoff = mp.Value('i', 0, lock=False)
+        self.last_backoff = mp.Value('d', 0, lock=False)
+        self.last_throughput = mp.Value('d', 0, lock=False)
+        self.last_latency = mp.Value('d', 0, lock=False)
+        # bytes of this process not yet added to interval_bytes, so that
+        # chunks do not take the shared lock
+        self.local_bytes = 0
+        self.local_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['local_lock']
+        state['local_bytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local_lock = threading.Lock()
+
+    def acquire(self, timeout=None) -> bool:
+        """ block until a download may start
+        """
+        with self.cond:
+            is_ok = self.cond.wait_for(
+                lambda: self.in_flight.value < int(self.window.value),
+                timeout=timeout,
+            )
+            if is_ok:
+                self.in_flight.value += 1
+            return is_ok
+
+    def acquire_until(self, deadline) -> bool:
+        """ block until a download may start, False once the wall clock
+            deadline has passed
+        """
+        time_left = deadline - time.time()
+        if time_left <= 0:
+            return False
+        return self.acquire(timeout=time_left)
+
+    def on_chunk(self, data):
+        """ count downloaded bytes, used as chunk_callback of downloads
+        """
+        with self.local_lock:
+            self.local_bytes += len(data)
+
+    def release(
+        self,
+        latency=0, # seconds the download took
+        error=None, # exception raised by the download, if any
+    ):
+        now = time.time()
+        with self.local_lock:
+            local_bytes = self.local_bytes
+            self.local_bytes = 0
+        with self.cond:
+            self.in_flight.value -= 1
+            self.interval_bytes.value += local_bytes
+            if error is not None and is_backoff_error(error):
+                self.interval_backoff.value += 1
+                if now - self.last_backoff.value >= self.backoff_gap:
+                    self.last_backoff.value = now
+                    self.window.value = max(
+                        self.min_window,
+                        self.window.value * self.decrease,
+                    )
+                    logging.info(
+                        'download window backs off to %d after %s',
+                        int(self.window.value),
+                        type(error).__name__,
+                    )
+            elif error is None:
+                self.interval_latency.value += latency
+                self.interval_done.value += 1
+            if now - self.interval_start.value >= self.interval:
+                self.adjust(now)
+            self.cond.notify_all()
+
+    def adjust(self, now):
+        """ additive increase at the end of an interval without backoff in
+            which throughput or latency improved, called with the lock held
+        """
+        throughput = self.interval_bytes.value / (now - self.interval_start.value)
+        latency = 0
+        if self.interval_done.value > 0:
+            latency = self.interval_latency.value / self.interval_done.value
+        is_improved = (
+            throughput > self.last_throughput.value * 1.05
+            or (
+                throughput >= self.last_throughput.value * 0.95
+                and latency <= self.last_latency.value
+            )
+        )
+        if self.interval_backoff.value == 0 and is_improved:
+            self.window.value = min(
+                self.max_window,
+                self.window.value + self.increase,
+            )
+        logging.info(
+            'download window %d, %d in flight, throughput %.2f MB/s, latency %.1f seconds, %d backoffs',
+            int(self.window.value),
+            self.in_flight.value,
+            throughput / 1024 / 1024,
+            latency,
+            self.interval_backoff.value,
+        )
+        self.last_throughput.value = throughput
+        self.last_latency.value = latency
+        self.interval_start.value = now
+        self.interval_bytes.value = 0
+        self.interval_latency.value = 0
+        self.interval_done.value = 0
+        self.interval_backoff.value = 0
@@ -0,0 +1,209 @@
+""" Indexed store of detection results
+    Results are kept in a sqlite file keyed by (apk id, detect tag) instead of
+    an append-only json file, so that checking whether an apk is done is an
+    index lookup and startup does not re-read the whole history. The json
+    lines format stays available through import_jsonl and export_jsonl.
+"""
+import itertools
+import json
+import logging
+import typing
+from sqlite_store import SqliteStore
+
+
+class ResultStore(SqliteStore):
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS detection_result (
+            id TEXT,
+            detect_tag TEXT,
+            is_hit INTEGER,
+            detection_time REAL,
+            result TEXT,
+            PRIMARY KEY (id, detect_tag)
+        )
+        """,
+    )
+
+    def __init__(
+        self,
+        store_file,
+        timeout=60,
+        lookup_batch=500,
+    ):
+        self.store_file = store_file
+        # ids per SELECT ... IN query
+        self.lookup_batch = lookup_batch
+        super().__init__(store_file, timeout=timeout)
+
+    @staticmethod
+    def _row_of(result_item) -> tuple:
+        result_obj = json.loads(result_item)
+        return (
+            result_obj['id'],
+            result_obj.get('detect_tag'),
+            1 if result_obj.get('is_hit') else 0,
+            result_obj.get('detection_time'),
+            result_item,
+        )
+
+    def put_many(self, result_items: typing.Iterable[str]) -> int:
+        """ write json result lines in one transaction, a later result of the
+            same apk and detect tag replaces the earlier one
+        """
+        rows = [self._row_of(item) for item in result_items]
+        if len(rows) == 0:
+            return 0
+        conn = self.connect()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(
+                'INSERT OR REPLACE INTO detection_result VALUES (?, ?, ?, ?, ?)',
+                rows,
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    def is_done(self, apk_id, detect_tag=None) -> bool:
+        """ whether apk_id has a result, of detect_tag if given
+        """
+        if detect_tag is None:
+            row = self.connect().execute(
+                'SELECT 1 FROM detection_result WHERE id=? LIMIT 1',
+                (apk_id,),
+            ).fetchone()
+        else:
+            row = self.connect().execute(
+                'SELECT 1 FROM detection_result WHERE id=? AND detect_tag=?',
+                (apk_id, detect_tag),
+            ).fetchone()
+        return row is not None
+
+    def _select_by_ids(self, columns, apk_ids) -> typing.Iterator[tuple]:
+        conn = self.connect()
+        batch = []
+        for apk_id in apk_ids:
+            batch.append(apk_id)
+            if len(batch) >= self.lookup_batch:
+                yield from conn.execute(
+                    'SELECT {0} FROM detection_result WHERE id IN ({1})'.format(
+                        columns,
+                        ','.join('?' * len(batch)),
+                    ),
+                    batch,
+                )
+                batch = []
+        if len(batch) > 0:
+            yield from conn.execute(
+                'SELECT {0} FROM detection_result WHERE id IN ({1})'.format(
+                    columns,
+                    ','.join('?' * len(batch)),
+                ),
+                batch,
+            )
+
+    def ids(self) -> typing.Iterator[str]:
+        """ the ids with a result of any detect tag, in id order, read off
+            the primary key index
+        """
+        for row in self.connect().execute(
+            'SELECT DISTINCT id FROM detection_result ORDER BY id'
+        ):
+            yield row[0]
+
+    def latest_results(
+        self,
+        apk_ids: typing.Optional[typing.Iterable[str]] = None, # all if None
+    ) -> typing.Iterator[str]:
+        """ the latest json result line of each of apk_ids found in the
+            store; of every apk in id order if apk_ids is None
+        """
+        if apk_ids is None:
+            rows = self.connect().execute(
+                'SELECT id, detection_time, result FROM detection_result ORDER BY id'
+            )
+        else:
+            rows = sorted(self._select_by_ids('id, detection_time, result', apk_ids))
+        for apk_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield max(group, key=lambda row: row[1] or 0)[2]
+
+    def count(self) -> int:
+        return self.connect().execute(
+            'SELECT COUNT(*) FROM detection_result'
+        ).fetchone()[0]
+
+    def import_jsonl(self, result_file, batch_size=10000) -> int:
+        import_count = 0
+        batch = []
+        with open(result_file, 'r') as fd:
+            for line in fd:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                batch.append(line)
+                if len(batch) >= batch_size:
+                    import_count += self.put_many(batch)
+                    batch = []
+        import_count += self.put_many(batch)
+        logging.info('imported %d results from %s', import_count, result_file)
+        return import_count
+
+    def merge(self, store_file) -> int:
+        """ merge the results of another store, e.g., of another node, the
+            later result of an apk and detect tag wins
+        """
+        conn = self.connect()
+        conn.execute('ATTACH DATABASE ? AS other', (store_file,))
+        try:
+            conn.execute('BEGIN')
+            try:
+                merge_count = conn.execute(
+                    """
+                    INSERT OR REPLACE INTO detection_result
+                    SELECT o.id, o.detect_tag, o.is_hit, o.detection_time, o.result
+                    FROM other.detection_result o
+                    LEFT JOIN detection_result m
+                    ON m.id = o.id AND m.detect_tag IS o.detect_tag
+                    WHERE m.id IS NULL
+                    OR IFNULL(o.detection_time, 0) > IFNULL(m.detection_time, 0)
+                    """
+                ).rowcount
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.execute('DETACH DATABASE other')
+        logging.info('merged %d results from %s', merge_count, store_file)
+        return merge_count
+
+    def export_jsonl(self, result_file, detect_tag=None) -> int:
+        """ write results in the format of detection_results.json
+        """
+        export_count = 0
+        conn = self.connect()
+        if detect_tag is None:
+            rows = conn.execute(
+                'SELECT result FROM detection_result ORDER BY detection_time'
+            )
+        else:
+            rows = conn.execute(
+                'SELECT result FROM detection_result WHERE detect_tag=? ORDER BY detection_time',
+                (detect_tag,),
+            )
+        with open(result_file, 'w') as fd:
+            for row in rows:
+                fd.write(row[0] + '\n')
+                export_count += 1
+        logging.info('exported %d results to %s', export_count, result_file)
+        return export_count
+
+
+def is_result_store(result_file) -> bool:
+    """ whether result_file is a sqlite store rather than json lines
+    """
+    with open(result_file, 'rb') as fd:
+        return fd.read(16) == b'SQLite format 3\x00'
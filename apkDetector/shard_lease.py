@@ -0,0 +1,275 @@
+""" Leases on shards of the apk list for runs on several nodes
+    Apks are split into shard_count contiguous ranges of their sha256 prefix.
+    A node works on a shard while it holds its lease, a file in a directory
+    shared by all nodes (e.g., over nfs). Leases carry an expiry time and are
+    renewed by a thread of the holder; the shard of a lost node is taken over
+    once its lease expired by creating the next lease generation with
+    O_EXCL, so only one node wins. A done marker keeps a finished shard from
+    being leased again; it is written as soon as every apk fed from the shard
+    has a result or was given up on (see ShardProgress), so a crash only
+    redoes the shards the node was still working on.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import typing
+import zlib
+
+
+def shard_of(apk_id, shard_count) -> int:
+    """ shard of a sha256, by its 32-bit prefix
+    """
+    return int(apk_id[:8], 16) * shard_count >> 32
+
+
+class ShardLeaser(object):
+    def __init__(
+        self,
+        lease_dir,
+        shard_count,
+        node_id,
+        lease_ttl=600,
+    ):
+        self.lease_dir = lease_dir
+        self.shard_count = shard_count
+        self.node_id = node_id
+        # seconds a lease lasts without renewal
+        self.lease_ttl = lease_ttl
+        # shard -> lease generation held by this node
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.renew_thread = None
+        if not os.path.exists(lease_dir):
+            os.makedirs(lease_dir, exist_ok=True)
+
+    def lease_file(self, shard, generation) -> str:
+        return os.path.join(
+            self.lease_dir,
+            'shard-{0:05d}.lease.{1}'.format(shard, generation),
+        )
+
+    def done_file(self, shard) -> str:
+        return os.path.join(
+            self.lease_dir,
+            'shard-{0:05d}.done'.format(shard),
+        )
+
+    def scan(self) -> typing.Tuple[typing.Dict[int, int], typing.Set[int]]:
+        """ latest lease generation of every leased shard, and done shards
+        """
+        generations = {}
+        done_shards = set()
+        for name in os.listdir(self.lease_dir):
+            if not name.startswith('shard-'):
+                continue
+            attrs = name.split('.')
+            try:
+                shard = int(attrs[0][len('shard-'):])
+                if len(attrs) == 2 and attrs[1] == 'done':
+                    done_shards.add(shard)
+                elif len(attrs) == 3 and attrs[1] == 'lease':
+                    generations[shard] = max(generations.get(shard, -1), int(attrs[2]))
+            except ValueError:
+                continue
+        return generations, done_shards
+
+    def read_lease(self, shard, generation) -> typing.Optional[dict]:
+        try:
+            with open(self.lease_file(shard, generation), 'r') as fd:
+                return json.loads(fd.read())
+        except (OSError, ValueError):
+            # being written or replaced, try again later
+            return None
+
+    def write_lease(self, shard, generation, is_new=False) -> bool:
+        lease_str = json.dumps(dict(
+            node_id=self.node_id,
+            expire_time=time.time() + self.lease_ttl,
+        ))
+        lease_file = self.lease_file(shard, generation)
+        if is_new:
+            try:
+                fd = os.open(lease_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                return False
+            with os.fdopen(fd, 'w') as lease_fd:
+                lease_fd.write(lease_str)
+            return True
+        tmp_file = '{0}.{1}.tmp'.format(lease_file, self.node_id)
+        with open(tmp_file, 'w') as lease_fd:
+            lease_fd.write(lease_str)
+        os.replace(tmp_file, lease_file)
+        return True
+
+    def acquire(self) -> typing.Optional[int]:
+        """ lease a shard that is free, expired or left by this node before a
+            restart, None if there is none
+        """
+        generations, done_shards = self.scan()
+        # start at a node specific shard to keep nodes apart
+        start = shard_of(
+            '{0:08x}'.format(zlib.crc32(self.node_id.encode('utf-8'))),
+            self.shard_count,
+        )
+        for offset in range(self.shard_count):
+            shard = (start + offset) % self.shard_count
+            if shard in done_shards or shard in self.held:
+                continue
+            generation = generations.get(shard)
+            if generation is None:
+                generation = 0
+            else:
+                lease = self.read_lease(shard, generation)
+                if lease is None:
+                    continue
+                if lease['node_id'] != self.node_id and lease['expire_time'] > time.time():
+                    continue
+                logging.info(
+                    'take over shard %d from node %s',
+                    shard,
+                    lease['node_id'],
+                )
+                generation += 1
+            if not self.write_lease(shard, generation, is_new=True):
+                # another node was faster
+                continue
+            for old_generation in range(generation):
+                try:
+                    os.remove(self.lease_file(shard, old_generation))
+                except OSError:
+                    pass
+            with self.lock:
+                self.held[shard] = generation
+            return shard
+        return None
+
+    def renew(self):
+        """ extend the held leases, drop those taken over by another node
+        """
+        generations, done_shards = self.scan()
+        with self.lock:
+            for shard, generation in list(self.held.items()):
+                if generations.get(shard, generation) > generation:
+                    logging.warning('lost the lease of shard %d', shard)
+                    del self.held[shard]
+                    continue
+                self.write_lease(shard, generation)
+
+    def renew_loop(self):
+        while not self.stop_event.wait(self.lease_ttl / 3):
+            try:
+                self.renew()
+            except OSError as e:
+                logging.warning('error when renewing shard leases: %s', e)
+
+    def start(self):
+        self.renew_thread = threading.Thread(target=self.renew_loop, daemon=True)
+        self.renew_thread.start()
+
+    def iter_shards(self, deadline=None) -> typing.Iterator[int]:
+        """ lease shards one by one until none is left or the wall clock
+            deadline has passed
+        """
+        while deadline is None or time.time() < deadline:
+            shard = self.acquire()
+            if shard is None:
+                break
+            yield shard
+
+    def mark_done(self, shard):
+        """ write the done marker of a held shard and drop its lease
+        """
+        with self.lock:
+            generation = self.held.pop(shard, None)
+        if generation is None:
+            # taken over by another node meanwhile
+            return
+        with open(self.done_file(shard), 'w') as fd:
+            fd.write(json.dumps(dict(
+                node_id=self.node_id,
+                done_time=time.time(),
+            )))
+        try:
+            os.remove(self.lease_file(shard, generation))
+        except OSError:
+            pass
+        logging.info('node %s finished shard %d', self.node_id, shard)
+
+    def release(self, shard):
+        """ give up a held shard, another node may lease it at once
+        """
+        with self.lock:
+            generation = self.held.pop(shard, None)
+        if generation is None:
+            return
+        try:
+            os.remove(self.lease_file(shard, generation))
+        except OSError:
+            pass
+        logging.info('node %s released shard %d', self.node_id, shard)
+
+    def finish(self, is_done=True):
+        """ stop renewing and mark the shards still held done, or leave them
+            to expire if not is_done
+        """
+        self.stop_event.set()
+        if self.renew_thread is not None:
+            self.renew_thread.join()
+        with self.lock:
+            held_shards = list(self.held)
+            if not is_done:
+                logging.info(
+                    'node %s leaves %d unfinished shards to expire',
+                    self.node_id,
+                    len(held_shards),
+                )
+                self.held = {}
+                return
+        for shard in held_shards:
+            self.mark_done(shard)
+
+
+class ShardProgress(object):
+    """ apks fed from each leased shard that have neither a result nor were
+        given up on, a shard is marked done once none is left
+    """
+    def __init__(
+        self,
+        shard_leaser: ShardLeaser,
+    ):
+        self.shard_leaser = shard_leaser
+        # apk id -> shard, of apks not settled yet
+        self.apk_shards = {}
+        # shard -> number of its apks not settled yet
+        self.pending_counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, shard, apk_ids: typing.List[str]):
+        """ track the apks of shard, before they are fed
+        """
+        if len(apk_ids) == 0:
+            self.shard_leaser.mark_done(shard)
+            return
+        with self.lock:
+            for apk_id in apk_ids:
+                self.apk_shards[apk_id] = shard
+            self.pending_counts[shard] = len(apk_ids)
+
+    def settle(self, apk_ids: typing.Iterable[str]):
+        """ apks whose result was written or that were given up on
+        """
+        done_shards = []
+        with self.lock:
+            for apk_id in apk_ids:
+                shard = self.apk_shards.pop(apk_id, None)
+                if shard is None:
+                    continue
+                self.pending_counts[shard] -= 1
+                if self.pending_counts[shard] == 0:
+                    del self.pending_counts[shard]
+                    done_shards.append(shard)
+        for shard in done_shards:
+            self.shard_leaser.mark_done(shard)
@@ -0,0 +1,164 @@
+""" Multi-pattern matching of apk signs
+    All sign strings are compiled into a single trie-shaped regular expression,
+    so one pass over a buffer reports every sign that occurs in it, instead of
+    one `in` check per sign.
+"""
+import re
+import typing
+
+# called with the signs found so far, whether the verdict needs no more
+StopCheck = typing.Callable[[typing.Set[str]], bool]
+
+
+class SignMatcher(object):
+    """ Precompiled multi-pattern matcher over bytes
+
+    The trie of all sign patterns is turned into a regular expression wrapped
+    in a lookahead, so the re engine walks the trie from every position of the
+    buffer in C. At each position the longest matching pattern wins; shorter
+    patterns contained in it are added back through `implied`.
+    """
+    def __init__(
+        self,
+        sign_strs: typing.Iterable[str],
+        encoding: str='utf-8',
+    ):
+        self.encoding = encoding
+        # byte pattern -> sign str
+        self.patterns = {}
+        for sign_str in sign_strs:
+            pattern = sign_str.encode(
+                encoding=self.encoding,
+                errors='backslashreplace',
+            )
+            if len(pattern) == 0:
+                continue
+            self.patterns[pattern] = sign_str
+        self.max_len = max([len(p) for p in self.patterns], default=0)
+        # every pattern implies the patterns it contains
+        self.implied = {}
+        for pattern, sign_str in self.patterns.items():
+            self.implied[pattern] = set([
+                other_sign
+                for other, other_sign in self.patterns.items()
+                if other in pattern
+            ])
+        self.regex = None
+        if len(self.patterns) > 0:
+            self.regex = re.compile(
+                b'(?=(' + self._build_trie_re(self.patterns.keys()) + b'))',
+                re.S,
+            )
+
+    @staticmethod
+    def _build_trie_re(patterns) -> bytes:
+        trie = {}
+        for pattern in patterns:
+            node = trie
+            for c in pattern:
+                node = node.setdefault(c, {})
+            node[None] = True
+
+        def build(node) -> bytes:
+            alts = [
+                re.escape(bytes([c])) + build(node[c])
+                for c in sorted(k for k in node if k is not None)
+            ]
+            if len(alts) == 0:
+                return b''
+            if len(alts) == 1:
+                body = alts[0]
+            else:
+                body = b'(?:' + b'|'.join(alts) + b')'
+            # greedy optional: prefer the longer pattern at this position
+            if None in node:
+                return b'(?:' + body + b')?'
+            return body
+
+        return build(trie)
+
+    def match(
+        self,
+        buf,
+        stop_signs: typing.Optional[typing.Set[str]]=None,
+        should_stop: typing.Optional[StopCheck]=None,
+    ) -> typing.Set[str]:
+        """ return sign strs found in buf (bytes, bytearray, memoryview or mmap)
+            stop scanning early once all of stop_signs are found, or at the
+            first hit should_stop accepts
+        """
+        matched_signs = set()
+        if self.regex is None:
+            return matched_signs
+        for m in self.regex.finditer(buf):
+            matched_signs |= self.implied[m.group(1)]
+            if stop_signs is not None and stop_signs <= matched_signs:
+                break
+            if should_stop is not None and should_stop(matched_signs):
+                break
+        return matched_signs
+
+    def contains_any(self, buf) -> bool:
+        """ whether any sign occurs in buf, stops at the first one
+        """
+        return self.regex is not None and self.regex.search(buf) is not None
+
+    def match_stream(
+        self,
+        fd,
+        stop_signs: typing.Optional[typing.Set[str]]=None,
+        chunk_size: int=1024*1024,
+        should_stop: typing.Optional[StopCheck]=None,
+    ) -> typing.Set[str]:
+        """ match a binary file object chunk by chunk
+        """
+        sign_stream = SignStream(self)
+        while True:
+            chunk = fd.read(chunk_size)
+            if not chunk:
+                break
+            sign_stream.feed(chunk, stop_signs, should_stop)
+            if stop_signs is not None and stop_signs <= sign_stream.matched_signs:
+                break
+            if sign_stream.is_stopped:
+                break
+        return sign_stream.matched_signs
+
+
+class SignStream(object):
+    """ Push-style matching of a byte stream, e.g., chunks of a download
+        consecutive chunks overlap by max_len - 1 bytes so that no sign
+        spanning a chunk boundary is missed
+    """
+    def __init__(
+        self,
+        sign_matcher: SignMatcher,
+    ):
+        self.sign_matcher = sign_matcher
+        self.matched_signs = set()
+        self.tail = b''
+        # should_stop accepted the signs found, later chunks are ignored
+        self.is_stopped = False
+
+    def feed(
+        self,
+        chunk: bytes,
+        stop_signs: typing.Optional[typing.Set[str]]=None,
+        should_stop: typing.Optional[StopCheck]=None,
+    ):
+        if self.sign_matcher.regex is None or self.is_stopped:
+            return
+        buf = self.tail + chunk
+        stream_should_stop = None
+        if should_stop is not None:
+            stream_should_stop = lambda found: should_stop(self.matched_signs | found)
+        self.matched_signs |= self.sign_matcher.match(
+            buf,
+            None if stop_signs is None else stop_signs - self.matched_signs,
+            stream_should_stop,
+        )
+        if should_stop is not None and should_stop(self.matched_signs):
+            self.is_stopped = True
+            return
+        overlap = self.sign_matcher.max_len - 1
+        self.tail = buf[-overlap:] if overlap > 0 else b''
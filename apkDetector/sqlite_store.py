@@ -0,0 +1,53 @@
+""" Base of the sqlite-backed stores
+    A store opens its connection lazily, one per process: worker processes
+    are not forked, they get a pickled copy without the connection and open
+    their own on first use. Subclasses list their pragmas and schema.
+"""
+import os
+import sqlite3
+import typing
+
+
+class SqliteStore(object):
+    # run on every new connection
+    pragmas: typing.Sequence[str] = (
+        'journal_mode=WAL',
+        'synchronous=NORMAL',
+    )
+    # CREATE ... IF NOT EXISTS statements
+    schema: typing.Sequence[str] = ()
+
+    def __init__(
+        self,
+        db_file,
+        timeout=60,
+    ):
+        self.db_file = db_file
+        self.timeout = timeout
+        self.conn = None
+        self.conn_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conn'] = None
+        state['conn_pid'] = None
+        return state
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is not None and self.conn_pid == os.getpid():
+            return self.conn
+        db_dir = os.path.dirname(self.db_file)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(
+            self.db_file,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.conn_pid = os.getpid()
+        for pragma in self.pragmas:
+            self.conn.execute('PRAGMA ' + pragma)
+        for statement in self.schema:
+            self.conn.execute(statement)
+        return self.conn
@@ -0,0 +1,132 @@
+""" Write-ahead journal of apk task states
+    The main process appends one line per state transition of an apk
+    (queued, downloaded, detecting, then done or dropped) before or right
+    after handing it to the next stage, so that a restart knows which apks
+    were already downloaded when the previous run died and can feed them
+    straight into detection. The journal is compacted to the states of apks
+    downloaded but not yet finished on open, on close and every
+    compact_every records. Queued apks are
+    left out: a restart queues every apk without a result again, and the
+    download of an apk that failed for good never leaves the queued state.
+"""
+import logging
+import os
+import threading
+import typing
+
+
+class TaskState(object):
+    QUEUED = 'queued' # on the download task queue, dropped on compaction
+    DOWNLOADED = 'downloaded' # apk file written to apk_base_dir
+    DETECTING = 'detecting' # on the detection task queue
+    DONE = 'done' # result written to the result store or file
+    DROPPED = 'dropped' # given up on by download or detection, no result
+    # states an apk does not leave, forgotten by the journal
+    FINISHED = (DONE, DROPPED)
+
+
+class TaskJournal(object):
+    def __init__(
+        self,
+        journal_file,
+        compact_every=100000,
+    ):
+        self.journal_file = journal_file
+        self.compact_every = compact_every
+        # latest state of every apk not finished
+        self.states = {}
+        self.record_count = 0
+        self.lock = threading.Lock()
+        self.fd = None
+        journal_dir = os.path.dirname(journal_file)
+        if journal_dir and not os.path.exists(journal_dir):
+            os.makedirs(journal_dir, exist_ok=True)
+        if os.path.exists(journal_file):
+            self.replay()
+        self.compact()
+
+    def replay(self):
+        """ load the latest states, a torn last line of a crash is skipped
+        """
+        line_count = 0
+        with open(self.journal_file, 'r') as fd:
+            for line in fd:
+                line_count += 1
+                if not line.endswith('\n'):
+                    break
+                attrs = line.rstrip('\n').split('\t')
+                if len(attrs) != 2:
+                    logging.warning('skip bad journal line %d', line_count)
+                    continue
+                state, apk_id = attrs
+                if state in TaskState.FINISHED:
+                    self.states.pop(apk_id, None)
+                else:
+                    self.states[apk_id] = state
+        logging.info(
+            'replayed %d journal records, %d apks unfinished',
+            line_count,
+            len(self.states),
+        )
+
+    def compact(self):
+        """ rewrite the journal with only the states a restart resumes from
+        """
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+            self.states = dict([
+                (apk_id, state)
+                for apk_id, state in self.states.items()
+                if state != TaskState.QUEUED
+            ])
+            tmp_file = self.journal_file + '.tmp'
+            with open(tmp_file, 'w') as fd:
+                fd.write(''.join([
+                    '{0}\t{1}\n'.format(state, apk_id)
+                    for apk_id, state in self.states.items()
+                ]))
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(tmp_file, self.journal_file)
+            self.fd = open(self.journal_file, 'a')
+            self.record_count = len(self.states)
+
+    def record(self, state, apk_ids: typing.Iterable[str]):
+        """ append state for apk_ids in one write
+        """
+        apk_ids = list(apk_ids)
+        if len(apk_ids) == 0:
+            return
+        with self.lock:
+            self.fd.write(''.join([
+                '{0}\t{1}\n'.format(state, apk_id)
+                for apk_id in apk_ids
+            ]))
+            # written through to the os, so a crash of this process keeps it
+            self.fd.flush()
+            for apk_id in apk_ids:
+                if state in TaskState.FINISHED:
+                    self.states.pop(apk_id, None)
+                else:
+                    self.states[apk_id] = state
+            self.record_count += len(apk_ids)
+            is_compact = self.record_count >= self.compact_every + len(self.states)
+        if is_compact:
+            self.compact()
+
+    def ids_in(self, *states) -> typing.Set[str]:
+        with self.lock:
+            return set([
+                apk_id
+                for apk_id, state in self.states.items()
+                if state in states
+            ])
+
+    def close(self):
+        """ compact, so the next run replays only the apks to resume
+        """
+        self.compact()
+        with self.lock:
+            self.fd.close()
+            self.fd = None
@@ -0,0 +1,109 @@
+""" String pools of hand-built dex files
+"""
+import io
+import struct
+import unittest
+import zipfile
+import dex_parser
+from sign_matcher import SignMatcher
+
+
+def uleb128(value) -> bytes:
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def build_dex(strings, type_idxs) -> bytes:
+    """ a dex with only a header, string_ids, type_ids and string data
+    """
+    string_ids_off = dex_parser.DEX_HEADER_SIZE
+    type_ids_off = string_ids_off + 4 * len(strings)
+    data_off = type_ids_off + 4 * len(type_idxs)
+    string_data = bytearray()
+    string_data_offs = []
+    for string in strings:
+        string_data_offs.append(data_off + len(string_data))
+        string_data += uleb128(len(string)) + string + b'\0'
+    header = bytearray(dex_parser.DEX_HEADER_SIZE)
+    header[:8] = dex_parser.DEX_MAGIC + b'035\0'
+    struct.pack_into('<II', header, dex_parser.STRING_IDS_OFF, len(strings), string_ids_off)
+    struct.pack_into('<II', header, dex_parser.TYPE_IDS_OFF, len(type_idxs), type_ids_off)
+    return (
+        bytes(header)
+        + struct.pack('<{0}I'.format(len(strings)), *string_data_offs)
+        + struct.pack('<{0}I'.format(len(type_idxs)), *type_idxs)
+        + bytes(string_data)
+    )
+
+
+STRINGS = [
+    b'Lcom/xxx/p2p/Peer;',
+    b'[Lcom/yyy/Node;',
+    b'I',
+    b'wss://tracker.example.com',
+    b'x' * 200, # a uleb128 length of two bytes
+]
+
+
+class DexParserTest(unittest.TestCase):
+    def test_uleb128(self):
+        for value in [0, 1, 127, 128, 300, 2 ** 28]:
+            self.assertEqual(
+                dex_parser.read_uleb128(uleb128(value) + b'\xff', 0),
+                (value, len(uleb128(value))),
+            )
+        with self.assertRaises(dex_parser.DexFormatError):
+            dex_parser.read_uleb128(b'\x80\x80', 0)
+
+    def test_strings_and_types(self):
+        dex_data = build_dex(STRINGS, [0, 1, 2])
+        strings = dex_parser.parse_dex_strings(dex_data)
+        self.assertEqual(strings, STRINGS)
+        self.assertEqual(dex_parser.parse_dex_types(dex_data, strings), STRINGS[:3])
+
+    def test_class_names(self):
+        self.assertEqual(dex_parser.descriptor_to_class_name(b'Lcom/xxx/p2p/Peer;'), b'com.xxx.p2p.Peer')
+        self.assertEqual(dex_parser.descriptor_to_class_name(b'[[Lcom/yyy/Node;'), b'com.yyy.Node')
+        self.assertIsNone(dex_parser.descriptor_to_class_name(b'I'))
+
+    def test_bad_dex(self):
+        with self.assertRaises(dex_parser.DexFormatError):
+            dex_parser.parse_dex_strings(b'PK\x03\x04' + bytes(200))
+        dex_data = bytearray(build_dex(STRINGS, []))
+        struct.pack_into('<I', dex_data, dex_parser.STRING_IDS_OFF, 1000)
+        with self.assertRaises(dex_parser.DexFormatError):
+            dex_parser.parse_dex_strings(bytes(dex_data))
+
+    def test_index_match(self):
+        apk_data = io.BytesIO()
+        with zipfile.ZipFile(apk_data, 'w') as apk_zip:
+            apk_zip.writestr('classes.dex', build_dex(STRINGS[:2], [0]))
+            apk_zip.writestr('classes2.dex', build_dex(STRINGS[2:], [0]))
+            apk_zip.writestr('assets/classes.dex.txt', b'com.zzz.hidden')
+        dex_index = dex_parser.DexStringIndex()
+        with zipfile.ZipFile(apk_data) as apk_zip:
+            dex_index.add_apk(apk_zip)
+        self.assertEqual(dex_index.dex_count, 2)
+        self.assertIn(b'com.xxx.p2p.Peer', dex_index.strings)
+        sign_matcher = SignMatcher([
+            'com.xxx.p2p',
+            'tracker.example.com',
+            'com.zzz',
+            # spans two strings of the pool, never a hit
+            'Peer;[L',
+        ])
+        self.assertEqual(
+            dex_index.match(sign_matcher),
+            {'com.xxx.p2p', 'tracker.example.com'},
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
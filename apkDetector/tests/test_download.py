@@ -0,0 +1,163 @@
+""" Downloads against a local http server standing in for AndroZoo
+    run from apkDetector: python -m pytest tests
+"""
+import asyncio
+import hashlib
+import http.server
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.parse
+import get_apk_from_androzoo as du
+
+try:
+    import aiohttp
+    import async_downloader
+except ImportError:
+    aiohttp = None
+
+APK_DATA = bytes(range(256)) * 4096
+APK_SHA256 = hashlib.sha256(APK_DATA).hexdigest()
+
+
+class AndroZooHandler(http.server.BaseHTTPRequestHandler):
+    """ serves APK_DATA for any sha256, honoring byte ranges unless the
+        server says otherwise
+    """
+    def do_GET(self):
+        server = self.server
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        server.requests.append((query['sha256'][0], self.headers.get('Range')))
+        data = server.data
+        start = 0
+        range_match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if range_match is not None and server.honor_range:
+            start = int(range_match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                'Content-Range',
+                'bytes {0}-{1}/{2}'.format(start, len(data) - 1, len(data)),
+            )
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), AndroZooHandler)
+        self.server.data = APK_DATA
+        self.server.honor_range = True
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.download_url = du.ANDROZOO_DOWNLOAD_URL
+        du.ANDROZOO_DOWNLOAD_URL = (
+            'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+            + '/api/download?apikey={api_key}&sha256={sha256}'
+        )
+        self.work_dir = tempfile.mkdtemp()
+        self.result_file = os.path.join(self.work_dir, 'test.apk')
+        self.chunks = []
+
+    def tearDown(self):
+        du.ANDROZOO_DOWNLOAD_URL = self.download_url
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def write_part(self, data):
+        with open(self.result_file + '.part', 'wb') as fd:
+            fd.write(data)
+
+    def download(self, sha256=APK_SHA256) -> bool:
+        return du.download_apk(
+            sha256,
+            self.result_file,
+            'key',
+            chunk_size=64*1024,
+            chunk_callback=self.chunks.append,
+        )
+
+    def assert_downloaded(self):
+        with open(self.result_file, 'rb') as fd:
+            self.assertEqual(fd.read(), APK_DATA)
+        self.assertFalse(os.path.exists(self.result_file + '.part'))
+        # every byte reaches the callback exactly once, in order
+        self.assertEqual(b''.join(self.chunks), APK_DATA)
+
+    def test_download(self):
+        self.assertTrue(self.download())
+        self.assert_downloaded()
+        self.assertEqual(self.server.requests, [(APK_SHA256, None)])
+
+    def test_resume(self):
+        self.write_part(APK_DATA[:100000])
+        self.assertTrue(self.download())
+        self.assert_downloaded()
+        self.assertEqual(self.server.requests, [(APK_SHA256, 'bytes=100000-')])
+
+    def test_resume_range_ignored(self):
+        self.server.honor_range = False
+        self.write_part(APK_DATA[:100000])
+        self.assertTrue(self.download())
+        self.assert_downloaded()
+
+    def test_complete_part(self):
+        # the server answers 416 when the part file already has every byte
+        self.write_part(APK_DATA)
+        self.assertTrue(self.download())
+        self.assert_downloaded()
+        self.assertEqual(
+            self.server.requests,
+            [(APK_SHA256, 'bytes={0}-'.format(len(APK_DATA)))],
+        )
+
+    def test_sha256_mismatch(self):
+        self.assertFalse(self.download('00' * 32))
+        self.assertFalse(os.path.exists(self.result_file))
+        self.assertFalse(os.path.exists(self.result_file + '.part'))
+
+    def test_resume_sha256_mismatch(self):
+        # a corrupt part file is dropped, the next try starts over
+        self.write_part(b'x' * 100000)
+        self.assertFalse(self.download())
+        self.assertFalse(os.path.exists(self.result_file + '.part'))
+        self.chunks = []
+        self.assertTrue(self.download())
+        self.assert_downloaded()
+
+    @unittest.skipIf(aiohttp is None, 'needs aiohttp')
+    def test_async_resume(self):
+        self.write_part(APK_DATA[:100000])
+
+        async def download():
+            async with async_downloader.new_session(1) as session:
+                return await async_downloader.download_apk(
+                    session,
+                    APK_SHA256,
+                    self.result_file,
+                    'key',
+                    chunk_size=64*1024,
+                    chunk_callback=self.chunks.append,
+                )
+
+        self.assertTrue(asyncio.run(download()))
+        self.assert_downloaded()
+        self.assertEqual(self.server.requests, [(APK_SHA256, 'bytes=100000-')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+""" Round trips of the binary formats: task batches and the androzoo index
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from androzoo_index import AndroZooIndex, MISSING_DAY, select_csv
+from apk_detector_workflow_mp import Apk
+
+CSV_HEADER = 'sha256,sha1,md5,dex_date,apk_size,pkg_name,vercode,vt_detection,vt_scan_date,dex_size,markets\n'
+
+
+def sha256_of(i) -> str:
+    return '{0:064x}'.format(i * 0x9e3779b97f4a7c15 + 1)
+
+
+class ApkBatchTest(unittest.TestCase):
+    def test_round_trip(self):
+        apks = [
+            Apk(sha256_of(1), 'com.example.a', '2020-01-02', 'play.google.com'),
+            Apk(sha256_of(2), 'com.例子.b', '', 'anzhi|appchina', raw_signs=['p2p', 'ws://']),
+            Apk(sha256_of(3), 'c', apk_file='/data/apks/c.apk', raw_signs=[]),
+        ]
+        unpacked = Apk.unpack_batch(Apk.pack_batch(apks))
+        self.assertEqual(len(unpacked), len(apks))
+        for apk, other in zip(apks, unpacked):
+            for name in Apk.__slots__:
+                self.assertEqual(getattr(apk, name), getattr(other, name), name)
+
+    def test_empty(self):
+        self.assertEqual(Apk.unpack_batch(Apk.pack_batch([])), [])
+
+
+class AndroZooIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.csv_file = os.path.join(self.work_dir, 'latest.csv')
+        markets = ['play.google.com', 'anzhi', '"play.google.com|anzhi"', 'appchina']
+        with open(self.csv_file, 'w') as fd:
+            fd.write(CSV_HEADER)
+            for i in range(200):
+                dex_ds = '' if i % 17 == 0 else '20{0:02d}-{1:02d}-01 00:00:00'.format(10 + i % 12, 1 + i % 12)
+                fd.write('{0},a,b,{1},1,"com.p{2}",1,0,,1,{3}\n'.format(
+                    sha256_of(i).upper(),
+                    dex_ds,
+                    i,
+                    markets[i % len(markets)],
+                ))
+            # listed twice, kept once
+            fd.write('{0},a,b,2015-05-01 00:00:00,1,"com.p1",1,0,,1,anzhi\n'.format(sha256_of(1)))
+            # not a sha256, skipped
+            fd.write('nothex,a,b,2015-05-01 00:00:00,1,"com.bad",1,0,,1,anzhi\n')
+            fd.write('{0},a,b,2015-05-01 00:00:00,1,"com.bad",1,0,,1,anzhi\n'.format(sha256_of(7)[:62]))
+        self.index = AndroZooIndex.open(self.csv_file)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.work_dir)
+
+    def assert_same_selection(self, **kwargs):
+        selection = self.index.select(**kwargs)
+        apk_dict = select_csv(self.csv_file, **kwargs)
+        self.assertEqual(set(selection.keys()), set(apk_dict.keys()))
+        for sha256 in apk_dict:
+            self.assertIn(sha256, selection)
+            fields = selection[sha256]
+            self.assertEqual(fields['pkg_id'], apk_dict[sha256]['pkg_id'])
+            self.assertEqual(fields['market'], apk_dict[sha256]['market'])
+        return selection
+
+    def test_columns(self):
+        self.assertEqual(self.index.row_count, 201)
+        days = list(self.index.days)
+        self.assertEqual(days, sorted(days))
+        self.assertEqual(days[0], MISSING_DAY)
+
+    def test_select_all(self):
+        self.assertEqual(len(self.assert_same_selection()), 200)
+
+    def test_select_dates(self):
+        self.assert_same_selection(after_ds='2015-06-01')
+        self.assert_same_selection(before_ds='2015-06-01')
+        self.assert_same_selection(after_ds='2018-01-01', before_ds='2012-01-01')
+
+    def test_select_markets(self):
+        selection = self.assert_same_selection(markets=['anzhi'])
+        self.assertEqual(len(selection), 100)
+        self.assert_same_selection(after_ds='2015-06-01', markets=['appchina'])
+
+    def test_lookup(self):
+        selection = self.index.select()
+        self.assertEqual(selection[sha256_of(5)]['pkg_id'], 'com.p5')
+        self.assertNotIn('00' * 32, selection)
+        self.assertNotIn('nothex', selection)
+        self.assertNotIn('nothex', select_csv(self.csv_file))
+        # the earliest of the two rows of an apk listed twice
+        self.assertEqual(selection[sha256_of(1)]['dex_date'], '2011-02-01')
+        self.assertEqual(select_csv(self.csv_file)[sha256_of(1)]['dex_date'], '2011-02-01')
+
+    def test_id_order(self):
+        selection = self.index.select(markets=['anzhi'])
+        sha256s = list(selection.keys())
+        self.assertEqual(sha256s, sorted(sha256s))
+        for row in selection.rows:
+            self.assertEqual(
+                selection.shard_of(row, 7),
+                int(selection.sha256(row)[:8], 16) * 7 >> 32,
+            )
+
+    def test_find_rows(self):
+        for selection in [self.index.select(), select_csv(self.csv_file)]:
+            sha256s = [sha256_of(i) for i in range(0, 300, 3)] + ['nothex', sha256_of(2)]
+            for items in [sorted(sha256s), sha256s]:
+                self.assertEqual(
+                    list(selection.find_rows(items)),
+                    [(sha256, selection.row_of(sha256)) for sha256 in items],
+                )
+            self.assertEqual(
+                sum(1 for sha256, row in selection.find_rows(sorted(sha256s)) if row is not None),
+                68,
+            )
+
+    def test_old_index(self):
+        index_file = self.index.index_file
+        self.index.close()
+        with open(index_file, 'r+b') as fd:
+            fd.write(b'AZIDX001')
+        self.index = AndroZooIndex.open(self.csv_file)
+        self.assertEqual(len(self.index.select()), 200)
+
+    def test_stale(self):
+        self.assertTrue(self.index.is_fresh(self.csv_file))
+        with open(self.csv_file, 'a') as fd:
+            fd.write('{0},a,b,2020-01-01 00:00:00,1,"com.new",1,0,,1,anzhi\n'.format(sha256_of(1000)))
+        self.assertFalse(self.index.is_fresh(self.csv_file))
+        index = AndroZooIndex.open(self.csv_file)
+        try:
+            self.assertIn(sha256_of(1000), index.select())
+        finally:
+            index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
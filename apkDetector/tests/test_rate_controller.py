@@ -0,0 +1,66 @@
+""" Backoff detection and the AIMD window
+"""
+import socket
+import unittest
+import requests
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+from rate_controller import AimdController, is_backoff_error
+
+
+def http_error(status_code) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+class BackoffErrorTest(unittest.TestCase):
+    def test_status(self):
+        self.assertTrue(is_backoff_error(http_error(429)))
+        self.assertTrue(is_backoff_error(http_error(503)))
+        self.assertFalse(is_backoff_error(http_error(404)))
+
+    def test_wrapped_timeout(self):
+        read_timeout = ReadTimeoutError(None, '/api/download', 'Read timed out.')
+        self.assertTrue(is_backoff_error(requests.ConnectionError(read_timeout)))
+        self.assertTrue(is_backoff_error(requests.ConnectionError(
+            MaxRetryError(None, '/api/download', read_timeout),
+        )))
+        try:
+            try:
+                raise socket.timeout('timed out')
+            except OSError:
+                raise requests.ConnectionError('connection aborted')
+        except requests.ConnectionError as e:
+            self.assertTrue(is_backoff_error(e))
+        self.assertFalse(is_backoff_error(requests.ConnectionError('refused')))
+
+
+class AimdControllerTest(unittest.TestCase):
+    def test_window(self):
+        controller = AimdController(max_window=8, interval=0, backoff_gap=0)
+        self.assertEqual(int(controller.window.value), 2)
+        for i in range(2):
+            self.assertTrue(controller.acquire(timeout=0))
+        self.assertFalse(controller.acquire(timeout=0))
+        controller.on_chunk(b'x' * 1000)
+        controller.release(latency=1)
+        self.assertEqual(int(controller.window.value), 3)
+        controller.release(error=http_error(503))
+        self.assertEqual(int(controller.window.value), 1)
+        self.assertEqual(controller.in_flight.value, 0)
+
+    def test_local_bytes(self):
+        controller = AimdController(max_window=8, interval=3600)
+        controller.acquire(timeout=0)
+        controller.on_chunk(b'x' * 1000)
+        self.assertEqual(controller.interval_bytes.value, 0)
+        # the copy a download process gets starts without them
+        state = controller.__getstate__()
+        self.assertEqual(state['local_bytes'], 0)
+        self.assertNotIn('local_lock', state)
+        controller.release(latency=1)
+        self.assertEqual(controller.interval_bytes.value, 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
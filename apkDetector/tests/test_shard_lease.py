@@ -0,0 +1,83 @@
+""" Shard leases of two nodes sharing a lease dir
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from shard_lease import ShardLeaser, ShardProgress, shard_of
+
+
+class ShardLeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.lease_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lease_dir)
+
+    def leaser(self, node_id, lease_ttl=600) -> ShardLeaser:
+        return ShardLeaser(self.lease_dir, 4, node_id, lease_ttl=lease_ttl)
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of('00000000' + '0' * 56, 256), 0)
+        self.assertEqual(shard_of('ffffffff' + 'f' * 56, 256), 255)
+        self.assertEqual(shard_of('80000000' + '0' * 56, 4), 2)
+
+    def test_disjoint(self):
+        node1 = self.leaser('node1')
+        node2 = self.leaser('node2')
+        shards1 = [node1.acquire(), node1.acquire()]
+        shards2 = [node2.acquire(), node2.acquire()]
+        self.assertEqual(sorted(shards1 + shards2), [0, 1, 2, 3])
+        self.assertIsNone(node1.acquire())
+        self.assertIsNone(node2.acquire())
+
+    def test_done(self):
+        node1 = self.leaser('node1')
+        shards = list(node1.iter_shards())
+        self.assertEqual(sorted(shards), [0, 1, 2, 3])
+        node1.mark_done(shards[0])
+        node1.release(shards[1])
+        node1.finish(is_done=False)
+        # done shards are never leased again, released ones at once, and
+        # those left unfinished once their lease expired
+        node2 = self.leaser('node2')
+        self.assertEqual(list(node2.iter_shards()), [shards[1]])
+
+    def test_take_over(self):
+        node1 = self.leaser('node1', lease_ttl=0.2)
+        shard = node1.acquire()
+        node2 = self.leaser('node2')
+        self.assertNotEqual(node2.acquire(), shard)
+        time.sleep(0.3)
+        taken = [node2.acquire() for i in range(3)]
+        self.assertIn(shard, taken)
+        # the lost lease is dropped on the next renewal, and not marked done
+        node1.renew()
+        self.assertNotIn(shard, node1.held)
+        node1.mark_done(shard)
+        self.assertFalse(os.path.exists(node1.done_file(shard)))
+
+    def test_deadline(self):
+        node1 = self.leaser('node1')
+        self.assertEqual(list(node1.iter_shards(deadline=time.time() - 1)), [])
+
+    def test_progress(self):
+        node1 = self.leaser('node1')
+        shard1 = node1.acquire()
+        shard2 = node1.acquire()
+        progress = ShardProgress(node1)
+        progress.add(shard1, ['a', 'b'])
+        progress.add(shard2, [])
+        self.assertTrue(os.path.exists(node1.done_file(shard2)))
+        progress.settle(['a'])
+        self.assertFalse(os.path.exists(node1.done_file(shard1)))
+        # given up on, as settled by drop_result_phase
+        progress.settle(['b'])
+        with open(node1.done_file(shard1), 'r') as fd:
+            self.assertEqual(json.loads(fd.read())['node_id'], 'node1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+""" The trie regex of SignMatcher against plain substring checks
+"""
+import io
+import random
+import unittest
+from sign_matcher import SignMatcher, SignStream
+
+SIGN_STRS = ['p2p', 'p2pengine', 'com.xxx.p2p', 'webrtc', 'web', 'rtc', 'a.b', 'x*y', '(z)']
+
+
+def expected_signs(buf, sign_strs=SIGN_STRS) -> set:
+    return set([
+        sign_str
+        for sign_str in sign_strs
+        if sign_str.encode('utf-8') in buf
+    ])
+
+
+class SignMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.sign_matcher = SignMatcher(SIGN_STRS)
+
+    def test_match(self):
+        buf = b'load com.xxx.p2pengine over webrtc, not a-b or xy or z'
+        self.assertEqual(self.sign_matcher.match(buf), expected_signs(buf))
+        # regex metacharacters are plain bytes
+        self.assertEqual(self.sign_matcher.match(b'a-b xxy z'), set())
+        self.assertEqual(self.sign_matcher.match(b'x*y (z)'), {'x*y', '(z)'})
+
+    def test_random(self):
+        rand = random.Random(7)
+        alphabet = b'p2engiwbrtcom.x*y()az'
+        for i in range(200):
+            buf = bytes(rand.choice(alphabet) for j in range(rand.randint(0, 300)))
+            self.assertEqual(self.sign_matcher.match(buf), expected_signs(buf))
+
+    def test_no_signs(self):
+        sign_matcher = SignMatcher(['', ''])
+        self.assertEqual(sign_matcher.match(b'anything'), set())
+        self.assertFalse(sign_matcher.contains_any(b'anything'))
+
+    def test_utf16(self):
+        sign_matcher = SignMatcher(SIGN_STRS, encoding='utf-16-le')
+        self.assertEqual(sign_matcher.match('use webrtc'.encode('utf-16-le')), {'webrtc', 'web', 'rtc'})
+
+    def test_stream_boundaries(self):
+        buf = b'....com.xxx.p2p......webrtc...' * 3
+        for chunk_size in [1, 2, 3, 7, 64]:
+            self.assertEqual(
+                self.sign_matcher.match_stream(io.BytesIO(buf), chunk_size=chunk_size),
+                expected_signs(buf),
+            )
+
+    def test_stop_signs(self):
+        buf = b'web ' + b'.' * 100 + b' p2p'
+        sign_stream = SignStream(self.sign_matcher)
+        sign_stream.feed(buf[:50], stop_signs={'web'})
+        self.assertEqual(sign_stream.matched_signs, {'web'})
+
+    def test_should_stop(self):
+        buf = b'rtc ' * 10 + b'p2p ' + b'web ' * 10
+        self.assertEqual(
+            self.sign_matcher.match(buf, should_stop=lambda found: 'p2p' in found),
+            {'rtc', 'p2p'},
+        )
+        self.assertEqual(
+            self.sign_matcher.match_stream(
+                io.BytesIO(buf),
+                chunk_size=4,
+                should_stop=lambda found: 'p2p' in found,
+            ),
+            {'rtc', 'p2p'},
+        )
+        # a stream stopped once ignores later chunks
+        sign_stream = SignStream(self.sign_matcher)
+        for i in range(0, len(buf), 5):
+            sign_stream.feed(buf[i:i + 5], should_stop=lambda found: 'p2p' in found)
+        self.assertTrue(sign_stream.is_stopped)
+        self.assertEqual(sign_stream.matched_signs, {'rtc', 'p2p'})
+
+
+if __name__ == '__main__':
+    unittest.main()
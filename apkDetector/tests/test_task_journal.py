@@ -0,0 +1,71 @@
+""" Replay and compaction of the task journal
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from task_journal import TaskJournal, TaskState
+
+
+class TaskJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.work_dir, 'task_journal.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_replay(self):
+        journal = TaskJournal(self.journal_file)
+        journal.record(TaskState.QUEUED, ['a', 'b', 'c', 'd'])
+        journal.record(TaskState.DOWNLOADED, ['a', 'b', 'c'])
+        journal.record(TaskState.DETECTING, ['a', 'b'])
+        journal.record(TaskState.DONE, ['a'])
+        # no close, as after a crash
+        journal = TaskJournal(self.journal_file)
+        self.assertEqual(journal.ids_in(TaskState.DOWNLOADED, TaskState.DETECTING), {'b', 'c'})
+        # queued apks are queued again by a restart anyway
+        self.assertEqual(journal.ids_in(TaskState.QUEUED), set())
+        journal.close()
+
+    def test_dropped(self):
+        journal = TaskJournal(self.journal_file)
+        journal.record(TaskState.DETECTING, ['a', 'b'])
+        journal.record(TaskState.DROPPED, ['a'])
+        self.assertEqual(journal.ids_in(TaskState.DETECTING), {'b'})
+        journal = TaskJournal(self.journal_file)
+        self.assertEqual(journal.ids_in(TaskState.DETECTING, TaskState.DROPPED), {'b'})
+        journal.close()
+
+    def test_torn_line(self):
+        journal = TaskJournal(self.journal_file)
+        journal.record(TaskState.DOWNLOADED, ['a', 'b'])
+        journal.close()
+        with open(self.journal_file, 'a') as fd:
+            fd.write('bad line\n{0}\tb'.format(TaskState.DONE))
+        journal = TaskJournal(self.journal_file)
+        self.assertEqual(journal.ids_in(TaskState.DOWNLOADED), {'a', 'b'})
+        journal.close()
+
+    def test_compact(self):
+        journal = TaskJournal(self.journal_file, compact_every=10)
+        for i in range(100):
+            journal.record(TaskState.QUEUED, [str(i)])
+            journal.record(TaskState.DOWNLOADED, [str(i)])
+            if i % 10 != 0:
+                journal.record(TaskState.DONE, [str(i)])
+        with open(self.journal_file, 'r') as fd:
+            self.assertLess(len(fd.readlines()), 40)
+        journal.close()
+        with open(self.journal_file, 'r') as fd:
+            self.assertEqual(len(fd.readlines()), 10)
+        journal = TaskJournal(self.journal_file)
+        self.assertEqual(
+            journal.ids_in(TaskState.DOWNLOADED),
+            set([str(i) for i in range(0, 100, 10)]),
+        )
+        journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()